@@ -0,0 +1,319 @@
+"""
+Builds the venv of a repo from its requirements.txt.
+
+Venvs are content addressed by the hash of the resolved wheels and the base interpreter. They are staged in
+<cache dir>/venvs/<hash>, and the venv of the repo is a symlink to one of them, which is replaced atomically. The wheels
+are kept in a content addressed cache shared by all repos, so a venv is rebuilt without network. Posix only.
+"""
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from jenky import util
+
+logger = logging.getLogger(__package__)
+
+# Written last into a staged venv, so a venv without it is incomplete.
+MANIFEST = 'jenky-manifest.json'
+
+
+class DependencyError(Exception):
+    pass
+
+
+def venvs_root() -> Path:
+    return (util.cache_dir / 'venvs').absolute()
+
+
+def base_python(directory: Path) -> str:
+    """
+    The interpreter the venv of the directory is based on, or ours if there is none.
+    """
+    pyvenv_file = directory / 'venv' / 'pyvenv.cfg'
+    if pyvenv_file.is_file():
+        with open(pyvenv_file, 'r') as f:
+            pyvenv = {k.strip(): v.strip() for k, _, v in (line.partition('=') for line in f) if v}
+        # Since Python 3.11, else we guess.
+        for executable in (pyvenv.get('executable'), pyvenv.get('home', '') + '/python3'):
+            if executable and os.path.isfile(executable):
+                return executable
+    return sys.executable
+
+
+# Lines which include another requirements or constraints file.
+INCLUDE_PATTERN = re.compile(r'^(-r|--requirement|-c|--constraint)[\s=]*(\S+)$')
+
+
+def requirement_lines(path: Path, seen: Optional[set] = None) -> List[str]:
+    """
+    The lines of the requirements file without comments and blank lines, followed by the lines of the files it includes.
+    The lines of a constraints file are prefixed with -c.
+    """
+    seen = set() if seen is None else seen
+    seen.add(path.resolve())
+    lines = []
+    for line in path.read_text(encoding='utf8').splitlines():
+        line = line.partition('#')[0].strip()
+        match = INCLUDE_PATTERN.match(line)
+        if not match:
+            if line:
+                lines.append(line)
+            continue
+        included = path.parent / match.group(2)
+        if included.resolve() in seen:
+            continue
+        try:
+            included_lines = requirement_lines(included, seen)
+        except FileNotFoundError:
+            # pip will complain.
+            lines.append(line)
+            continue
+        if match.group(1) in ('-c', '--constraint'):
+            included_lines = ['-c ' + included_line for included_line in included_lines]
+        lines.extend(included_lines)
+    return lines
+
+
+def is_pinned(lines: List[str]) -> bool:
+    """
+    Whether all requirements are pinned to a version or URL, so that they always resolve to the same wheels.
+    """
+    return all('==' in line or ' @ ' in line for line in lines if not line.startswith('-'))
+
+
+def requirements_hash(directory: Path, python: str) -> Optional[str]:
+    """
+    Hash of the requirements, including the included files, without comments and blank lines and in any order, and of
+    the base interpreter. None if there is no requirements.txt.
+    """
+    try:
+        lines = sorted(requirement_lines(directory / 'requirements.txt'))
+    except FileNotFoundError:
+        return None
+    digest = hashlib.sha256(os.path.realpath(python).encode())
+    for line in lines:
+        digest.update(b'\n' + line.encode())
+    return digest.hexdigest()[:16]
+
+
+def resolved_hash(python: str, wheels: List[Path]) -> str:
+    """
+    Hash of the resolved wheels and of the base interpreter, which identifies a venv.
+    """
+    digest = hashlib.sha256(os.path.realpath(python).encode())
+    for wheel in sorted(wheel.parent.name for wheel in wheels):
+        digest.update(b'\n' + wheel.encode())
+    return digest.hexdigest()[:16]
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WheelCache:
+    """
+    Wheels stored by their sha256 as sha256/<digest>/<file name>, with links/<file name> pointing to them for pip's
+    --find-links. The wheels of each resolved requirements hash are listed in manifests/<hash>.json.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.links = root / 'links'
+        self.links.mkdir(parents=True, exist_ok=True)
+        (root / 'manifests').mkdir(exist_ok=True)
+
+    def add(self, wheel: Path) -> Path:
+        digest = file_digest(wheel)
+        path = self.root / 'sha256' / digest / wheel.name
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            shutil.copyfile(wheel, tmp_path)
+            os.replace(tmp_path, path)
+        link = self.links / wheel.name
+        tmp_link = self.links / (wheel.name + '.tmp')
+        tmp_link.unlink(missing_ok=True)
+        tmp_link.symlink_to(os.path.relpath(path, self.links))
+        os.replace(tmp_link, link)
+        return path
+
+    def manifest(self, requirements: str) -> Optional[List[Path]]:
+        try:
+            digests = json.loads((self.root / 'manifests' / f'{requirements}.json').read_text(encoding='utf8'))
+        except FileNotFoundError:
+            return None
+        wheels = [self.root / 'sha256' / entry for entry in digests]
+        if not all(wheel.is_file() for wheel in wheels):
+            return None
+        return wheels
+
+    def save_manifest(self, requirements: str, wheels: List[Path]):
+        digests = [wheel.relative_to(self.root / 'sha256').as_posix() for wheel in wheels]
+        path = self.root / 'manifests' / f'{requirements}.json'
+        path.with_suffix('.tmp').write_text(json.dumps(digests, indent=2), encoding='utf8')
+        os.replace(path.with_suffix('.tmp'), path)
+
+
+def wheel_cache() -> WheelCache:
+    return WheelCache((util.cache_dir / 'wheels').absolute())
+
+
+def pip(python: str, args: List[str], on_line: Callable[[str], None]) -> int:
+    """
+    Runs our pip for the interpreter python, which needs no pip of its own.
+    """
+    cmd = [sys.executable, '-m', 'pip', '--python', python, '--disable-pip-version-check'] + args
+    on_line(f'$ pip {" ".join(args)}')
+    return util.run_streaming(cmd, Path.cwd(), on_line)
+
+
+def resolve(directory: Path, python: str, requirements: str, cache: WheelCache, on_line: Callable[[str], None],
+            use_manifest: bool = True) -> List[Path]:
+    """
+    Returns the cached wheels of all requirements, including the dependencies. Without use_manifest, the requirements
+    are resolved again even if they were resolved before.
+    """
+    wheels = cache.manifest(requirements) if use_manifest else None
+    if wheels is not None:
+        on_line(f'{len(wheels)} wheels are cached')
+        return wheels
+
+    find_links = [cache.links] + util.wheel_dirs
+    args = ['wheel', '--requirement', (directory / 'requirements.txt').as_posix()]
+    for path in find_links:
+        args += ['--find-links', path.as_posix()]
+    if util.offline:
+        args.append('--no-index')
+    with tempfile.TemporaryDirectory(dir=cache.root) as tmp_dir:
+        if pip(python, args + ['--wheel-dir', tmp_dir], on_line):
+            raise DependencyError('Cannot resolve requirements.txt')
+        wheels = [cache.add(wheel) for wheel in sorted(Path(tmp_dir).glob('*.whl'))]
+    cache.save_manifest(requirements, wheels)
+    return wheels
+
+
+@contextlib.contextmanager
+def venv_lock(target: Path):
+    """
+    Serializes the builds of the venv target, also across jenky processes sharing the cache dir.
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with open(target.with_name(target.name + '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def relocate(venv: Path, old: Path, new: Path):
+    """
+    The scripts of a venv and its pyvenv.cfg contain the absolute path of the venv.
+    """
+    old_bytes, new_bytes = old.as_posix().encode(), new.as_posix().encode()
+    for path in [venv / 'pyvenv.cfg'] + list((venv / 'bin').iterdir()):
+        if path.is_symlink() or not path.is_file():
+            continue
+        content = path.read_bytes()
+        if old_bytes in content:
+            path.write_bytes(content.replace(old_bytes, new_bytes))
+
+
+def build_venv(python: str, requirements: str, target: Path, wheels: List[Path], on_line: Callable[[str], None]):
+    """
+    Creates the venv in a temporary directory, installs the wheels and renames it to target.
+    The caller holds the venv_lock of target.
+    """
+    tmp_target = Path(tempfile.mkdtemp(prefix=target.name + '.tmp-', dir=target.parent))
+    try:
+        if util.run_streaming([python, '-m', 'venv', '--without-pip', tmp_target.as_posix()], Path.cwd(), on_line):
+            raise DependencyError(f'Cannot create venv {target}')
+
+        # One pip, because concurrent installs into the same site-packages clash on shared directories and scripts.
+        venv_python = (tmp_target / 'bin' / 'python').as_posix()
+        args = ['install', '--no-deps', '--no-index', '--no-warn-script-location']
+        if wheels and pip(venv_python, args + [wheel.as_posix() for wheel in wheels], on_line):
+            raise DependencyError(f'Cannot install into venv {target}')
+
+        relocate(tmp_target, tmp_target, target)
+        (tmp_target / MANIFEST).write_text(
+            json.dumps(dict(python=python, requirements=requirements, wheels=[wheel.name for wheel in wheels]),
+                       indent=2), encoding='utf8')
+        if target.exists():
+            # A build which did not finish, from before we wrote the manifest last.
+            shutil.rmtree(target)
+        os.rename(tmp_target, target)
+    except BaseException:
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        raise
+
+
+def swap(directory: Path, target: Path, on_line: Callable[[str], None]):
+    """
+    Points the venv of the directory to target. A venv directory, which is not ours, is moved aside.
+    """
+    link = directory / 'venv'
+    if link.exists() and not link.is_symlink():
+        aside = directory / f'venv.old-{int(time.time())}'
+        os.rename(link, aside)
+        on_line(f'Moved {link} to {aside}')
+    tmp_link = directory / 'venv.tmp'
+    if tmp_link.is_symlink():
+        tmp_link.unlink()
+    tmp_link.symlink_to(target, target_is_directory=True)
+    os.replace(tmp_link, link)
+    on_line(f'Switched venv to {target}')
+
+
+def read_manifest(venv: Path) -> dict:
+    try:
+        return json.loads((venv / MANIFEST).read_text(encoding='utf8'))
+    except (FileNotFoundError, NotADirectoryError, ValueError):
+        return {}
+
+
+def sync(directory: Path, on_line: Callable[[str], None], python: Optional[str] = None) -> bool:
+    """
+    Makes the venv of the directory match its requirements.txt. Nothing is done if the pinned requirements did not
+    change, or if the requirements resolve to the wheels of the current venv.
+    Returns True if the venv was switched. Raises DependencyError.
+    """
+    if os.name != 'posix':
+        raise DependencyError('Building venvs is only supported on posix')
+    python = python or base_python(directory)
+    requirements = requirements_hash(directory, python)
+    if requirements is None:
+        return False
+    pinned = is_pinned(requirement_lines(directory / 'requirements.txt'))
+    link = directory / 'venv'
+    if pinned and link.is_symlink() and read_manifest(link).get('requirements') == requirements:
+        return False
+
+    t0 = time.time()
+    wheels = resolve(directory, python, requirements, wheel_cache(), on_line, use_manifest=pinned)
+    target = venvs_root() / resolved_hash(python, wheels)
+    if link.is_symlink() and os.readlink(link) == target.as_posix() and (target / MANIFEST).is_file():
+        return False
+
+    with venv_lock(target):
+        # Another repo may have built it while we waited.
+        if not (target / MANIFEST).is_file():
+            build_venv(python, requirements, target, wheels, on_line)
+            on_line(f'Built venv {target} with {len(wheels)} packages in {time.time() - t0:.1f}s')
+        swap(directory, target, on_line)
+    util.forget_python_runtime(directory)
+    return True
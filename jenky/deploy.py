@@ -0,0 +1,234 @@
+"""
+Blue/green deploys. The target ref is checked out into a new git worktree, and the processes of the repo are started
+there as a new generation. Only when all of them are ready, the old generation is stopped. If the new generation
+does not get ready, it is stopped instead and the old one keeps running.
+"""
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psutil
+
+from jenky import dependencies, git_helper, startup, util
+from jenky.util import Process, Repo
+
+logger = logging.getLogger(__package__)
+
+# Seconds the new generation must keep running after it is ready, before the old one is stopped.
+SETTLE_TIME = 2.
+
+
+class DeployError(Exception):
+    pass
+
+
+def deploys_file() -> Path:
+    return util.cache_dir / 'deploys.json'
+
+
+def load_deploys() -> Dict[str, str]:
+    """
+    The working tree of the last deploy by repo name.
+    """
+    try:
+        return json.loads(deploys_file().read_text(encoding='utf8'))
+    except FileNotFoundError:
+        return {}
+
+
+def save_deploy(repo: Repo):
+    deploys = load_deploys()
+    deploys[repo.repoName] = repo.directory.as_posix()
+    _save_deploys(deploys)
+
+
+def forget_deploy(repo_name: str):
+    deploys = load_deploys()
+    if deploys.pop(repo_name, None):
+        _save_deploys(deploys)
+
+
+def _save_deploys(deploys: Dict[str, str]):
+    tmp_file = deploys_file().with_suffix('.tmp')
+    tmp_file.write_text(json.dumps(deploys, indent=2), encoding='utf8')
+    os.replace(tmp_file, deploys_file())
+
+
+def deployed_directories() -> Dict[str, Path]:
+    """
+    The working trees of the last deploys which still exist, by repo name.
+    """
+    directories = {name: Path(directory) for name, directory in load_deploys().items()}
+    return {name: directory for name, directory in directories.items() if directory.is_dir()}
+
+
+def apply_deploys(repos: List[Repo]):
+    """
+    Points the repos to the working trees of their last deploys, so that these survive a restart of jenky.
+    """
+    directories = deployed_directories()
+    for repo in repos:
+        if repo.repoName in directories:
+            repo.directory = directories[repo.repoName]
+
+
+def worktree_processes(repo: Repo, directory: Path) -> Optional[List[Process]]:
+    """
+    The processes of the repo as configured by the jenky_config.json in the working tree, or None if the app config
+    lists them. Raises DeployError.
+    """
+    if not util.app_config_path:
+        return None
+    directories = deployed_directories()
+    directories[repo.repoName] = directory
+    try:
+        app_config, files = util.read_app_config(util.app_config_path, directories)
+        if directory / util.REPO_CONFIG_FILE not in files:
+            return None
+        repo_info = [repo_info for repo_info in app_config['repos'] if repo_info['repoName'] == repo.repoName][0]
+        return Repo.parse_obj(repo_info).processes
+    except (OSError, ValueError) as e:
+        raise DeployError(f'Invalid {util.REPO_CONFIG_FILE}: {e}')
+
+
+def worktree_root(repo: Repo) -> Path:
+    return (util.cache_dir / 'deploys' / repo.repoName).absolute()
+
+
+def add_worktree(repo: Repo, git_ref: str, on_line: Callable[[str], None]) -> Path:
+    """
+    Checks out git_ref into a new worktree next to the current ones. Raises DeployError.
+    """
+    completed = subprocess.run([git_helper.git_cmd, 'rev-parse', '--verify', '--quiet', git_ref + '^{commit}'],
+                               cwd=repo.directory.as_posix(), capture_output=True)
+    if completed.returncode:
+        raise DeployError(f'No such commit {git_ref}')
+    git_hash = str(completed.stdout, encoding='ascii').strip()
+
+    directory = worktree_root(repo) / f'{git_hash[:12]}-{int(time.time())}'
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    if git_helper.run_git(repo.directory, ['worktree', 'add', '--detach', directory.as_posix(), git_hash], on_line):
+        raise DeployError('Cannot add worktree')
+    try:
+        link_venv(repo.directory, directory, on_line)
+    except DeployError:
+        remove_worktree(repo, directory, on_line)
+        raise
+    return directory
+
+
+def link_venv(current: Path, directory: Path, on_line: Callable[[str], None]):
+    """
+    The venv is not under version control. The new working tree shares the venv of the current one if the
+    requirements are the same, and gets a venv built for its requirements otherwise.
+    """
+    venv = current / 'venv'
+    if not venv.exists() or (directory / 'venv').exists():
+        return
+
+    python = dependencies.base_python(current)
+    if dependencies.requirements_hash(current, python) == dependencies.requirements_hash(directory, python):
+        (directory / 'venv').symlink_to(venv.resolve(), target_is_directory=True)
+        on_line(f'Using venv {venv.resolve()}')
+        return
+    try:
+        dependencies.sync(directory, on_line, python)
+    except dependencies.DependencyError as e:
+        raise DeployError(str(e))
+
+
+def remove_worktree(repo: Repo, directory: Path, on_line: Callable[[str], None]):
+    """
+    Removes a worktree of a deploy. The configured directory of the repo is never removed.
+    """
+    if worktree_root(repo) not in directory.parents:
+        return
+    git_helper.run_git(repo.directory, ['worktree', 'remove', '--force', directory.as_posix()], on_line)
+
+
+def is_alive(p: psutil.Process) -> bool:
+    try:
+        return p.is_running() and p.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+class Generation:
+    """
+    The processes of a repo started in a new working tree. They are not supervised until they are adopted.
+    """
+
+    def __init__(self, repo: Repo, directory: Path, processes: Optional[List[Process]] = None):
+        """
+        processes are the definitions of the working tree, by default those of the live repo.
+        """
+        self.directory = directory
+        self.repo = repo.copy(update=dict(directory=directory, processes=repo.processes if processes is None else processes))
+        # The definition of the process, its copy of this generation and the running process.
+        self.started: List[Tuple[Process, Process, psutil.Process]] = []
+        # All copies, each with its own output until it is adopted.
+        self.copies: List[Process] = []
+
+    async def start(self, on_line: Callable[[str], None]):
+        """
+        Starts the processes to keep running in the waves of their dependencies, and waits until each wave is ready.
+        Raises DeployError.
+        """
+        loop = asyncio.get_running_loop()
+        self.repo.refresh()
+        try:
+            ordered = startup.waves(self.repo.processes)
+        except ValueError as e:
+            raise DeployError(str(e))
+
+        for wave in ordered:
+            wave = [proc for proc in wave if proc.keep_running]
+            if not wave:
+                continue
+            staged = []
+            for proc in wave:
+                copy = proc.copy()
+                copy.set_repo(self.repo)
+                util.stage_output(copy, f'{proc.name}.{self.directory.name}')
+                staged.append(copy)
+                self.copies.append(copy)
+            # Note: FastApi does not support asyncio subprocesses, so we start them from threads.
+            ps = await asyncio.gather(*(loop.run_in_executor(None, util.start_process, copy, self.directory)
+                                        for copy in staged))
+            for proc, copy, p in zip(wave, staged, ps):
+                if p:
+                    copy.create_time = p.create_time()
+                    self.started.append((proc, copy, p))
+                    on_line(f'Started {proc.name} with pid {p.pid}')
+            failed = [proc.name for proc, p in zip(wave, ps) if not p]
+            if failed:
+                raise DeployError(f'{", ".join(failed)} exited right away')
+
+            ready = await asyncio.gather(*(
+                startup.wait_ready(copy, copy.create_time, True, lambda p=p: is_alive(p))
+                for _, copy, p in self.started[-len(wave):]))
+            for (proc, copy, _), ok in zip(self.started[-len(wave):], ready):
+                if not ok:
+                    raise DeployError(f'{proc.name} did not get ready')
+                on_line(f'{proc.name} is ready after {copy.time_to_ready:.3f}s')
+
+        if self.started:
+            await asyncio.sleep(SETTLE_TIME)
+        exited = [proc.name for proc, _, p in self.started if not is_alive(p)]
+        if exited:
+            raise DeployError(f'{", ".join(exited)} exited')
+
+    async def stop(self):
+        """
+        Stops the processes and deletes the output of those not adopted.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, util.terminate_process, copy, p)
+                               for _, copy, p in self.started if is_alive(p)))
+        for copy in self.copies:
+            util.discard_output(copy)
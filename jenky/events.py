@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import threading
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__package__)
+
+
+def format_event(event: str, data: str, event_id: Optional[str] = None) -> str:
+    """
+    Formats a server-sent event, see https://html.spec.whatwg.org/multipage/server-sent-events.html
+    """
+    lines = [f'event: {event}']
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.extend(f'data: {line}' for line in data.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    def __init__(self, max_length: int):
+        # Pairs of event id and formatted event, None means the subscription was closed.
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_length + 1)
+        self.max_length = max_length
+        self.closed = False
+
+    async def get(self) -> Optional[Tuple[Optional[str], str]]:
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """
+    Fans out server-sent events to all subscribers. Each subscriber has a bounded buffer. A subscriber which cannot keep
+    up is closed, and the client is expected to reconnect with the Last-Event-ID header.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_length: int = 1000):
+        self.loop = loop
+        self.max_length = max_length
+        self.subscriptions: List[Subscription] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription(self.max_length)
+        with self._lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, event: str, data: str, event_id: Optional[str] = None):
+        """
+        May be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(self._publish, (event_id, format_event(event, data, event_id)))
+
+    def _publish(self, message: Tuple[Optional[str], str]):
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+
+        for subscription in subscriptions:
+            if subscription.queue.qsize() < subscription.max_length:
+                subscription.queue.put_nowait(message)
+            else:
+                logger.warning('Closing slow event stream subscriber')
+                self.unsubscribe(subscription)
+                subscription.closed = True
+                subscription.queue.put_nowait(None)
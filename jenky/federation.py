@@ -0,0 +1,112 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from jenky.util import Peer
+
+logger = logging.getLogger(__package__)
+
+
+class PeerError(Exception):
+    pass
+
+
+class Federation:
+    """
+    Talks to the peer jenky instances. All requests share one connection pool, reads are cached for ttl seconds, and
+    concurrent reads of the same resource share one request.
+    """
+
+    def __init__(self, peers: List[Peer], timeout: float = 2., ttl: float = 2.,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.peers: Dict[str, Peer] = {peer.name: peer for peer in peers}
+        self.ttl = ttl
+        self._client = httpx.AsyncClient(timeout=timeout, transport=transport,
+                                         limits=httpx.Limits(max_keepalive_connections=4 * len(peers) + 1))
+        # (peer name, path, params) -> (expiry, future of the response body)
+        self._cache: Dict[Tuple[str, str, Tuple], Tuple[float, asyncio.Future]] = {}
+
+    async def close(self):
+        await self._client.aclose()
+
+    def peer_url(self, name: str, path: str) -> str:
+        try:
+            peer = self.peers[name]
+        except KeyError:
+            raise PeerError(f'No such node {name}')
+        return peer.url.rstrip('/') + path
+
+    async def get(self, name: str, path: str, params: Optional[dict] = None) -> dict:
+        """
+        Raises PeerError if the peer is unknown, unreachable or answers with an error.
+        """
+        key = (name, path, tuple(sorted((params or {}).items())))
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached and cached[0] > now:
+            return await asyncio.shield(cached[1])
+
+        future = asyncio.ensure_future(self._get(name, path, params))
+        self._cache[key] = (now + self.ttl, future)
+        future.add_done_callback(functools.partial(self._forget_failure, key))
+        # Drop expired entries now and then.
+        if len(self._cache) > 100 * len(self.peers):
+            self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+        return await asyncio.shield(future)
+
+    def _forget_failure(self, key: Tuple, future: asyncio.Future):
+        if future.cancelled() or future.exception():
+            if self._cache.get(key, (None, None))[1] is future:
+                del self._cache[key]
+
+    async def _get(self, name: str, path: str, params: Optional[dict]) -> dict:
+        return await self._request('GET', name, path, params=params)
+
+    async def post(self, name: str, path: str, body: dict) -> dict:
+        result = await self._request('POST', name, path, json=body)
+        self.invalidate(name)
+        return result
+
+    def invalidate(self, name: str):
+        self._cache = {key: value for key, value in self._cache.items() if key[0] != name}
+
+    async def _request(self, method: str, name: str, path: str, **kwargs) -> dict:
+        url = self.peer_url(name, path)
+        try:
+            response = await self._client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            raise PeerError(f'{method} {url}: {type(e).__name__} {e}')
+        if response.status_code >= 400:
+            raise PeerError(f'{method} {url}: Status {response.status_code}')
+        try:
+            return response.json()
+        except ValueError:
+            raise PeerError(f'{method} {url}: Invalid JSON')
+
+    async def fan_out(self, path: str, params: Optional[dict] = None) -> Dict[str, object]:
+        """
+        Gets the resource from all peers concurrently. Returns the body or the PeerError per peer name.
+        """
+        names = list(self.peers)
+        results = await asyncio.gather(*(self.get(name, path, params) for name in names), return_exceptions=True)
+        for i, result in enumerate(results):
+            if isinstance(result, BaseException) and not isinstance(result, PeerError):
+                logger.error(f'Fan out to {names[i]}', exc_info=result)
+                results[i] = PeerError(str(result) or type(result).__name__)
+        return dict(zip(names, results))
+
+
+def tag_repos(config: dict, node: str) -> List[dict]:
+    """
+    Tags each repo and process of the /repos response with its node.
+    """
+    repos = config.get('repos', [])
+    for repo in repos:
+        repo['node'] = node
+        for proc in repo.get('processes', []):
+            proc['node'] = node
+    return repos
@@ -1,25 +1,26 @@
-# Note: FastApi does not support asyncio subprocesses, so do not use it!
+# Note: FastApi does not support asyncio subprocesses, so git runs in threads of the executor.
 
-raise Exception('Deprecated')
-
-import json
+import asyncio
+import collections
+import itertools
 import logging
 import os
-from pathlib import Path
-from typing import List, Tuple, Optional
 import subprocess
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
 
 from pydantic import BaseModel
 
-from jenky import util
+from jenky import dependencies, util
 from jenky.util import Repo
 
-logger = logging.getLogger()
+logger = logging.getLogger(__package__)
 
-# git_cmd = 'C:/ws/tools/PortableGit/bin/git.exe'
-# git_cmd = 'git'
-git_cmd: str = ''
+git_cmd: str = 'git'
 git_version: str = ''
+# Seconds a successful fetch is reused, so that viewing a repo does not go to the remote each time.
+FETCH_TTL = 60.
 
 
 def git_support(_git_cmd: str):
@@ -32,102 +33,62 @@ def git_support(_git_cmd: str):
         logger.warning(str(e))
 
 
-def is_git_repo(repo: Repo):
-    return git_version and (repo.directory / '.git').is_dir()
-
-
-def git_refs(git_dir: Path) -> Tuple[str, List[dict]]:
-    logger.debug(git_dir)
-    # TODO: git ls-remote --refs --quiet --symref
-    # But note that we cannot get creatorDate, nor sort by it!
-    proc = subprocess.run(
-        [git_cmd, 'for-each-ref', '--sort', '-creatordate', "--format",
-         """{
-          "refName": "%(refname)",
-          "creatorDate": "%(creatordate:iso-strict)",
-          "isHead": "%(HEAD)"
-        },"""],
-        cwd=git_dir.as_posix(),
-        capture_output=True)
-
-    if proc.stderr:
-        raise OSError(str(proc.stderr, encoding='utf8'))
+def is_git_repo(repo: Repo) -> bool:
+    return (repo.directory / '.git').exists()
 
-    output = str(proc.stdout, encoding='utf8')
-    refs = json.loads(f'[{output} null]')[:-1]
-    head_refs = [ref for ref in refs if ref['isHead'] == '*']
-    if not head_refs:
-        proc = subprocess.run(
-            [git_cmd, 'tag', '--points-at', 'HEAD'],
-            cwd=git_dir.as_posix(),
-            capture_output=True)
 
-        if proc.stderr:
-            raise OSError(str(proc.stderr, encoding='utf8'))
-
-        head_ref = str(proc.stdout, encoding='utf8')
-    else:
-        # This would be a "git rev-parse --abbrev-ref HEAD"
-        head_ref = head_refs[0]['refName']
-
-    return head_ref, refs
-
-
-def git_fetch(repo: Repo) -> List[str]:
-    git_dir = repo.directory
-    messages = []
-    cmd = [git_cmd, 'fetch', '--tags']
-    logger.debug(f'{git_dir} {cmd}')
-    proc = subprocess.run(cmd, cwd=git_dir.as_posix(), capture_output=True)
-    messages.append(str(proc.stderr, encoding='ascii').rstrip())
-    messages.append(str(proc.stdout, encoding='ascii').rstrip())
-
-    return messages
+def run_git(git_dir: Path, args: List[str], on_line: Callable[[str], None]) -> int:
+    """
+    Runs git in the directory and passes each line of its output to on_line. Returns the exit code.
+    """
+    on_line(f'$ git {" ".join(args)}')
+    env = os.environ.copy()
+    # Fail instead of waiting for credentials nobody will type in.
+    env['GIT_TERMINAL_PROMPT'] = '0'
+    return util.run_streaming([git_cmd] + args, git_dir, on_line, env=env)
 
 
-def get_sha(git_dir: Path, file: Path) -> str:
-    cmd = [git_cmd, "ls-files", "-s", file.as_posix()]
-    proc = subprocess.run(cmd, cwd=git_dir.as_posix(), capture_output=True)
-    line = str(proc.stdout, encoding='ascii').rstrip()
-    # Output format is
-    #    '100644 3fff12262ed377d9023c70f13f93ebd6b0f9dc46 0	filename'
-    return line.split()[1]
+def git_fetch(git_dir: Path, git_ref: Optional[str], on_line: Callable[[str], None]) -> int:
+    return run_git(git_dir, ['fetch', '--tags', '--progress'], on_line)
 
 
-def git_checkout(repo: Repo, git_ref: str) -> str:
+def git_checkout(git_dir: Path, git_ref: str, on_line: Callable[[str], None]) -> int:
     """
     git_ref is of the form refs/heads/main or refs/tags/0.0.3
     """
-    git_dir = repo.directory
-
     is_branch = git_ref.startswith('refs/heads/')
     target = git_ref
     if is_branch:
         # We need the branch name
-        target = git_ref.split('/')[-1]
+        target = git_ref[len('refs/heads/'):]
+
+    python = dependencies.base_python(git_dir)
+    requirements_before = dependencies.requirements_hash(git_dir, python)
 
-    sha_before = get_sha(git_dir, Path('requirements.txt'))
+    returncode = run_git(git_dir, ['checkout', target], on_line)
+    if returncode == 0 and is_branch:
+        returncode = run_git(git_dir, ['merge', '--ff-only'], on_line)
+
+    # The venv may have changed with the checkout.
+    util.forget_python_runtime(git_dir)
+
+    if dependencies.requirements_hash(git_dir, python) != requirements_before:
+        if (git_dir / 'venv').exists():
+            try:
+                dependencies.sync(git_dir, on_line, python)
+            except dependencies.DependencyError as e:
+                on_line(f'Warning: requirements.txt did change! {e}')
+                returncode = returncode or 1
+        else:
+            on_line('Warning: requirements.txt did change!')
 
-    cmd = [git_cmd, 'checkout', target]
-    logger.debug(f'{git_dir} {cmd}')
-    proc = subprocess.run(cmd, cwd=git_dir.as_posix(), capture_output=True)
-    messages = []
-    messages.append(str(proc.stderr, encoding='ascii').rstrip())
-    messages.append(str(proc.stdout, encoding='ascii').rstrip())
-    if proc.returncode == 1:
-        pass
-    elif is_branch:
-        cmd = [git_cmd, 'merge']
-        logger.debug(f'{git_dir} {cmd}')
-        proc = subprocess.run(cmd, cwd=git_dir.as_posix(), capture_output=True)
-        messages.append(str(proc.stderr, encoding='ascii').rstrip())
-        messages.append(str(proc.stdout, encoding='ascii').rstrip())
+    return returncode
 
-    sha_after = get_sha(git_dir, Path('requirements.txt'))
-    if sha_after != sha_before:
-        messages.append('Warning: requirements.txt did change!')
 
-    return '\n'.join(messages)
+ACTIONS: Dict[str, Callable[[Path, Optional[str], Callable[[str], None]], int]] = dict(
+    fetch=git_fetch,
+    checkout=git_checkout,
+)
 
 
 class GitAction(BaseModel):
@@ -135,24 +96,147 @@ class GitAction(BaseModel):
     gitRef: Optional[str]
 
 
-def register_endpoints(app, config):
+class GitJob:
+    """
+    One git operation on a repo. The state goes from queued to running to done or failed.
+    """
 
-    @app.get("/repos/{repo_id}")
-    def get_repo(repo_id: str) -> Repo:
-        repo = util.repo_by_id(config.repos, repo_id)
-        if is_git_repo(repo):
-            git_fetch(repo)
-            repo.git_tag, repo.git_refs = git_refs(repo.directory)
-        else:
-            repo.git_message = 'Not a git repository'
-        return repo
-
-    @app.post("/repos/{repo_id}")
-    def post_repo(repo_id: str, action: GitAction) -> dict:
-        repo = util.repo_by_id(config.repos, repo_id)
-        if action.action == 'checkout':
-            message = git_checkout(repo, git_ref=action.gitRef)
-        else:
-            assert False, 'Invalid action ' + action.action
+    def __init__(self, job_id: int, repo: Repo, action: str, git_ref: Optional[str]):
+        self.id = job_id
+        self.repo = repo
+        self.action = action
+        self.git_ref = git_ref
+        self.state = 'queued'
+        self.lines: List[str] = []
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.done = asyncio.Event()
+        self._changed = asyncio.Event()
+
+    def append(self, line: str):
+        """
+        Must be called on the event loop.
+        """
+        self.lines.append(line)
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def finish(self, state: str, error: Optional[str] = None):
+        self.state = state
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+        self._notify()
+
+    async def follow(self, offset: int = 0):
+        """
+        Yields the output lines from offset on, until the job is finished.
+        """
+        while True:
+            changed = self._changed
+            while offset < len(self.lines):
+                yield self.lines[offset]
+                offset += 1
+            if self.finished_at is not None:
+                return
+            await changed.wait()
+
+    def as_dict(self) -> dict:
+        return dict(id=self.id, repoName=self.repo.repoName, action=self.action, gitRef=self.git_ref,
+                    state=self.state, error=self.error, lines=self.lines, createdAt=self.created_at,
+                    startedAt=self.started_at, finishedAt=self.finished_at)
+
+
+class GitQueue:
+    """
+    Runs the git jobs, one at a time per repo and at most concurrency at once. Must be created on the event loop.
+    Besides the ACTIONS, which run in a thread, coroutine functions of the repo, git ref and a line callback can be
+    added to actions.
+    """
 
-        return dict(repo_id=repo_id, action=action.action, message=message)
+    def __init__(self, concurrency: int = 4, fetch_ttl: float = FETCH_TTL, max_length: int = 100,
+                 on_done: Optional[Callable[[GitJob], None]] = None):
+        self.fetch_ttl = fetch_ttl
+        self.max_length = max_length
+        self.on_done = on_done
+        self.actions = dict(ACTIONS)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._repo_locks: Dict[str, asyncio.Lock] = {}
+        self._ids = itertools.count(1)
+        self.jobs: Dict[int, GitJob] = collections.OrderedDict()
+        # The last fetch job per repo name.
+        self._fetches: Dict[str, GitJob] = {}
+
+    def submit(self, repo: Repo, action: str, git_ref: Optional[str] = None) -> GitJob:
+        """
+        Raises ValueError on an invalid action.
+        """
+        if action not in self.actions:
+            raise ValueError(f'Invalid action {action}')
+        if action != 'fetch' and not git_ref:
+            raise ValueError(f'{action.capitalize()} needs a gitRef')
+        job = GitJob(next(self._ids), repo, action, git_ref)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_length:
+            self.jobs.popitem(last=False)
+        asyncio.create_task(self._run(job))
+        return job
+
+    def get(self, job_id: int) -> GitJob:
+        return self.jobs[job_id]
+
+    def fetch(self, repo: Repo) -> GitJob:
+        """
+        Returns the running or a successful fetch job of the repo younger than fetch_ttl, or submits a new one.
+        """
+        job = self._fetches.get(repo.repoName)
+        if job is not None:
+            if job.finished_at is None:
+                return job
+            if job.state == 'done' and time.time() - job.finished_at < self.fetch_ttl:
+                return job
+        job = self._fetches[repo.repoName] = self.submit(repo, 'fetch')
+        return job
+
+    def fetch_all(self, repos: List[Repo]) -> List[GitJob]:
+        return [self.fetch(repo) for repo in repos if is_git_repo(repo)]
+
+    async def _run(self, job: GitJob):
+        loop = asyncio.get_running_loop()
+        lock = self._repo_locks.setdefault(job.repo.repoName, asyncio.Lock())
+        # Wait for the repo first, so that waiting jobs do not block other repos.
+        async with lock:
+            async with self._semaphore:
+                job.state = 'running'
+                job.started_at = time.time()
+                logger.info(f'git {job.action} {job.git_ref or ""} in {job.repo.repoName}')
+                action = self.actions[job.action]
+                try:
+                    if asyncio.iscoroutinefunction(action):
+                        returncode = await action(job.repo, job.git_ref, job.append)
+                    else:
+                        returncode = await loop.run_in_executor(
+                            None, action, job.repo.directory, job.git_ref,
+                            lambda line: loop.call_soon_threadsafe(job.append, line))
+                        # Let the pending lines arrive first.
+                        await asyncio.sleep(0)
+                    if returncode:
+                        job.finish('failed', f'Exit code {returncode}')
+                    else:
+                        job.finish('done')
+                except Exception as e:
+                    logger.exception(f'git {job.action} in {job.repo.repoName}')
+                    job.finish('failed', str(e) or type(e).__name__)
+
+        if job.state == 'failed':
+            logger.warning(f'git {job.action} in {job.repo.repoName} failed: {job.error}')
+        if self.on_done:
+            try:
+                self.on_done(job)
+            except Exception:
+                logger.exception(f'Handling git job {job.id}')
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+from jenky.metrics import Histogram, label_value
+from jenky.util import Process
+
+logger = logging.getLogger(__package__)
+
+
+class ProbeState:
+    def __init__(self):
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.last_probe: Optional[float] = None
+        self.histogram = Histogram()
+
+    def as_dict(self) -> dict:
+        return dict(failures=self.failures, lastError=self.last_error, lastProbe=self.last_probe,
+                    latency=self.histogram.as_dict())
+
+
+class HealthChecker:
+    """
+    Runs the liveness probes of all running processes concurrently on the event loop. After failureThreshold
+    consecutive failures, on_unhealthy is called with the process.
+    """
+
+    def __init__(self, on_unhealthy: Callable[[Process], None]):
+        self.on_unhealthy = on_unhealthy
+        self.states: Dict[str, ProbeState] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._client = httpx.AsyncClient()
+
+    def start(self, procs: List[Process]):
+        for proc in procs:
+            if proc.liveness and proc.name not in self._tasks:
+                self.states[proc.name] = ProbeState()
+                self._tasks[proc.name] = asyncio.create_task(self._run(proc))
+
+    def stop(self, proc: Process):
+        task = self._tasks.pop(proc.name, None)
+        if task:
+            task.cancel()
+        self.states.pop(proc.name, None)
+
+    async def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        await self._client.aclose()
+
+    async def _run(self, proc: Process):
+        state = self.states[proc.name]
+        while True:
+            await asyncio.sleep(proc.liveness.interval)
+            create_time = proc.create_time
+            if create_time is None or time.time() - create_time < proc.liveness.initial_delay:
+                # Not running, or still starting up.
+                state.failures = 0
+                proc.healthy = None
+                continue
+
+            t0 = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.probe(proc), proc.liveness.timeout)
+                error = None
+            except asyncio.TimeoutError:
+                error = f'Timeout after {proc.liveness.timeout}s'
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            state.histogram.observe(time.perf_counter() - t0)
+            state.last_probe = time.time()
+
+            if proc.create_time != create_time:
+                # Restarted while we were probing.
+                continue
+            if error is None:
+                state.failures = 0
+                proc.healthy = True
+                continue
+
+            state.failures += 1
+            state.last_error = error
+            logger.warning(f'Liveness probe {state.failures} of process {proc.name} failed: {error}')
+            if state.failures >= proc.liveness.failure_threshold:
+                proc.healthy = False
+                state.failures = 0
+                try:
+                    self.on_unhealthy(proc)
+                except Exception:
+                    logger.exception(f'Handling unhealthy {proc.name}')
+
+    async def probe(self, proc: Process):
+        """
+        Raises an exception if the process is not alive.
+        """
+        liveness = proc.liveness
+        if liveness.http:
+            response = await self._client.get(liveness.http, timeout=liveness.timeout)
+            if response.status_code >= 400:
+                raise ValueError(f'Status {response.status_code}')
+        elif liveness.port is not None:
+            _, writer = await asyncio.open_connection(liveness.host, liveness.port)
+            writer.close()
+        elif liveness.command:
+            # Note: FastApi does not support asyncio subprocesses, so we run it in a thread.
+            completed = await asyncio.get_running_loop().run_in_executor(None, lambda: subprocess.run(
+                liveness.command, cwd=proc.repo.directory, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, timeout=liveness.timeout))
+            if completed.returncode:
+                raise ValueError(f'Exit code {completed.returncode}')
+
+    def prometheus(self, procs: List[Process]) -> str:
+        lines = [
+            '# HELP jenky_probe_duration_seconds Latency of the liveness probes.',
+            '# TYPE jenky_probe_duration_seconds histogram',
+        ]
+        for proc in procs:
+            state = self.states.get(proc.name)
+            if state is None:
+                continue
+            labels = f'repo="{label_value(proc.repo.repoName)}",process="{label_value(proc.name)}"'
+            for bound, count in state.histogram.cumulative():
+                lines.append(f'jenky_probe_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'jenky_probe_duration_seconds_sum{{{labels}}} {state.histogram.sum:.15g}')
+            lines.append(f'jenky_probe_duration_seconds_count{{{labels}}} {state.histogram.count}')
+        return '\n'.join(lines) + '\n'
@@ -3,6 +3,21 @@ declare namespace jenky {
         name: string;
         createTime: number;
         keepRunning: boolean;
+        gracePeriod: number;
+        maxOutputBytes: number;
+        keepRuns: number;
+        restartBackoff: number;
+        maxRestartBackoff: number;
+        maxRestarts: number;
+        restartWindow: number;
+        crashLooping: boolean;
+        nextRestart: number;
+        dependsOn: string[];
+        readiness: Readiness;
+        timeToReady: number;
+        liveness: Liveness;
+        healthy: boolean;
+        preload: string[];
         serviceSubDomain: string;
         serviceHomePath: string;
         logUrl: string;
@@ -21,4 +36,36 @@ declare namespace jenky {
         gitMessage: string;
         processes: Process[];
     }
-}
\ No newline at end of file
+
+    interface Readiness {
+        port: number;
+        host: string;
+        logPattern: string;
+        file: string;
+        timeout: number;
+    }
+
+    interface Liveness {
+        http: string;
+        port: number;
+        host: string;
+        command: string[];
+        interval: number;
+        initialDelay: number;
+        timeout: number;
+        failureThreshold: number;
+    }
+
+    interface Peer {
+        name: string;
+        url: string;
+    }
+
+    interface Config {
+        appName: string;
+        version: string;
+        repos: Repo[];
+        nodeName: string;
+        peers: Peer[];
+    }
+}
@@ -0,0 +1,198 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__package__)
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY,
+        created REAL NOT NULL,
+        process TEXT,
+        level INTEGER NOT NULL,
+        name TEXT,
+        func TEXT,
+        message TEXT NOT NULL,
+        exc_text TEXT)''',
+    'CREATE INDEX IF NOT EXISTS logs_process_created_level ON logs (process, created, level)',
+    'CREATE INDEX IF NOT EXISTS logs_created ON logs (created)',
+    'CREATE INDEX IF NOT EXISTS logs_level_created ON logs (level, created)',
+]
+
+FTS_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5(message, content='logs', content_rowid='id')",
+    '''CREATE TRIGGER IF NOT EXISTS logs_ai AFTER INSERT ON logs BEGIN
+        INSERT INTO logs_fts (rowid, message) VALUES (new.id, new.message);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS logs_ad AFTER DELETE ON logs BEGIN
+        INSERT INTO logs_fts (logs_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END''',
+]
+
+COLUMNS = ['id', 'created', 'process', 'level', 'name', 'func', 'message', 'exc_text']
+
+
+class LogStore(logging.Handler):
+    """
+    Persistent and queryable store of all log records, both of jenky and of the child processes.
+    Records are written in batches by a background thread, and records older than retention_days are deleted.
+    Queries use keyset pagination on (created, id), so that deep pages are as fast as the first one.
+    """
+
+    def __init__(self, path: Path, retention_days: float = 30., fts: bool = True, batch_size: int = 1000):
+        super().__init__()
+        self.path = path
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.last_retention = 0.
+        # Records emitted after the writer stopped.
+        self.dropped = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+
+        connection = self._connect()
+        for sql in SCHEMA:
+            connection.execute(sql)
+        self.fts = False
+        if fts:
+            try:
+                for sql in FTS_SCHEMA:
+                    connection.execute(sql)
+                self.fts = True
+            except sqlite3.OperationalError as e:
+                # SQLite was compiled without FTS5.
+                logger.warning(f'No full text search on logs: {e}')
+        connection.commit()
+        connection.close()
+
+        self._writer = threading.Thread(target=self._run, name='jenky-log-store', daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path.as_posix(), timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    def emit(self, record: logging.LogRecord):
+        if not self._writer.is_alive():
+            # Closed, nobody would drain the queue.
+            self.dropped += 1
+            return
+        try:
+            message = record.getMessage()
+        except Exception:
+            message = str(record.msg)
+        self._queue.put((record.created, getattr(record, 'jenky_process', None), record.levelno, record.name,
+                         record.funcName, message, record.exc_text))
+
+    def flush(self):
+        """
+        Blocks until all records emitted so far are written.
+        """
+        if not self._writer.is_alive():
+            # Closed already, logging.shutdown() flushes all handlers at exit.
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        super().close()
+
+    def _run(self):
+        connection = self._connect()
+        sql = 'INSERT INTO logs (created, process, level, name, func, message, exc_text) VALUES (?, ?, ?, ?, ?, ?, ?)'
+        closed = False
+        while not closed:
+            try:
+                items = [self._queue.get(timeout=1.)]
+            except queue.Empty:
+                items = []
+            while items and len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Besides records, there are flush events and None for close.
+            rows = [item for item in items if isinstance(item, tuple)]
+            events = [item for item in items if isinstance(item, threading.Event)]
+            closed = None in items
+
+            try:
+                if rows:
+                    with connection:
+                        connection.executemany(sql, rows)
+                self._apply_retention(connection)
+            except Exception:
+                logger.exception('Writing logs')
+            for event in events:
+                event.set()
+        connection.close()
+
+    def _apply_retention(self, connection: sqlite3.Connection):
+        now = time.time()
+        if now - self.last_retention < 3600.:
+            return
+        self.last_retention = now
+        # Delete in small transactions, so that readers and the writer are not blocked for long.
+        while True:
+            with connection:
+                count = connection.execute(
+                    'DELETE FROM logs WHERE id IN (SELECT id FROM logs WHERE created < ? LIMIT 10000)',
+                    (now - self.retention_days * 86400,)).rowcount
+            if count < 10000:
+                break
+
+    def query(self, process: Optional[str] = None, level: Optional[int] = None, since: Optional[float] = None,
+              until: Optional[float] = None, text: Optional[str] = None, cursor: Optional[str] = None,
+              limit: int = 100) -> Tuple[List[dict], Optional[str]]:
+        """
+        Returns the matching logs, newest first, and the cursor for the next (older) page, if any.
+        level is the minimal level, and text is an FTS5 query on the message.
+        """
+        where = []
+        params = []
+        if process is not None:
+            where.append('process = ?')
+            params.append(process)
+        if level is not None:
+            where.append('level >= ?')
+            params.append(level)
+        if since is not None:
+            where.append('created >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('created < ?')
+            params.append(until)
+        if text:
+            if not self.fts:
+                raise ValueError('Full text search is not available')
+            where.append('id IN (SELECT rowid FROM logs_fts WHERE logs_fts MATCH ?)')
+            params.append(text)
+        if cursor:
+            created, _, log_id = cursor.partition(',')
+            where.append('(created, id) < (?, ?)')
+            params.extend([float(created), int(log_id)])
+
+        sql = f'SELECT {", ".join(COLUMNS)} FROM logs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY created DESC, id DESC LIMIT ?'
+        params.append(limit)
+
+        connection = sqlite3.connect(self.path.as_posix(), timeout=10)
+        try:
+            rows = connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+        logs = [dict(zip(COLUMNS, row)) for row in rows]
+        next_cursor = f'{rows[-1][1]!r},{rows[-1][0]}' if len(rows) == limit else None
+        return logs, next_cursor
@@ -1,11 +1,37 @@
 # TODO: Rename?
 # If an application accidentally has the jenky package folder in its search path,
 # this module overrides stdlib logging package, and things fail. Which is fine, or not.
+import collections
+import json
 import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional
 
 import persistqueue
+from persistqueue.serializers import pickle as serializer
+
+# Where persistqueue.SQLiteQueue stores its items.
+QUEUE_DB_FILE = 'data.db'
+QUEUE_TABLE = 'queue_default'
+# Attempts to write a batch, and the delay in seconds before the first retry, doubling with each retry.
+WRITE_ATTEMPTS = 5
+RETRY_DELAY = 0.1
+
+
+def insert_items(connection: sqlite3.Connection, items: List[Dict]):
+    """
+    Appends the items to the queue in one transaction. This writes to the private table of persistqueue.SQLiteQueue
+    with its serializer, exactly as SQLiteQueue.put does for a single item.
+    """
+    now = time.time()
+    with connection:
+        connection.executemany(f'INSERT INTO {QUEUE_TABLE} (data, timestamp) VALUES (?, ?)',
+                               [(serializer.dumps(item), now) for item in items])
 
 
 class PersistHandler(logging.Handler):
@@ -19,6 +45,8 @@ class PersistHandler(logging.Handler):
         self.queue.put(self.record_to_dict(record))
 
     def record_to_dict(self, record: logging.LogRecord) -> Dict:
+        # The name of the process as configured in jenky.
+        record.jenkyProcess = os.environ.get('JENKY_NAME')
         delattr(record, 'process')
         delattr(record, 'processName')
         delattr(record, 'thread')
@@ -54,6 +82,165 @@ class PersistHandler(logging.Handler):
         )
         record.module = d['module']
         record.created = d['created']
+        record.jenky_process = d.get('jenkyProcess')
         if 'exc_text' in d:
             record.exc_text = d['exc_text']
         return record
+
+
+class BatchingPersistHandler(PersistHandler):
+    """
+    Same as PersistHandler, but emit() only appends to a bounded buffer. A background thread writes the buffered records
+    in one transaction every batch_size records or flush_interval seconds, whichever comes first.
+    If the buffer is full, emit() does what overflow says: block, drop-oldest or drop-newest.
+    A batch which cannot be written is retried with backoff, and dropped after WRITE_ATTEMPTS.
+    """
+
+    def __init__(self, cache_path: Path, batch_size: int = 500, flush_interval: float = 0.1,
+                 max_length: int = 100000, overflow: str = 'block'):
+        assert overflow in {'block', 'drop-oldest', 'drop-newest'}, 'Invalid overflow ' + overflow
+        # This creates the queue table.
+        super().__init__(cache_path)
+        self.db_file = Path(cache_path) / QUEUE_DB_FILE
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_length = max_length
+        self.overflow = overflow
+        self.buffer = collections.deque()
+        self.dropped = 0
+        # Records lost because their batch could not be written.
+        self.failed = 0
+        self._condition = threading.Condition()
+        self._appended = 0
+        # Records committed to the queue.
+        self._written = 0
+        # Records dropped from the buffer or lost.
+        self._discarded = 0
+        self._flush_requested = False
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name='jenky-persist-handler', daemon=True)
+        self._writer.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        item = self.record_to_dict(record)
+        with self._condition:
+            while len(self.buffer) >= self.max_length and not self._closed:
+                if self.overflow == 'drop-newest':
+                    self.dropped += 1
+                    return
+                elif self.overflow == 'drop-oldest':
+                    self.buffer.popleft()
+                    self.dropped += 1
+                    self._discarded += 1
+                else:
+                    self._condition.wait()
+            self.buffer.append(item)
+            self._appended += 1
+            if len(self.buffer) >= self.batch_size:
+                self._condition.notify_all()
+
+    def flush(self) -> None:
+        """
+        Blocks until all records emitted so far are written.
+        """
+        with self._condition:
+            target = self._appended
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._written + self._discarded < target and self._writer.is_alive():
+                self._condition.wait(0.1)
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        super().close()
+
+    def _run(self):
+        # SQLite connections must not be shared between threads.
+        connection = sqlite3.connect(self.db_file.as_posix(), timeout=10)
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: len(self.buffer) >= self.batch_size or self._flush_requested or self._closed,
+                    timeout=self.flush_interval)
+                items = list(self.buffer)
+                self.buffer.clear()
+                self._flush_requested = False
+                closed = self._closed
+                # Unblock emitters.
+                self._condition.notify_all()
+
+            if items:
+                written = self._write(connection, items)
+                with self._condition:
+                    if written:
+                        self._written += len(items)
+                    else:
+                        self.failed += len(items)
+                        self._discarded += len(items)
+                    self._condition.notify_all()
+            elif closed:
+                break
+
+        connection.close()
+
+    def _write(self, connection: sqlite3.Connection, items: List[Dict]) -> bool:
+        """
+        Returns False if the batch could not be written after WRITE_ATTEMPTS.
+        """
+        delay = RETRY_DELAY
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                insert_items(connection, items)
+                return True
+            except Exception:
+                if attempt == WRITE_ATTEMPTS:
+                    # Reports the exception with the first record of the batch.
+                    self.handleError(self.record_from_dict(items[0]))
+                    return False
+                time.sleep(delay)
+                delay *= 2
+
+
+class UnixSocketHandler(PersistHandler):
+    """
+    Sends each record as one JSON datagram to the Unix socket of the jenky server, without blocking.
+    If the socket is gone or its buffer is full, the record goes to the persistent queue instead, same as PersistHandler.
+    """
+
+    def __init__(self, socket_path: Optional[str], cache_path: Path):
+        logging.Handler.__init__(self)
+        self.formatter = logging.Formatter()
+        self.socket_path = socket_path
+        self.cache_path = cache_path
+        self._queue: Optional[persistqueue.SQLiteQueue] = None
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    @classmethod
+    def from_environ(cls) -> 'UnixSocketHandler':
+        return cls(os.environ.get('JENKY_LOG_SOCKET'), Path(os.environ['JENKY_LOG_FILE']))
+
+    @property
+    def queue(self) -> persistqueue.SQLiteQueue:
+        # Only created if we ever need the fallback.
+        if self._queue is None:
+            self._queue = persistqueue.SQLiteQueue(self.cache_path, auto_commit=True)
+        return self._queue
+
+    def emit(self, record: logging.LogRecord) -> None:
+        item = self.record_to_dict(record)
+        if self.socket_path:
+            try:
+                self.sock.sendto(json.dumps(item, default=str).encode('utf8'), self.socket_path)
+                return
+            except OSError:
+                # For example no such file, connection refused, would block or message too long.
+                pass
+        self.queue.put(item)
+
+    def close(self) -> None:
+        self.sock.close()
+        super().close()
@@ -0,0 +1,271 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import psutil
+
+from jenky.util import Process
+
+logger = logging.getLogger(__package__)
+
+# Name, Prometheus type and help of each sampled value. Values are summed over the process and all its descendants.
+# The io bytes are gauges, not counters: They drop whenever a child exits or the process restarts.
+FIELDS: List[Tuple[str, str, str]] = [
+    ('cpuPercent', 'gauge', 'CPU utilization in percent of one core'),
+    ('rssBytes', 'gauge', 'Resident set size in bytes'),
+    ('numFds', 'gauge', 'Number of open file descriptors (handles on Windows)'),
+    ('numThreads', 'gauge', 'Number of threads'),
+    ('readBytes', 'gauge', 'Bytes read by the live processes of the tree'),
+    ('writeBytes', 'gauge', 'Bytes written by the live processes of the tree'),
+    ('numProcesses', 'gauge', 'Number of processes in the tree'),
+]
+FIELD_NAMES = [field[0] for field in FIELDS]
+
+# Upper bounds in seconds of the latency histogram buckets, same as the Prometheus client default.
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class Histogram:
+    def __init__(self):
+        # The last count is for values above the largest bucket.
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Returns the (le, count) pairs of the Prometheus histogram.
+        """
+        total = 0
+        result = []
+        for bound, count in zip([f'{bucket:g}' for bucket in BUCKETS] + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self) -> dict:
+        return dict(buckets=list(BUCKETS), counts=self.counts, sum=self.sum, count=self.count)
+
+
+def prometheus_name(field: str) -> str:
+    """
+    cpuPercent -> jenky_process_cpu_percent
+    """
+    snake = ''.join('_' + c.lower() if c.isupper() else c for c in field)
+    return 'jenky_process_' + snake
+
+
+class Ring:
+    """
+    Fixed-size time series with one array per field. Nothing is allocated after construction.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = [array('d', bytes(8 * capacity)) for _ in FIELDS]
+        # Number of samples ever appended.
+        self.count = 0
+
+    def append(self, t: float, sample: List[float]):
+        i = self.count % self.capacity
+        self.times[i] = t
+        for values, value in zip(self.values, sample):
+            values[i] = value
+        self.count += 1
+
+    def last(self) -> Optional[List[float]]:
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return [values[i] for values in self.values]
+
+    def series(self, since: Optional[float] = None) -> dict:
+        """
+        Returns the samples after since, oldest first, as one list per field.
+        """
+        first = max(0, self.count - self.capacity)
+        indices = [n % self.capacity for n in range(first, self.count)]
+        if since is not None:
+            indices = [i for i in indices if self.times[i] > since]
+        series = dict(times=[self.times[i] for i in indices])
+        for name, values in zip(FIELD_NAMES, self.values):
+            series[name] = [values[i] for i in indices]
+        return series
+
+
+class Sampler:
+    """
+    Samples the resource usage of all tracked processes and their child trees every interval seconds on a background
+    thread. Each pass reads the process table once, and reads each process with psutil's oneshot().
+    """
+
+    def __init__(self, interval: float = 5., capacity: int = 720):
+        self.interval = interval
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        # Process name -> (proc, root process)
+        self._tracked: Dict[str, Tuple[Process, psutil.Process]] = {}
+        self.rings: Dict[str, Ring] = {}
+        # Process name -> (time, total cpu seconds of the tree) of the previous pass
+        self._cpu: Dict[str, Tuple[float, float]] = {}
+        # Our own cost
+        self.passes = 0
+        self.cpu_seconds = 0.
+        self.last_duration = 0.
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def track(self, proc: Process, p: Optional[psutil.Process]):
+        """
+        Starts sampling the process p, or stops sampling if p is None. May be called from any thread.
+        """
+        with self._lock:
+            if p is None:
+                self._tracked.pop(proc.name, None)
+                self._cpu.pop(proc.name, None)
+            elif proc.name not in self._tracked or self._tracked[proc.name][1].pid != p.pid:
+                self._tracked[proc.name] = (proc, p)
+                self._cpu.pop(proc.name, None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='jenky-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                logger.exception('Sampling processes')
+
+    def sample(self):
+        """
+        One pass over all tracked processes.
+        """
+        t0 = time.perf_counter()
+        cpu0 = time.thread_time()
+        with self._lock:
+            tracked = list(self._tracked.items())
+
+        # One scan of the process table for all trees.
+        children: Dict[int, List[psutil.Process]] = {}
+        for p in psutil.process_iter(['ppid']):
+            children.setdefault(p.info['ppid'], []).append(p)
+
+        now = time.time()
+        for name, (proc, root) in tracked:
+            tree = [root]
+            for p in tree:
+                tree.extend(children.get(p.pid, []))
+            sample = self._sample_tree(tree)
+            if sample is None:
+                # The root is gone, the next sync will tell us.
+                continue
+
+            cpu_seconds = sample[0]
+            previous = self._cpu.get(name)
+            self._cpu[name] = (now, cpu_seconds)
+            if previous and now > previous[0]:
+                # Exited children take their cpu times with them, so this can go negative.
+                sample[0] = max(0., 100. * (cpu_seconds - previous[1]) / (now - previous[0]))
+            else:
+                sample[0] = 0.
+
+            with self._lock:
+                ring = self.rings.get(name)
+                if ring is None:
+                    ring = self.rings[name] = Ring(self.capacity)
+                ring.append(now, sample)
+
+        self.passes += 1
+        self.cpu_seconds += time.thread_time() - cpu0
+        self.last_duration = time.perf_counter() - t0
+
+    @staticmethod
+    def _sample_tree(tree: List[psutil.Process]) -> Optional[List[float]]:
+        """
+        Returns the summed values of all processes of the tree, with total cpu seconds in place of cpuPercent.
+        """
+        sample = [0.] * len(FIELDS)
+        for n, p in enumerate(tree):
+            try:
+                with p.oneshot():
+                    cpu_times = p.cpu_times()
+                    sample[0] += cpu_times.user + cpu_times.system
+                    sample[1] += p.memory_info().rss
+                    sample[2] += p.num_handles() if os.name == 'nt' else p.num_fds()
+                    sample[3] += p.num_threads()
+                    if hasattr(p, 'io_counters'):
+                        io = p.io_counters()
+                        sample[4] += io.read_bytes
+                        sample[5] += io.write_bytes
+                    sample[6] += 1
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                if n == 0:
+                    return None
+            except psutil.AccessDenied:
+                # For example a child which changed its user.
+                pass
+        return sample
+
+    def stats(self) -> dict:
+        return dict(
+            interval=self.interval, passes=self.passes, processes=len(self._tracked), cpuSeconds=self.cpu_seconds,
+            lastDuration=self.last_duration)
+
+    def series(self, since: Optional[float] = None) -> Dict[str, dict]:
+        with self._lock:
+            return {name: ring.series(since) for name, ring in self.rings.items() if name in self._tracked}
+
+    def prometheus(self) -> str:
+        """
+        The latest sample of each process and our own cost in the Prometheus text exposition format.
+        """
+        with self._lock:
+            latest = [(proc, self.rings[name].last()) for name, (proc, _) in self._tracked.items()
+                      if name in self.rings]
+
+        lines = []
+        for index, (field, kind, description) in enumerate(FIELDS):
+            metric = prometheus_name(field)
+            if kind == 'counter':
+                metric += '_total'
+            lines.append(f'# HELP {metric} {description}.')
+            lines.append(f'# TYPE {metric} {kind}')
+            for proc, sample in latest:
+                labels = f'repo="{label_value(proc.repo.repoName)}",process="{label_value(proc.name)}"'
+                lines.append(f'{metric}{{{labels}}} {sample[index]:.15g}')
+
+        lines.extend([
+            '# HELP jenky_sampler_passes_total Number of sampling passes.',
+            '# TYPE jenky_sampler_passes_total counter',
+            f'jenky_sampler_passes_total {self.passes}',
+            '# HELP jenky_sampler_cpu_seconds_total CPU time spent sampling.',
+            '# TYPE jenky_sampler_cpu_seconds_total counter',
+            f'jenky_sampler_cpu_seconds_total {self.cpu_seconds:.15g}',
+            '# HELP jenky_sampler_last_duration_seconds Wall time of the last sampling pass.',
+            '# TYPE jenky_sampler_last_duration_seconds gauge',
+            f'jenky_sampler_last_duration_seconds {self.last_duration:.15g}',
+        ])
+        return '\n'.join(lines) + '\n'
+
+
+def label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,344 @@
+import bisect
+import gzip
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple, IO
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__package__)
+
+# Maximal size of a chunk returned by the read_forward() and read_backward() functions.
+CHUNK_SIZE = 50 * 1024
+
+compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='jenky-compress')
+
+
+def utf8_boundary(data: bytes) -> int:
+    """
+    Returns the length of the longest prefix of data which does not end in an incomplete UTF-8 sequence.
+    """
+    for i in range(1, min(4, len(data)) + 1):
+        byte = data[-i]
+        if byte & 0b11000000 != 0b10000000:
+            # This is a lead (or ascii) byte, check if its sequence is complete.
+            if byte >= 0b11110000:
+                length = 4
+            elif byte >= 0b11100000:
+                length = 3
+            elif byte >= 0b11000000:
+                length = 2
+            else:
+                length = 1
+            return len(data) if length <= i else len(data) - i
+    return len(data)
+
+
+def cut_tail(data: bytes) -> bytes:
+    """
+    Cuts data after the last complete line. If there is no complete line, cuts after the last complete UTF-8 sequence.
+    """
+    newline = data.rfind(b'\n')
+    if newline >= 0:
+        return data[:newline + 1]
+    return data[:utf8_boundary(data)]
+
+
+def head_skip(data: bytes) -> int:
+    """
+    Returns the number of bytes to skip so that data starts with a complete line. If data is only one line, returns the
+    number of bytes to skip so that it starts with a complete UTF-8 sequence.
+    """
+    newline = data.find(b'\n')
+    if 0 <= newline < len(data) - 1:
+        return newline + 1
+    skip = 0
+    while skip < len(data) and data[skip] & 0b11000000 == 0b10000000:
+        skip += 1
+    return skip
+
+
+def read_forward(path: Path, offset: int, size: int = CHUNK_SIZE) -> Tuple[int, int, bytes]:
+    """
+    Reads at most size bytes starting at offset, up to the last complete line. If there is no complete line, we stop
+    at the last complete UTF-8 sequence. Returns the start offset, the end offset for the next call, and the data.
+    If the file was truncated below offset, we start over at 0.
+    """
+    with open(path.as_posix(), 'rb') as f:
+        if offset > os.fstat(f.fileno()).st_size:
+            offset = 0
+        f.seek(offset)
+        data = cut_tail(f.read(size))
+    return offset, offset + len(data), data
+
+
+def read_backward(path: Path, end: Optional[int] = None, size: int = CHUNK_SIZE) -> Tuple[int, int, bytes]:
+    """
+    Reads at most size bytes ending at end (default is end of file), starting at the first complete line.
+    Use the returned start offset as the end of the next call to page backwards.
+    """
+    with open(path.as_posix(), 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        end = file_size if end is None else min(end, file_size)
+        start = max(0, end - size)
+        f.seek(start)
+        data = f.read(end - start)
+
+    if start > 0:
+        # We are in the middle of a line and could hit a composed unicode character.
+        skip = head_skip(data)
+        data = data[skip:]
+        start += skip
+    return start, end, data
+
+
+class Segment(BaseModel):
+    run: int
+    # Offset of the segment within its run
+    start: int
+    size: int
+    # File name relative to the segments directory, ends with .gz if compressed
+    file: str
+
+
+class SegmentIndex(BaseModel):
+    run: int = 0
+    # Offset of the live file within the current run
+    live_start: int = 0
+    segments: List[Segment] = []
+
+
+class OutputCapture:
+    """
+    The captured stdout/stderr of one process: The live file {name}.out and the segments in the {name}.segments
+    directory. If the live file grows beyond max_bytes, it is rotated into a numbered segment, which is compressed in
+    the background. Segments are kept for the last keep_runs runs of the process.
+    Offsets are logical offsets within a run, so that clients can page through all segments of a run.
+    """
+
+    def __init__(self, directory: Path, name: str, max_bytes: int = 10 * 1024 * 1024, keep_runs: int = 3):
+        self.live_file = directory / f'{name}.out'
+        self.segments_dir = directory / f'{name}.segments'
+        self.index_file = self.segments_dir / 'index.json'
+        self.max_bytes = max_bytes
+        self.keep_runs = keep_runs
+        self._lock = threading.RLock()
+        if self.index_file.exists():
+            self.index = SegmentIndex.parse_file(self.index_file)
+        else:
+            self.index = SegmentIndex()
+
+    def _save_index(self):
+        self.segments_dir.mkdir(exist_ok=True)
+        tmp_file = self.index_file.with_suffix('.tmp')
+        tmp_file.write_text(self.index.json(), encoding='utf8')
+        os.replace(tmp_file, self.index_file)
+
+    def start_run(self) -> IO:
+        """
+        Archives the output of the previous run and returns the file the new run shall write to.
+        """
+        with self._lock:
+            if self.live_file.exists():
+                self._close_segment(move=True)
+            self.index.run += 1
+            self.index.live_start = 0
+            self._expire()
+            self._save_index()
+        # Append mode, so that rotation can truncate the file while the process is writing.
+        return open(self.live_file.as_posix(), 'ab')
+
+    def rotate_if_needed(self) -> bool:
+        """
+        Returns True if the live file was rotated. Cheap if nothing is to be done.
+        """
+        try:
+            size = os.stat(self.live_file).st_size
+        except FileNotFoundError:
+            return False
+        if size < self.max_bytes:
+            return False
+
+        with self._lock:
+            self._close_segment(move=False)
+            self._save_index()
+        return True
+
+    def _close_segment(self, move: bool):
+        """
+        Moves (the process is gone) or copies and truncates (the process is running) the live file into a new segment.
+        """
+        index = self.index
+        seq = sum(1 for segment in index.segments if segment.run == index.run)
+        file = f'{index.run:06d}-{seq:04d}.out'
+        path = self.segments_dir / file
+        self.segments_dir.mkdir(exist_ok=True)
+
+        if move:
+            os.replace(self.live_file, path)
+        else:
+            # Same as logrotate copytruncate. Output written between the last read and the truncation is lost.
+            with open(self.live_file, 'rb') as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+                os.truncate(self.live_file, 0)
+
+        size = os.stat(path).st_size
+        if size == 0:
+            path.unlink()
+            return
+
+        index.segments.append(Segment(run=index.run, start=index.live_start, size=size, file=file))
+        index.live_start += size
+        compressor.submit(self._compress, file)
+
+    def _compress(self, file: str):
+        path = self.segments_dir / file
+        gz_path = self.segments_dir / (file + '.gz')
+        tmp_path = self.segments_dir / (file + '.gz.tmp')
+        try:
+            with open(path, 'rb') as f_in, gzip.open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        except FileNotFoundError:
+            # Expired in the meantime
+            return
+        except Exception:
+            logger.exception(f'Compressing {path}')
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            segments = [segment for segment in self.index.segments if segment.file == file]
+            if segments:
+                os.replace(tmp_path, gz_path)
+                segments[0].file = gz_path.name
+                self._save_index()
+            else:
+                tmp_path.unlink()
+        path.unlink(missing_ok=True)
+
+    def adopt(self, staged: 'OutputCapture'):
+        """
+        Makes the current run of staged, the capture of a process started elsewhere, the current run of this capture.
+        The previous run is archived, and the files of staged are moved here.
+        """
+        with self._lock, staged._lock:
+            if self.live_file.exists():
+                self._close_segment(move=True)
+            self.index.run += 1
+            self.index.live_start = staged.index.live_start
+            self.segments_dir.mkdir(exist_ok=True)
+            for seq, segment in enumerate(s for s in staged.index.segments if s.run == staged.index.run):
+                file = f'{self.index.run:06d}-{seq:04d}.out' + ('.gz' if segment.file.endswith('.gz') else '')
+                try:
+                    os.replace(staged.segments_dir / segment.file, self.segments_dir / file)
+                except FileNotFoundError:
+                    # Compressed just now.
+                    os.replace(staged.segments_dir / (segment.file + '.gz'), self.segments_dir / (file + '.gz'))
+                    file += '.gz'
+                self.index.segments.append(Segment(run=self.index.run, start=segment.start, size=segment.size,
+                                                   file=file))
+            if staged.live_file.exists():
+                # The process keeps writing to the same file.
+                os.replace(staged.live_file, self.live_file)
+            self._expire()
+            self._save_index()
+            staged.index.segments = []
+        staged.remove()
+
+    def remove(self):
+        """
+        Deletes all files of the capture.
+        """
+        with self._lock:
+            self.live_file.unlink(missing_ok=True)
+            shutil.rmtree(self.segments_dir, ignore_errors=True)
+
+    def _expire(self):
+        first_run = self.index.run - self.keep_runs + 1
+        expired = [segment for segment in self.index.segments if segment.run < first_run]
+        self.index.segments = [segment for segment in self.index.segments if segment.run >= first_run]
+        for segment in expired:
+            (self.segments_dir / segment.file).unlink(missing_ok=True)
+
+    def runs(self) -> List[int]:
+        with self._lock:
+            runs = {segment.run for segment in self.index.segments}
+            runs.add(self.index.run)
+        return sorted(runs)
+
+    def _pieces(self, run: Optional[int]) -> Tuple[List[Tuple[int, int, Optional[str]]], int]:
+        """
+        Returns the (start, size, file) pieces of the run, where file None is the live file, and the size of the run.
+        """
+        with self._lock:
+            run = self.index.run if run is None else run
+            pieces = [(segment.start, segment.size, segment.file)
+                      for segment in self.index.segments if segment.run == run]
+            if run == self.index.run:
+                try:
+                    live_size = os.stat(self.live_file).st_size
+                except FileNotFoundError:
+                    live_size = 0
+                pieces.append((self.index.live_start, live_size, None))
+        size = pieces[-1][0] + pieces[-1][1] if pieces else 0
+        return pieces, size
+
+    def _read_piece(self, file: Optional[str], offset: int, length: int) -> bytes:
+        if file is None:
+            path = self.live_file
+        else:
+            path = self.segments_dir / file
+        opener = gzip.open if path.suffix == '.gz' else open
+        with opener(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def _read_range(self, run: Optional[int], start: int, end: int) -> bytes:
+        for attempt in range(2):
+            pieces, _ = self._pieces(run)
+            # Jump straight to the first segment containing start.
+            i = max(0, bisect.bisect_right([piece[0] for piece in pieces], start) - 1)
+            chunks = []
+            try:
+                for piece_start, piece_size, file in pieces[i:]:
+                    if piece_start >= end:
+                        break
+                    offset = max(start, piece_start) - piece_start
+                    length = min(end, piece_start + piece_size) - piece_start - offset
+                    if length > 0:
+                        chunks.append(self._read_piece(file, offset, length))
+                return b''.join(chunks)
+            except FileNotFoundError:
+                # A segment was compressed or expired while we were reading, try again.
+                if attempt:
+                    raise
+        return b''
+
+    def read_forward(self, offset: int, size: int = CHUNK_SIZE, run: Optional[int] = None) -> Tuple[int, int, bytes]:
+        """
+        Same as the read_forward() function, but for all segments of the run (default is the current run).
+        """
+        _, run_size = self._pieces(run)
+        if offset > run_size:
+            offset = 0
+        data = cut_tail(self._read_range(run, offset, min(offset + size, run_size)))
+        return offset, offset + len(data), data
+
+    def read_backward(self, end: Optional[int] = None, size: int = CHUNK_SIZE,
+                      run: Optional[int] = None) -> Tuple[int, int, bytes]:
+        """
+        Same as the read_backward() function, but for all segments of the run (default is the current run).
+        """
+        _, run_size = self._pieces(run)
+        end = run_size if end is None else min(end, run_size)
+        start = max(0, end - size)
+        data = self._read_range(run, start, end)
+        if start > 0:
+            skip = head_skip(data)
+            data = data[skip:]
+            start += skip
+        return start, end, data
@@ -0,0 +1,102 @@
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from jenky.util import Config, Process, Repo
+
+# Fields of a process which are its state, not its configuration.
+STATE_FIELDS = {'create_time', 'crash_looping', 'next_restart', 'time_to_ready', 'healthy'}
+# Configuration fields which only take effect by restarting the process.
+RESTART_FIELDS = {'cmd', 'env'}
+
+
+class ConfigWatcher:
+    """
+    Polls the modification times of the config files. Cheap enough to run every few seconds.
+    A change stays pending until the files are watched again, so a half-written or invalid file is read again.
+    """
+
+    def __init__(self, files: List[Path]):
+        self.files: List[Path] = []
+        self.watch(files)
+
+    def watch(self, files: List[Path], signature: Optional[Tuple[Optional[int], ...]] = None):
+        """
+        Call this only after the files were read successfully. The signature, taken before reading, applies if the
+        files did not change, so that a modification while reading is not missed.
+        """
+        self.signature = signature if signature is not None and files == self.files else self.current(files)
+        self.files = files
+
+    def current(self, files: Optional[List[Path]] = None) -> Tuple[Optional[int], ...]:
+        signature = []
+        for file in self.files if files is None else files:
+            try:
+                signature.append(os.stat(file).st_mtime_ns)
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def changed(self) -> bool:
+        return self.current() != self.signature
+
+
+class ConfigDiff:
+    """
+    What changed between two versions of the config. Repos and processes are matched by name.
+    """
+
+    def __init__(self):
+        self.added_repos: List[Repo] = []
+        self.removed_repos: List[str] = []
+        # Repos with changed directory or remoteUrl
+        self.changed_repos: List[Repo] = []
+        # (repo name, process) pairs of the new config
+        self.added: List[Tuple[str, Process]] = []
+        self.removed: List[Tuple[str, str]] = []
+        # (repo name, process of the new config, whether it must be restarted)
+        self.changed: List[Tuple[str, Process, bool]] = []
+
+    def __bool__(self) -> bool:
+        return any((self.added_repos, self.removed_repos, self.changed_repos, self.added, self.removed, self.changed))
+
+    def __str__(self) -> str:
+        return (f'{len(self.added_repos)} repos added, {len(self.removed_repos)} removed, '
+                f'{len(self.changed_repos)} changed, {len(self.added)} processes added, {len(self.removed)} removed, '
+                f'{len(self.changed)} changed of which {sum(1 for c in self.changed if c[2])} restart')
+
+
+def process_config(proc: Process) -> dict:
+    return proc.dict(exclude=STATE_FIELDS)
+
+
+def diff_configs(old: Config, new: Config) -> ConfigDiff:
+    diff = ConfigDiff()
+    old_repos = {repo.repoName: repo for repo in old.repos}
+    new_repos = {repo.repoName: repo for repo in new.repos}
+
+    diff.added_repos = [repo for name, repo in new_repos.items() if name not in old_repos]
+    diff.removed_repos = [name for name in old_repos if name not in new_repos]
+
+    for name, new_repo in new_repos.items():
+        old_repo = old_repos.get(name)
+        if old_repo is None:
+            continue
+        moved = new_repo.directory != old_repo.directory
+        if moved or new_repo.remote_url != old_repo.remote_url:
+            diff.changed_repos.append(new_repo)
+
+        old_procs = {proc.name: proc for proc in old_repo.processes}
+        new_procs = {proc.name: proc for proc in new_repo.processes}
+        diff.added.extend((name, proc) for proc_name, proc in new_procs.items() if proc_name not in old_procs)
+        diff.removed.extend((name, proc_name) for proc_name in old_procs if proc_name not in new_procs)
+        for proc_name, new_proc in new_procs.items():
+            old_proc = old_procs.get(proc_name)
+            if old_proc is None:
+                continue
+            old_fields = process_config(old_proc)
+            new_fields = process_config(new_proc)
+            if old_fields != new_fields or moved:
+                restart = moved or any(old_fields[field] != new_fields[field] for field in RESTART_FIELDS)
+                diff.changed.append((name, new_proc, restart))
+    return diff
@@ -0,0 +1,170 @@
+"""
+Runs the periodic jobs of jenky on the event loop.
+
+All times are taken from the monotonic clock, so jumps of the wall clock do not matter. The runs of a job never
+overlap, the next run is scheduled when the previous one finished. Blocking jobs run in a bounded thread pool, so that
+they do not stall the HTTP traffic. After an error, a job is retried with exponential backoff and jitter.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from jenky.metrics import Histogram, label_value
+
+logger = logging.getLogger(__package__)
+
+# Threads for blocking jobs.
+MAX_WORKERS = 4
+# Upper bound in seconds of the delay after consecutive errors.
+MAX_BACKOFF = 60.
+
+
+class Job:
+    """
+    The action returns the seconds until its next run, None for the interval of the job, or a negative number to stop.
+    """
+
+    def __init__(self, name: str, action: Callable[[], Any], interval: float, blocking: bool):
+        self.name = name
+        self.action = action
+        self.interval = interval
+        self.blocking = blocking
+        self.runs = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.last_error: Optional[str] = None
+        self.running = False
+        # Monotonic time the next run is due.
+        self.due: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.last_lateness: Optional[float] = None
+        self.duration = Histogram()
+        # Seconds between the due time and the actual start of a run.
+        self.lateness = Histogram()
+        self.task: Optional[asyncio.Task] = None
+
+    def backoff(self) -> float:
+        delay = min(MAX_BACKOFF, max(self.interval, 1.) * 2 ** (self.consecutive_errors - 1))
+        # Equal jitter, so that jobs failing together do not retry together.
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def as_dict(self) -> dict:
+        due_in = None if self.due is None else self.due - time.monotonic()
+        return dict(interval=self.interval, blocking=self.blocking, running=self.running, dueIn=due_in,
+                    runs=self.runs, errors=self.errors, consecutiveErrors=self.consecutive_errors,
+                    lastError=self.last_error, lastDuration=self.last_duration, lastLateness=self.last_lateness,
+                    duration=self.duration.as_dict(), lateness=self.lateness.as_dict())
+
+
+class Scheduler:
+    def __init__(self, max_workers: int = MAX_WORKERS):
+        self.jobs: Dict[str, Job] = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='jenky-scheduler')
+
+    def add(self, name: str, action: Callable[[], Any], interval: float, delay: Optional[float] = None,
+            blocking: bool = False) -> Job:
+        """
+        Runs the action first after delay seconds, which defaults to the interval. A coroutine function is awaited on
+        the event loop, a blocking action runs in the thread pool, and any other action runs on the event loop.
+        """
+        self.stop(name)
+        job = Job(name, action, interval, blocking)
+        self.jobs[name] = job
+        job.task = asyncio.create_task(self._run(job, interval if delay is None else delay))
+        return job
+
+    def stop(self, name: str):
+        job = self.jobs.pop(name, None)
+        if job and job.task:
+            job.task.cancel()
+
+    async def run_blocking(self, func: Callable[..., Any], *args) -> Any:
+        """
+        Runs func in the thread pool of the blocking jobs.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _run(self, job: Job, delay: float):
+        while True:
+            job.due = time.monotonic() + delay
+            await asyncio.sleep(delay)
+            job.running = True
+            t0 = time.monotonic()
+            try:
+                delay = await self._call(job)
+                job.consecutive_errors = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f'Job {job.name} failed')
+                job.errors += 1
+                job.consecutive_errors += 1
+                job.last_error = str(e) or type(e).__name__
+                delay = job.backoff()
+            finally:
+                job.running = False
+                job.runs += 1
+                job.last_duration = time.monotonic() - t0
+                job.duration.observe(job.last_duration)
+            if delay is None:
+                delay = job.interval
+            elif delay < 0.:
+                job.due = None
+                self.jobs.pop(job.name, None)
+                return
+
+    async def _call(self, job: Job) -> Optional[float]:
+        if job.blocking:
+            def target():
+                # The start in the pool thread, so that waiting for a free thread counts as late.
+                self._started(job, time.monotonic())
+                return job.action()
+
+            return await self.run_blocking(target)
+
+        self._started(job, time.monotonic())
+        if asyncio.iscoroutinefunction(job.action):
+            return await job.action()
+        return job.action()
+
+    @staticmethod
+    def _started(job: Job, t: float):
+        job.last_lateness = max(0., t - job.due)
+        job.lateness.observe(job.last_lateness)
+
+    async def close(self):
+        tasks = [job.task for job in self.jobs.values() if job.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.jobs.clear()
+        self.executor.shutdown(wait=False)
+
+    def as_dict(self) -> Dict[str, dict]:
+        return {name: job.as_dict() for name, job in self.jobs.items()}
+
+    def prometheus(self) -> str:
+        lines: List[str] = []
+        for metric, description, attribute in (
+                ('jenky_job_duration_seconds', 'Duration of the runs of the periodic jobs.', 'duration'),
+                ('jenky_job_lateness_seconds', 'Delay of the start of the runs after they were due.', 'lateness')):
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} histogram')
+            for job in self.jobs.values():
+                histogram: Histogram = getattr(job, attribute)
+                labels = f'job="{label_value(job.name)}"'
+                for bound, count in histogram.cumulative():
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{metric}_sum{{{labels}}} {histogram.sum:.15g}')
+                lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+        lines.extend([
+            '# HELP jenky_job_errors_total Number of failed runs of the periodic jobs.',
+            '# TYPE jenky_job_errors_total counter',
+        ])
+        lines.extend(f'jenky_job_errors_total{{job="{label_value(job.name)}"}} {job.errors}'
+                     for job in self.jobs.values())
+        return '\n'.join(lines) + '\n'
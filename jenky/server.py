@@ -1,51 +1,491 @@
 
 import asyncio
 import base64
+import functools
 import json
 import logging.handlers
+import socket
+import sqlite3
 
 import time
 from pathlib import Path
-from typing import List, Callable, Tuple
+from typing import Dict, List, Callable, Tuple, Optional
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
+import psutil
 from pydantic import BaseModel
-from starlette.responses import RedirectResponse, Response, JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import RedirectResponse, Response, JSONResponse, StreamingResponse
 
-from jenky import util
-from jenky.util import Config, get_tail
+from jenky import deploy, git_helper, output, reload, startup, util
+from jenky.events import Broadcaster, format_event
+from jenky.federation import Federation, PeerError, tag_repos
+from jenky.git_helper import GitAction, GitJob, GitQueue
+from jenky.health import HealthChecker
+from jenky.metrics import Sampler
+from jenky.scheduler import Scheduler
+from jenky.startup import wait_ready
+from jenky.supervisor import ExitWatcher, Terminator
+from jenky.util import Config, Process
 
 
 logger = logging.getLogger(__package__)
 app = FastAPI()
 
-
-async def schedule(action: Callable[[], float], start_at: float):
-    while True:
-        await asyncio.sleep(start_at - time.time())
+# Full scan of all processes if we are notified about exits, and if not.
+SAFETY_NET_INTERVAL = 60.
+POLL_INTERVAL = 5.
+# Comment lines sent on idle event streams, so that dead connections are detected.
+KEEP_ALIVE_INTERVAL = 15.
+# Seconds between checks for appended data when following a file.
+FOLLOW_INTERVAL = .25
+# Seconds between drains of the log queue, if it has no backlog.
+READ_LOGS_INTERVAL = 1.
+# Seconds between checks whether process outputs need to be rotated.
+ROTATE_INTERVAL = 5.
+# Seconds between checks whether the config files changed.
+RELOAD_INTERVAL = 2.
+# Seconds between resource samples of the processes, and the number of samples kept per process (one hour).
+SAMPLE_INTERVAL = 5.
+SAMPLE_CAPACITY = 720
+
+
+def sync_process(proc: Process, publish: bool = True) -> asyncio.Task:
+    """
+    Syncs the process in the background, see sync_process_async. Must be called on the event loop.
+    """
+    return asyncio.create_task(sync_process_async(proc, publish))
+
+
+async def sync_process_async(proc: Process, publish: bool = True) -> Optional[psutil.Process]:
+    """
+    Syncs the process in a worker thread, because starting it may take a while, and then finishes on the event loop.
+    """
+    p, create_time = await app.state.scheduler.run_blocking(util.sync_process_since, proc, proc.repo.directory)
+    after_sync(proc, p, create_time)
+    if publish:
+        publish_repos()
+    return p
+
+
+def after_sync(proc: Process, p: Optional[psutil.Process], create_time: Optional[float]):
+    """
+    create_time is the one from before the sync. Must be called on the event loop.
+    """
+    if p:
+        app.state.exit_watcher.watch(proc, p.pid)
+    app.state.sampler.track(proc, p)
+
+    if p and proc.create_time != create_time:
+        # Started, or found running for the first time. We do not time adopted processes, they may have been ready
+        # for hours.
+        starts = util.restart_backoff(proc).starts
+        timed = bool(starts) and starts[-1] >= proc.create_time - 1.
+        task = asyncio.create_task(wait_ready(proc, proc.create_time, timed))
+        task.add_done_callback(lambda _: publish_repos())
+        app.state.ready_tasks[proc.name] = task
+
+    # Come back when the restart backoff is over.
+    timer = app.state.restart_timers.pop(proc.name, None)
+    if timer:
+        timer.cancel()
+    if proc.keep_running and not p and proc.next_restart is not None:
+        app.state.restart_timers[proc.name] = asyncio.get_running_loop().call_later(
+            max(0., proc.next_restart - time.time()), sync_process, proc)
+
+
+def restart_process(proc: Process, reason: str):
+    """
+    Terminates the process, and the sync after the termination starts it again.
+    """
+    p = util.find_process(proc.name)
+    if not p:
+        asyncio.create_task(sync_process_async(proc))
+        return
+    logger.warning(f'Restarting {reason} process {proc.name}')
+    termination = app.state.terminator.terminate(proc, p)
+
+    async def sync_after_termination():
+        await termination.done.wait()
+        await sync_process_async(proc)
+
+    asyncio.create_task(sync_after_termination())
+    publish_repos()
+
+
+def restart_unhealthy(proc: Process):
+    restart_process(proc, 'unhealthy')
+
+
+def add_process(repo: util.Repo, proc: Process):
+    proc.set_repo(repo)
+    if proc not in repo.processes:
+        repo.processes.append(proc)
+    app.state.health_checker.start([proc])
+    sync_process(proc, publish=False)
+
+
+def remove_process(repo: util.Repo, proc: Process):
+    proc.keep_running = False
+    # This terminates the process.
+    task = sync_process(proc, publish=False)
+    repo.processes.remove(proc)
+    app.state.health_checker.stop(proc)
+    task.add_done_callback(lambda _: app.state.sampler.track(proc, None))
+
+
+def apply_config(new_config: Config):
+    """
+    Applies the changes between the last loaded and the new config to the live config. Processes which did not change
+    keep running, and changed processes are only restarted if their cmd or env changed.
+    If this fails half way, the last loaded config stays, and applying the new config again does the rest.
+    """
+    config = app.state.config
+    diff = reload.diff_configs(app.state.loaded_config, new_config)
+    # Keep an untouched copy, the processes of the new config become live objects.
+    loaded_config = new_config.copy(deep=True)
+    config.app_name = new_config.app_name
+    config.node_name = new_config.node_name
+    config.peers = new_config.peers
+    app.state.federation.peers = {peer.name: peer for peer in new_config.peers}
+    if diff:
+        logger.warning(f'Applying config change: {diff}')
+        apply_diff(config, diff)
+        publish_repos()
+    app.state.loaded_config = loaded_config
+
+
+def apply_diff(config: Config, diff: reload.ConfigDiff):
+    """
+    Each step is skipped if it was done already.
+    """
+    repos = {repo.repoName: repo for repo in config.repos}
+    for name in diff.removed_repos:
+        repo = repos.pop(name, None)
+        if repo is None:
+            continue
+        for proc in list(repo.processes):
+            remove_process(repo, proc)
+        config.repos.remove(repo)
+    for repo in diff.added_repos:
+        if repo.repoName in repos:
+            continue
+        repo.refresh()
+        config.repos.append(repo)
+        repos[repo.repoName] = repo
+        for proc in repo.processes:
+            add_process(repo, proc)
+
+    for new_repo in diff.changed_repos:
+        repo = repos[new_repo.repoName]
+        repo.directory = new_repo.directory
+        repo.remote_url = new_repo.remote_url
+        deploy.forget_deploy(repo.repoName)
+        repo.refresh()
+    for repo_name, proc_name in diff.removed:
+        repo = repos[repo_name]
+        for proc in [proc for proc in repo.processes if proc.name == proc_name]:
+            remove_process(repo, proc)
+    for repo_name, proc in diff.added:
+        repo = repos[repo_name]
+        if proc.name not in {live.name for live in repo.processes}:
+            add_process(repo, proc)
+
+    for repo_name, new_proc, restart in diff.changed:
+        _, proc = util.get_by_id(config.repos, repo_name, new_proc.name)
+        # Not again if the change was applied already.
+        restart = restart and (proc.cmd, proc.env) != (new_proc.cmd, new_proc.env)
+        for field in reload.process_config(new_proc):
+            setattr(proc, field, getattr(new_proc, field))
+        app.state.health_checker.stop(proc)
+        app.state.health_checker.start([proc])
+        if restart and proc.keep_running:
+            util.restart_backoff(proc).reset(proc)
+            restart_process(proc, 'changed')
+        else:
+            # For example keepRunning changed.
+            sync_process(proc, publish=False)
+
+
+def read_config_if_changed() -> Optional[tuple]:
+    watcher = app.state.config_watcher
+    if not watcher.changed():
+        return None
+    signature = watcher.current()
+    return util.read_app_config(util.app_config_path, deploy.deployed_directories()) + (signature,)
+
+
+async def reload_config():
+    """
+    Applies the config files if they changed.
+    """
+    changed = await app.state.scheduler.run_blocking(read_config_if_changed)
+    if changed:
+        app_config, files, signature = changed
+        repos = [util.Repo.parse_obj(repo) for repo in app_config['repos']]
+        apply_config(util.make_config(app_config, app.state.config.version, repos))
+        # Only now, so that a config which is invalid or was not applied is read again.
+        app.state.config_watcher.watch(files, signature)
+
+
+async def start_processes():
+    """
+    Starts the processes in waves ordered by their dependencies. The processes of a wave are started concurrently, and
+    the next wave is started when all processes of the wave are ready.
+    """
+    t0 = time.time()
+    loop = asyncio.get_running_loop()
+    procs = [proc for repo in app.state.config.repos for proc in repo.processes]
+    try:
+        ordered = startup.waves(procs)
+    except ValueError as e:
+        logger.error(f'{e}, starting all processes at once')
+        ordered = [procs]
+
+    for wave in ordered:
+        # Note: FastApi does not support asyncio subprocesses, so we start them from threads.
+        results = await asyncio.gather(*(loop.run_in_executor(None, util.sync_process_since, proc, proc.repo.directory)
+                                         for proc in wave))
+        for proc, (p, create_time) in zip(wave, results):
+            after_sync(proc, p, create_time)
+        publish_repos()
+        tasks = [app.state.ready_tasks[proc.name] for proc in wave if proc.name in app.state.ready_tasks]
+        await asyncio.gather(*tasks)
+
+    logger.info(f'Started {len(procs)} processes in {len(ordered)} waves within {time.time() - t0:.3f}s')
+
+
+def publish_repos():
+    """
+    Pushes the repos to all event stream subscribers, but only if a process or git ref changed.
+    """
+    repos_state = [(repo.git_tag, [(proc.name, proc.keep_running, proc.create_time, proc.crash_looping,
+                                    proc.next_restart, proc.healthy) for proc in repo.processes])
+                   for repo in app.state.config.repos]
+    if repos_state != app.state.repos_state:
+        app.state.repos_state = repos_state
+        app.state.broadcaster.publish('repos', app.state.config.json(by_alias=True))
+
+
+async def deploy_repo(repo: util.Repo, git_ref: str, on_line: Callable[[str], None]) -> int:
+    """
+    Deploys git_ref blue/green, see jenky.deploy. Returns non-zero if the deploy failed and was rolled back.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        directory = await loop.run_in_executor(None, deploy.add_worktree, repo, git_ref, on_line)
+    except deploy.DeployError as e:
+        on_line(f'Deploy failed: {e}')
+        return 1
+
+    try:
+        processes = await loop.run_in_executor(None, deploy.worktree_processes, repo, directory)
+    except deploy.DeployError as e:
+        on_line(f'Deploy failed: {e}')
+        await loop.run_in_executor(None, deploy.remove_worktree, repo, directory, on_line)
+        return 1
+
+    generation = deploy.Generation(repo, directory, processes)
+    try:
+        await generation.start(on_line)
+    except deploy.DeployError as e:
+        on_line(f'Deploy failed, rolling back: {e}')
+        await generation.stop()
+        await loop.run_in_executor(None, deploy.remove_worktree, repo, directory, on_line)
+        return 1
+
+    # Switch over: Adopt the new generation, then stop the old one.
+    old_directory = repo.directory
+    repo.directory = directory
+    repo.refresh()
+    deploy.save_deploy(repo)
+    procs = {proc.name: proc for proc in repo.processes}
+    if processes is not None:
+        procs = adopt_definitions(repo, processes)
+    terminations = []
+    for definition, copy, p in generation.started:
+        proc = procs[definition.name]
+        util.adopt_output(copy, proc)
+        old = util.find_process(proc.name)
+        util.get_state_journal().started(proc.name, p.pid, p.create_time())
+        util.restart_backoff(proc).reset(proc)
+        if old and old.pid != p.pid:
+            terminations.append(app.state.terminator.terminate(proc, old))
+        await sync_process_async(proc, publish=False)
+        proc.time_to_ready = copy.time_to_ready
+    publish_repos()
+    if processes is not None:
+        watch_config()
+    on_line(f'Switched {repo.repoName} to {directory}, stopping {len(terminations)} processes')
+
+    await asyncio.gather(*(termination.done.wait() for termination in terminations))
+    util.close_zygotes(old_directory.absolute().as_posix())
+    await loop.run_in_executor(None, deploy.remove_worktree, repo, old_directory, on_line)
+    return 0
+
+
+def adopt_definitions(repo: util.Repo, definitions: List[Process]) -> Dict[str, Process]:
+    """
+    Makes the process definitions of a deployed working tree live. Returns the live processes by name.
+    """
+    procs = {proc.name: proc for proc in repo.processes}
+    for definition in definitions:
+        proc = procs.get(definition.name)
+        if proc is None:
+            definition.set_repo(repo)
+            repo.processes.append(definition)
+            app.state.health_checker.start([definition])
+            procs[definition.name] = definition
+            continue
+        for field in reload.process_config(definition):
+            setattr(proc, field, getattr(definition, field))
+        app.state.health_checker.stop(proc)
+        app.state.health_checker.start([proc])
+    for name in [name for name in procs if name not in {definition.name for definition in definitions}]:
+        remove_process(repo, procs.pop(name))
+
+    # The loaded config is what the config files say, so that a reload does not see a change.
+    loaded_repo = util.repo_by_id(app.state.loaded_config.repos, repo.repoName)
+    loaded_repo.processes = [definition.copy(deep=True) for definition in definitions]
+    return procs
+
+
+def watch_config():
+    """
+    Watches the config files, with the jenky_config.json of deployed repos in their working trees.
+    """
+    if util.app_config_path:
+        app.state.config_watcher.watch(util.read_app_config(util.app_config_path, deploy.deployed_directories())[1])
+
+
+def git_job_done(job: GitJob):
+    if job.state == 'done' and git_helper.is_git_repo(job.repo):
+        job.repo.refresh()
+        publish_repos()
+
+
+def publish_log(entry: util.LogEntry):
+    broadcaster = app.state.broadcaster
+    if not broadcaster.subscriptions:
+        # Nobody listens, so do not format the entry.
+        return
+    item = util.list_handler.item(entry)
+    broadcaster.publish('log', json.dumps(item), event_id=item[0])
+
+
+class LogProtocol(asyncio.DatagramProtocol):
+    """
+    Receives the records sent by jenky.logging.UnixSocketHandler, one JSON record per datagram.
+    """
+
+    def datagram_received(self, data: bytes, addr):
         try:
-            # assert False, 'FooBar'
-            start_at = action()
-        except Exception as e:
-            logger.exception(str(action))
-            start_at += 1
-        if start_at < 0.:
-            break
+            record = json.loads(data)
+        except ValueError:
+            logger.warning(f'Invalid log datagram of size {len(data)}')
+            return
+        util.log_handler([record])
+
+
+async def serve_log_socket(path: Path):
+    path.unlink(missing_ok=True)
+    try:
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            LogProtocol, local_addr=path.as_posix(), family=socket.AF_UNIX)
+    except OSError as e:
+        # For example the path is too long.
+        logger.warning(f'Cannot listen on {path}: {e}')
+        return None
+    util.log_socket = path
+    return transport
 
 
 @app.on_event("startup")
 async def startup_event():
-    def sync_processes_action() -> float:
-        util.sync_processes(app.state.config.repos)
-        return time.time() + 5
-
-    def read_logs_action() -> float:
-        util.read_logs()
-        return time.time() + 1
-
-    asyncio.create_task(schedule(sync_processes_action, time.time() + 5))
-    asyncio.create_task(schedule(read_logs_action, time.time() + 1))
+    loop = asyncio.get_running_loop()
+    # Only now, uvicorn closed all log handlers when it configured logging.
+    util.open_log_store()
+    if util.app_config_path and deploy.deployed_directories():
+        # The processes of a repo deployed to another working tree are configured there.
+        app_config, _ = util.read_app_config(util.app_config_path, deploy.deployed_directories())
+        app.state.config = util.make_config(app_config, app.state.config.version,
+                                            util.collect_repos(app_config['repos']))
+    # First, everything may run blocking work in its thread pool.
+    scheduler = app.state.scheduler = Scheduler()
+    exit_watcher = ExitWatcher(loop, on_exit=sync_process)
+    app.state.exit_watcher = exit_watcher
+    app.state.terminator = Terminator(loop)
+    util.terminate_handler = app.state.terminator.terminate
+    app.state.broadcaster = Broadcaster(loop, max_length=util.list_handler.capacity)
+    app.state.repos_state = None
+    app.state.restart_timers = {}
+    app.state.ready_tasks = {}
+    app.state.sampler = Sampler(interval=SAMPLE_INTERVAL, capacity=SAMPLE_CAPACITY)
+    app.state.sampler.start()
+    app.state.health_checker = HealthChecker(on_unhealthy=restart_unhealthy)
+    app.state.health_checker.start([proc for repo in app.state.config.repos for proc in repo.processes])
+    app.state.federation = Federation(app.state.config.peers)
+    app.state.git_queue = GitQueue(on_done=git_job_done)
+    app.state.git_queue.actions['deploy'] = deploy_repo
+    app.state.loaded_config = app.state.config.copy(deep=True)
+    # After the copy, so that a deployed worktree does not count as a config change.
+    deploy.apply_deploys(app.state.config.repos)
+    app.state.config_watcher = None
+    if util.app_config_path:
+        app.state.config_watcher = reload.ConfigWatcher([])
+        watch_config()
+    util.list_handler.listeners.append(publish_log)
+    app.state.log_transport = None
+    if hasattr(socket, 'AF_UNIX'):
+        app.state.log_transport = await serve_log_socket((util.cache_dir / 'log.sock').absolute())
+
+    async def sync_processes_job():
+        procs = [proc for repo in app.state.config.repos for proc in repo.processes]
+        results = await scheduler.run_blocking(
+            lambda: [util.sync_process_since(proc, proc.repo.directory) for proc in procs])
+        for proc, (p, create_time) in zip(procs, results):
+            after_sync(proc, p, create_time)
+        publish_repos()
+
+    def read_logs_job() -> Optional[float]:
+        if util.read_logs() == util.log_reader.batch_size:
+            # There is a backlog, continue right after other tasks had their turn.
+            return 0.
+
+    def rotate_outputs_job():
+        for repo in app.state.config.repos:
+            for proc in repo.processes:
+                util.output_capture(proc).rotate_if_needed()
+
+    async def start_processes_task():
+        await start_processes()
+        scheduler.add('syncProcesses', sync_processes_job,
+                      SAFETY_NET_INTERVAL if exit_watcher.supported else POLL_INTERVAL)
+
+    asyncio.create_task(start_processes_task())
+    scheduler.add('readLogs', read_logs_job, READ_LOGS_INTERVAL, blocking=True)
+    scheduler.add('rotateOutputs', rotate_outputs_job, ROTATE_INTERVAL, blocking=True)
+    if util.app_config_path:
+        scheduler.add('reloadConfig', reload_config, RELOAD_INTERVAL)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await app.state.health_checker.close()
+    await app.state.federation.close()
+    util.list_handler.listeners.remove(publish_log)
+    if app.state.log_transport:
+        app.state.log_transport.close()
+        util.log_socket.unlink(missing_ok=True)
+        util.log_socket = None
+    app.state.exit_watcher.close()
+    app.state.sampler.stop()
+    for timer in app.state.restart_timers.values():
+        timer.cancel()
+    await app.state.scheduler.close()
+    util.close_zygotes()
+    util.close_log_store()
 
 
 html_root = Path(__file__).parent / 'html'
@@ -74,44 +514,352 @@ def get_repos() -> Config:
     # util.sync_processes(config.repos)
     for repo in app.state.config.repos:
         repo.refresh()
+    publish_repos()
     return app.state.config
 
 
+@app.post("/repos")
+async def fetch_repos(action: GitAction) -> dict:
+    """
+    Fetches all git repos concurrently, the only action is fetch. Returns the jobs, see /jobs/{id}.
+    """
+    if action.action != 'fetch':
+        raise HTTPException(status_code=400, detail=f'Invalid action {action.action}')
+    jobs = app.state.git_queue.fetch_all(app.state.config.repos)
+    return dict(action=action.action, jobs=[job.as_dict() for job in jobs])
+
+
+@app.get("/repos/{repo_id}")
+async def get_repo(repo_id: str, fetch: bool = True) -> dict:
+    """
+    The repo with its git refs. With fetch, also fetches from the remote in the background, unless the last fetch is
+    younger than git_helper.FETCH_TTL seconds. The fetched refs are there once the returned job is done.
+    """
+    try:
+        repo = util.repo_by_id(app.state.config.repos, repo_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f'No such repo {repo_id}')
+    if not git_helper.is_git_repo(repo):
+        return dict(repo=repo, fetch=None, message='Not a git repository')
+    repo.refresh()
+    job = app.state.git_queue.fetch(repo) if fetch else None
+    return dict(repo=repo, fetch=job.as_dict() if job else None)
+
+
+@app.post("/repos/{repo_id}")
+async def change_repo(repo_id: str, action: GitAction) -> dict:
+    """
+    Returns immediately with the job of the fetch or checkout, which can be followed at /jobs/{id}.
+    """
+    try:
+        repo = util.repo_by_id(app.state.config.repos, repo_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f'No such repo {repo_id}')
+    if not git_helper.is_git_repo(repo):
+        raise HTTPException(status_code=400, detail=f'{repo_id} is not a git repository')
+    try:
+        job = app.state.git_queue.submit(repo, action.action, action.gitRef)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return dict(repo_id=repo_id, action=action.action, job=job.as_dict())
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: int, wait: float = 0.) -> dict:
+    """
+    With wait > 0, blocks for up to wait seconds until the job is finished.
+    """
+    try:
+        job = app.state.git_queue.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f'No such job {job_id}')
+    if wait > 0:
+        try:
+            await asyncio.wait_for(job.done.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+    return job.as_dict()
+
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: int) -> StreamingResponse:
+    """
+    Streams the output of the job as plain text until it is finished. The last line is the final state.
+    """
+    try:
+        job = app.state.git_queue.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f'No such job {job_id}')
+
+    async def lines():
+        async for line in job.follow():
+            yield line + '\n'
+        yield f'{job.state}{": " + job.error if job.error else ""}\n'
+
+    return StreamingResponse(lines(), media_type='text/plain')
+
+
 class Action(BaseModel):
     action: str
 
 
 @app.post("/repos/{repo_id}/processes/{process_id}")
-def change_process_state(repo_id: str, process_id: str, action: Action):
+async def change_process_state(repo_id: str, process_id: str, action: Action):
+    """
+    Returns immediately. A kill returns the termination, which can be polled at /terminations/{id}.
+    Both actions reset the restart backoff, so a manual restart also starts a crash-looping process again.
+    """
     assert action.action in {'kill', 'restart'}
     _, proc = util.get_by_id(app.state.config.repos, repo_id, process_id)
     proc.keep_running = (action.action == 'restart')
-    # util.sync_process(proc, repo.directory)
-    time.sleep(1)
-
-    return dict(repo_id=repo_id, process_id=process_id, action=action.action)
+    util.restart_backoff(proc).reset(proc)
+    t0 = time.time()
+    await sync_process_async(proc)
+    # A process which exits right away on SIGTERM is terminated already.
+    termination = app.state.terminator.active(proc) or app.state.terminator.latest(proc, since=t0)
+
+    return dict(repo_id=repo_id, process_id=process_id, action=action.action,
+                termination=termination.as_dict() if termination else None)
+
+
+@app.get("/nodes/repos")
+async def get_node_repos() -> dict:
+    """
+    The merged repos of this node and all peers, each repo and process tagged with its node.
+    Nodes which did not answer in time are listed with their error.
+    """
+    config = app.state.config
+    nodes = [dict(name=config.node_name, url=None, error=None)]
+    # Refreshes the repos in the thread pool, the same as the sync /repos does.
+    local_repos = await run_in_threadpool(lambda: json.loads(get_repos().json(by_alias=True)))
+    repos = tag_repos(local_repos, config.node_name)
+    for name, result in (await app.state.federation.fan_out('/repos')).items():
+        error = str(result) if isinstance(result, PeerError) else None
+        nodes.append(dict(name=name, url=app.state.federation.peers[name].url, error=error))
+        if error is None:
+            repos.extend(tag_repos(result, name))
+    return dict(nodes=nodes, repos=repos)
+
+
+@app.get("/nodes/logs")
+async def get_node_logs(last_event_id: Optional[str] = None) -> dict:
+    """
+    The logs of this node and all peers. last_event_id is a comma separated list of node:id, see lastEventId of the
+    response.
+    """
+    last_event_ids = {}
+    for item in (last_event_id or '').split(','):
+        name, _, event_id = item.rpartition(':')
+        if name:
+            last_event_ids[name] = event_id
+    config = app.state.config
+    logs = {config.node_name: get_logs(last_event_ids.get(config.node_name))['logsSince']}
+    errors = {}
+    params = {name: dict(last_event_id=last_event_ids[name]) if name in last_event_ids else None
+              for name in app.state.federation.peers}
+    results = await asyncio.gather(*(app.state.federation.get(name, '/logs', params[name]) for name in params),
+                                   return_exceptions=True)
+    for name, result in zip(params, results):
+        if isinstance(result, Exception):
+            errors[name] = str(result)
+        else:
+            logs[name] = result['logsSince']
+
+    # Keep the cursor of nodes without new logs or which did not answer.
+    last_ids = dict(last_event_ids)
+    last_ids.update({name: items[0][0] for name, items in logs.items() if items})
+    return dict(logs=logs, errors=errors, lastEventId=','.join(f'{name}:{i}' for name, i in last_ids.items()))
+
+
+@app.post("/nodes/{node}/repos/{repo_id}/processes/{process_id}")
+async def change_node_process_state(node: str, repo_id: str, process_id: str, action: Action):
+    """
+    Same as /repos/{repo_id}/processes/{process_id}, but on the given node.
+    """
+    if node == app.state.config.node_name:
+        return await change_process_state(repo_id, process_id, action)
+    if node not in app.state.federation.peers:
+        raise HTTPException(status_code=404, detail=f'No such node {node}')
+    try:
+        return await app.state.federation.post(node, f'/repos/{repo_id}/processes/{process_id}', action.dict())
+    except PeerError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+
+@app.get("/terminations/{termination_id}")
+async def get_termination(termination_id: int, wait: float = 0.) -> dict:
+    """
+    With wait > 0, blocks for up to wait seconds until the termination is finished.
+    """
+    try:
+        termination = app.state.terminator.get(termination_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f'No such termination {termination_id}')
+    if wait > 0:
+        try:
+            await asyncio.wait_for(termination.done.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+    return termination.as_dict()
 
 
 @app.get("/repos/{repo_id}/processes/{process_id}/{log_type}")
-def get_process_log(repo_id: str, process_id: str, log_type: str) -> Response:
-    # repo = util.repo_by_id(config.repos, repo_id)
-    path = util.cache_dir / f'{process_id}.{log_type}'
-    if path.exists():
-        lines = get_tail(path)
-        return Response(content=''.join(lines), media_type="text/plain")
+def get_process_log(repo_id: str, process_id: str, log_type: str, offset: Optional[int] = None,
+                    before: Optional[int] = None, follow: bool = False, run: Optional[int] = None) -> Response:
+    """
+    Without parameters, returns the tail of the file.
+    With offset, returns the complete lines from that byte offset on; with follow, streams data as it is appended.
+    With before, returns the chunk ending at that byte offset, which is used to page backwards.
+    The X-Start-Offset and X-End-Offset headers are the cursors for the next requests.
+    For the out log type, offsets span all segments of a run, and previous runs listed in X-Runs can be selected.
+    """
+    if log_type == 'out':
+        try:
+            _, proc = util.get_by_id(app.state.config.repos, repo_id, process_id)
+        except ValueError:
+            return Response(content='Not Found', media_type="text/plain", status_code=404)
+        source = util.output_capture(proc)
+        runs = source.runs()
+        if run is not None and run not in runs:
+            return Response(content='Not Found', media_type="text/plain", status_code=404)
+        headers = {'X-Runs': ','.join(str(r) for r in runs)}
+        read_forward = functools.partial(source.read_forward, run=run)
+        read_backward = functools.partial(source.read_backward, run=run)
+    else:
+        path = util.cache_dir / f'{process_id}.{log_type}'
+        if not path.exists():
+            return Response(content='Not Found', media_type="text/plain", status_code=404)
+        headers = {}
+        read_forward = functools.partial(output.read_forward, path)
+        read_backward = functools.partial(output.read_backward, path)
+
+    if follow:
+        return StreamingResponse(follow_file(read_forward, offset or 0), media_type="text/plain", headers=headers)
+
+    if offset is not None:
+        start, end, data = read_forward(offset)
     else:
-        return Response(content='Not Found', media_type="text/plain", status_code=404)
+        start, end, data = read_backward(before)
+    headers.update({'X-Start-Offset': str(start), 'X-End-Offset': str(end)})
+    return Response(content=str(data, encoding='utf8', errors='replace'), media_type="text/plain", headers=headers)
+
+
+async def follow_file(read_forward: Callable[[int], Tuple[int, int, bytes]], offset: int):
+    while True:
+        _, offset, data = read_forward(offset)
+        if data:
+            yield data
+        else:
+            await asyncio.sleep(FOLLOW_INTERVAL)
 
 
 @app.get("/logs")
 def get_logs(last_event_id: str = None) -> dict:
-    logs_since: List[Tuple[str, str]] = []
-    for item in util.list_handler.buffer:
-        if item[0] == last_event_id:
-            break
-        logs_since.append(item)
-
-    return dict(logsSince=logs_since, maxLength=util.list_handler.buffer.maxlen, repos=app.state.config.repos)
+    logs_since = util.list_handler.items_since(last_event_id)
+    return dict(logsSince=logs_since, maxLength=util.list_handler.capacity, repos=app.state.config.repos)
+
+
+@app.get("/logs/query")
+def query_logs(process: Optional[str] = None, level: Optional[str] = None, since: Optional[float] = None,
+               until: Optional[float] = None, q: Optional[str] = None, cursor: Optional[str] = None,
+               limit: int = 100) -> dict:
+    """
+    Queries the log store, newest first. level is the minimal level name or number, since and until are epoch seconds,
+    and q is a full text query on the message. Pass nextCursor as cursor to get the next page.
+    """
+    if level is not None and not level.isdigit():
+        if not isinstance(logging.__dict__.get(level.upper()), int):
+            raise HTTPException(status_code=422, detail=f'Invalid level {level}')
+        level = logging.__dict__[level.upper()]
+    try:
+        logs, next_cursor = util.log_store.query(
+            process=process, level=None if level is None else int(level), since=since, until=until, text=q,
+            cursor=cursor, limit=min(limit, 1000))
+    except (ValueError, sqlite3.OperationalError) as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return dict(logs=logs, nextCursor=next_cursor)
+
+
+@app.get("/logs/queue")
+def get_log_queue() -> dict:
+    """
+    Backlog depth and drain rate (items per second) of the queue the child processes log into.
+    """
+    return util.log_reader.stats()
+
+
+@app.get("/metrics")
+def get_metrics() -> Response:
+    """
+    Resource usage of the processes, the sampler itself, the liveness probe latencies and the periodic jobs in the
+    Prometheus text format.
+    """
+    procs = [proc for repo in app.state.config.repos for proc in repo.processes]
+    text = (app.state.sampler.prometheus() + app.state.health_checker.prometheus(procs) +
+            app.state.scheduler.prometheus())
+    return Response(text, media_type='text/plain; version=0.0.4')
+
+
+@app.get("/scheduler")
+def get_scheduler() -> dict:
+    """
+    Run count, errors and the histograms of duration and lateness (seconds after due) of each periodic job.
+    """
+    return app.state.scheduler.as_dict()
+
+
+@app.get("/probes")
+def get_probes() -> dict:
+    """
+    Consecutive failures, last error and latency histogram of the liveness probes per process name.
+    """
+    return {name: state.as_dict() for name, state in app.state.health_checker.states.items()}
+
+
+@app.get("/metrics/series")
+def get_metrics_series(since: Optional[float] = None) -> dict:
+    """
+    Time series of the resource usage per process name, oldest first, only samples after since (epoch seconds).
+    """
+    sampler = app.state.sampler
+    return dict(processes=sampler.series(since), sampler=sampler.stats())
+
+
+@app.get("/logs/stream")
+async def stream_logs(last_event_id: Optional[str] = Header(None)) -> StreamingResponse:
+    """
+    Server-sent events: A repos event with the current repos and whenever a process changes state, and a log event
+    for each log entry since the Last-Event-ID header.
+    """
+    broadcaster = app.state.broadcaster
+    # Subscribe before reading the backlog, so that we do not miss anything.
+    subscription = broadcaster.subscribe()
+    backlog = util.list_handler.items_since(last_event_id)
+
+    async def events():
+        try:
+            yield format_event('repos', app.state.config.json(by_alias=True))
+            # Ids are sequence numbers, so anything up to the newest backlog entry was already sent.
+            last_seq = int(backlog[0][0]) if backlog else 0
+            for item in reversed(backlog):
+                yield format_event('log', json.dumps(item), event_id=item[0])
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.get(), KEEP_ALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if message is None:
+                    # We were too slow, the client will reconnect.
+                    break
+                event_id, event = message
+                if event_id is None or int(event_id) > last_seq:
+                    yield event
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 
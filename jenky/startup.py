@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+from jenky import util
+from jenky.util import Process
+
+logger = logging.getLogger(__package__)
+
+# Seconds between readiness probes.
+PROBE_INTERVAL = .1
+
+
+def waves(procs: List[Process]) -> List[List[Process]]:
+    """
+    Orders the processes by their dependsOn, so that the processes of a wave only depend on processes of earlier
+    waves. Raises ValueError on unknown dependencies and cycles.
+    """
+    by_name: Dict[str, Process] = {proc.name: proc for proc in procs}
+    for proc in procs:
+        unknown = [name for name in proc.depends_on if name not in by_name]
+        if unknown:
+            raise ValueError(f'Process {proc.name} depends on unknown {", ".join(unknown)}')
+
+    result: List[List[Process]] = []
+    done = set()
+    pending = list(procs)
+    while pending:
+        wave = [proc for proc in pending if all(name in done for name in proc.depends_on)]
+        if not wave:
+            raise ValueError(f'Cyclic dependencies between {", ".join(proc.name for proc in pending)}')
+        result.append(wave)
+        done.update(proc.name for proc in wave)
+        pending = [proc for proc in pending if proc.name not in done]
+    return result
+
+
+class ReadinessProbe:
+    """
+    Checks the readiness condition of one start of a process.
+    """
+
+    def __init__(self, proc: Process, started_at: float):
+        self.proc = proc
+        self.started_at = started_at
+        self.offset = 0
+        readiness = proc.readiness
+        self.pattern = re.compile(readiness.log_pattern.encode(), re.MULTILINE) if readiness.log_pattern else None
+
+    async def __call__(self) -> bool:
+        readiness = self.proc.readiness
+        if readiness.port is not None:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(readiness.host, readiness.port), 1.)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            return True
+        if self.pattern:
+            return self._log_matches()
+        if readiness.file:
+            try:
+                return (self.proc.repo.directory / readiness.file).stat().st_mtime >= self.started_at
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _log_matches(self) -> bool:
+        capture = util.output_capture(self.proc)
+        while True:
+            _, end, data = capture.read_forward(self.offset)
+            if not data:
+                return False
+            if self.pattern.search(data):
+                return True
+            if not data.endswith(b'\n'):
+                # Wait for the rest of the line.
+                return False
+            self.offset = end
+
+
+async def wait_ready(proc: Process, started_at: float, timed: bool = True,
+                     is_running: Optional[Callable[[], bool]] = None) -> bool:
+    """
+    Waits until the process started at started_at is ready. If timed, sets its time_to_ready.
+    The process is watched by its create_time, or by is_running if it is not synced.
+    """
+    proc.time_to_ready = None
+    if proc.readiness is None:
+        if timed:
+            proc.time_to_ready = 0.
+        return True
+
+    probe = ReadinessProbe(proc, started_at)
+    deadline = started_at + proc.readiness.timeout
+    while True:
+        if proc.create_time != started_at or (is_running and not is_running()):
+            # It exited or was restarted in the meantime.
+            return False
+        if await probe():
+            if timed:
+                proc.time_to_ready = time.time() - started_at
+                logger.info(f'Process {proc.name} is ready after {proc.time_to_ready:.3f}s')
+            return True
+        if time.time() >= deadline:
+            logger.warning(f'Process {proc.name} is not ready after {proc.readiness.timeout}s')
+            return False
+        await asyncio.sleep(PROBE_INTERVAL)
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Tuple, Optional
+
+import psutil
+
+from jenky.util import Process
+
+logger = logging.getLogger(__package__)
+
+
+class ExitWatcher:
+    """
+    Gets notified by the event loop as soon as a watched process exits.
+    On Linux we use one pidfd per process. This also works for processes adopted from a previous jenky run, which are
+    not our children. On other platforms nothing is watched, and we rely on the periodic sync.
+    """
+
+    supported: bool = hasattr(os, 'pidfd_open')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_exit: Callable[[Process], None]):
+        self.loop = loop
+        self.on_exit = on_exit
+        self._lock = threading.Lock()
+        self._watched: Dict[int, Tuple[int, Process]] = {}  # pid -> (pidfd, proc)
+
+    def watch(self, proc: Process, pid: int) -> bool:
+        """
+        Returns False if we cannot watch the process. May be called from any thread.
+        """
+        if not self.supported:
+            return False
+
+        with self._lock:
+            if pid in self._watched:
+                return True
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                # Gone before we could watch it.
+                self.loop.call_soon_threadsafe(self._notify, proc)
+                return True
+            except OSError as e:
+                # For example ENOSYS on kernels older than 5.3.
+                logger.warning(f'Cannot watch process {proc.name}: {e}')
+                ExitWatcher.supported = False
+                return False
+            self._watched[pid] = (fd, proc)
+
+        self.loop.call_soon_threadsafe(self._add_reader, pid)
+        return True
+
+    def _add_reader(self, pid: int):
+        with self._lock:
+            if pid not in self._watched:
+                # We were closed in the meantime.
+                return
+            fd, _ = self._watched[pid]
+        self.loop.add_reader(fd, self._exited, pid)
+
+    def _exited(self, pid: int):
+        with self._lock:
+            fd, proc = self._watched.pop(pid)
+        self.loop.remove_reader(fd)
+        os.close(fd)
+
+        try:
+            # Reap the zombie if it is our child.
+            os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            pass
+
+        logger.info(f'Process {proc.name} with pid {pid} exited')
+        self._notify(proc)
+
+    def _notify(self, proc: Process):
+        try:
+            self.on_exit(proc)
+        except Exception:
+            logger.exception(f'Handling exit of {proc.name}')
+
+    def close(self):
+        with self._lock:
+            watched = list(self._watched.values())
+            self._watched.clear()
+        for fd, _ in watched:
+            self.loop.remove_reader(fd)
+            os.close(fd)
+
+
+class Termination:
+    """
+    Stops one process: SIGTERM, then wait for the grace period, then SIGKILL.
+    The state goes from terminating to killing (if needed) to terminated, or failed.
+    """
+
+    def __init__(self, termination_id: int, proc: Process, p: psutil.Process):
+        self.id = termination_id
+        self.proc = proc
+        self.p = p
+        self.state = 'terminating'
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.done = asyncio.Event()
+
+    @property
+    def is_active(self) -> bool:
+        return self.finished_at is None
+
+    async def run(self):
+        try:
+            self.p.terminate()
+            if not await self._wait(self.proc.grace_period):
+                logger.warning(f'Killing process {self.proc.name} after {self.proc.grace_period}s')
+                self.state = 'killing'
+                self.p.kill()
+                if not await self._wait(5.):
+                    raise TimeoutError(f'Process {self.p.pid} did not die')
+            self.state = 'terminated'
+        except psutil.NoSuchProcess:
+            self.state = 'terminated'
+        except Exception as e:
+            logger.exception(f'Terminating {self.proc.name}')
+            self.state = 'failed'
+            self.error = str(e)
+        finally:
+            self.finished_at = time.time()
+            self.done.set()
+
+    async def _wait(self, timeout: float) -> bool:
+        """
+        Returns True if the process is gone within timeout seconds. Also reaps it, if it is our child.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.p.wait(timeout=0)
+                return True
+            except psutil.TimeoutExpired:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+
+    def as_dict(self) -> dict:
+        return dict(
+            id=self.id, processName=self.proc.name, pid=self.p.pid, state=self.state, error=self.error,
+            gracePeriod=self.proc.grace_period, startedAt=self.started_at, finishedAt=self.finished_at)
+
+
+class Terminator:
+    """
+    Runs all terminations concurrently on the event loop. Use terminate() as util.terminate_handler.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, max_length: int = 100):
+        self.loop = loop
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self.terminations: Dict[int, Termination] = collections.OrderedDict()
+        self.max_length = max_length
+
+    def terminate(self, proc: Process, p: psutil.Process) -> Termination:
+        """
+        Starts terminating the process and returns immediately. May be called from any thread.
+        """
+        with self._lock:
+            termination = self.active(proc)
+            if termination:
+                return termination
+
+            termination = Termination(next(self._ids), proc, p)
+            self.terminations[termination.id] = termination
+            # Forget the oldest finished terminations, active ones are still polled.
+            finished = [t.id for t in self.terminations.values() if not t.is_active]
+            for termination_id in finished[:max(0, len(self.terminations) - self.max_length)]:
+                del self.terminations[termination_id]
+
+        asyncio.run_coroutine_threadsafe(termination.run(), self.loop)
+        return termination
+
+    def active(self, proc: Process) -> Optional[Termination]:
+        with self._lock:
+            for termination in self.terminations.values():
+                if termination.proc is proc and termination.is_active:
+                    return termination
+        return None
+
+    def latest(self, proc: Process, since: float = 0.) -> Optional[Termination]:
+        """
+        The last termination of the process started at or after since, also if it finished already.
+        """
+        with self._lock:
+            for termination in reversed(self.terminations.values()):
+                if termination.proc is proc and termination.started_at >= since:
+                    return termination
+        return None
+
+    def get(self, termination_id: int) -> Termination:
+        return self.terminations[termination_id]
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import os
+import subprocess
+import threading
+import zipfile
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from jenky import dependencies, util
+
+
+def make_wheel(wheel_dir: Path, name: str, version: str, requires=(), scripts=()) -> Path:
+    dist_info = f'{name}-{version}.dist-info'
+    files: Dict[str, str] = {
+        f'{dist_info}/entry_points.txt': '[console_scripts]\n' + ''.join(f'{script} = {name}:main\n'
+                                                                         for script in scripts),
+        f'{name}/__init__.py': f'VERSION = {version!r}\n\ndef main():\n    print(VERSION)\n',
+        f'{dist_info}/METADATA': '\n'.join(['Metadata-Version: 2.1', f'Name: {name}', f'Version: {version}'] +
+                                          [f'Requires-Dist: {r}' for r in requires]) + '\n',
+        f'{dist_info}/WHEEL': 'Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n',
+    }
+    record = []
+    for path, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content.encode()).digest()).rstrip(b'=').decode()
+        record.append(f'{path},sha256={digest},{len(content.encode())}')
+    record.append(f'{dist_info}/RECORD,,')
+    files[f'{dist_info}/RECORD'] = '\n'.join(record) + '\n'
+
+    path = wheel_dir / f'{name}-{version}-py3-none-any.whl'
+    with zipfile.ZipFile(path, 'w') as f:
+        for name_in_zip, content in files.items():
+            f.writestr(name_in_zip, content)
+    return path
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Posix only')
+def test_sync(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    wheel_dir = tmp_path / 'wheels'
+    wheel_dir.mkdir()
+    monkeypatch.setattr(util, 'cache_dir', cache_dir, raising=False)
+    monkeypatch.setattr(util, 'wheel_dirs', [wheel_dir])
+    monkeypatch.setattr(util, 'offline', True)
+
+    make_wheel(wheel_dir, 'alpha', '1.0', requires=['beta'])
+    make_wheel(wheel_dir, 'beta', '1.0')
+    make_wheel(wheel_dir, 'beta', '2.0')
+    make_wheel(wheel_dir, 'gamma', '1.0')
+
+    repo_dir = tmp_path / 'repo'
+    repo_dir.mkdir()
+    (repo_dir / 'requirements.txt').write_text('# Our deps\nalpha==1.0\nbeta==1.0\n')
+    lines = []
+    assert dependencies.sync(repo_dir, lines.append)
+
+    def run(code: str) -> str:
+        return subprocess.run([(repo_dir / 'venv' / 'bin' / 'python').as_posix(), '-c', code],
+                              capture_output=True, check=True).stdout.decode().strip()
+
+    assert run('import alpha, beta; print(alpha.VERSION, beta.VERSION)') == '1.0 1.0'
+    first = os.readlink(repo_dir / 'venv')
+    assert Path(first).parent == dependencies.venvs_root()
+
+    # Same requirements, nothing to do.
+    lines.clear()
+    (repo_dir / 'requirements.txt').write_text('beta==1.0\n\nalpha==1.0  # Comment\n')
+    assert not dependencies.sync(repo_dir, lines.append)
+    assert lines == []
+
+    # A new venv next to the old one, from the cached wheels of alpha.
+    (repo_dir / 'requirements.txt').write_text('alpha==1.0\nbeta==2.0\ngamma\n')
+    os.remove(wheel_dir / 'alpha-1.0-py3-none-any.whl')
+    assert dependencies.sync(repo_dir, lines.append)
+    assert os.readlink(repo_dir / 'venv') != first
+    assert run('import alpha, beta, gamma; print(alpha.VERSION, beta.VERSION)') == '1.0 2.0'
+    assert Path(first, dependencies.MANIFEST).is_file()
+
+    # Back to the first one, which is still there.
+    lines.clear()
+    (repo_dir / 'requirements.txt').write_text('alpha==1.0\nbeta==1.0\n')
+    assert dependencies.sync(repo_dir, lines.append)
+    assert os.readlink(repo_dir / 'venv') == first
+    assert lines == ['2 wheels are cached', f'Switched venv to {first}']
+
+    # Unpinned requirements are resolved again, and pick up a new version.
+    (repo_dir / 'requirements.txt').write_text('alpha==1.0\nbeta==1.0\ngamma\n')
+    assert dependencies.sync(repo_dir, lines.append)
+    assert run('import gamma; print(gamma.VERSION)') == '1.0'
+    make_wheel(wheel_dir, 'gamma', '2.0')
+    assert dependencies.sync(repo_dir, lines.append)
+    assert run('import gamma; print(gamma.VERSION)') == '2.0'
+    assert not dependencies.sync(repo_dir, lines.append)
+
+    # Unresolvable offline
+    current = os.readlink(repo_dir / 'venv')
+    (repo_dir / 'requirements.txt').write_text('delta\n')
+    with pytest.raises(dependencies.DependencyError):
+        dependencies.sync(repo_dir, lines.append)
+    assert os.readlink(repo_dir / 'venv') == current
+
+
+def test_requirements_hash(tmp_path: Path):
+    assert dependencies.requirements_hash(tmp_path, '/usr/bin/python3') is None
+    (tmp_path / 'requirements.txt').write_text('a\nb\n')
+    h = dependencies.requirements_hash(tmp_path, '/usr/bin/python3')
+    (tmp_path / 'requirements.txt').write_text('# Comment\nb\n\na  # Comment\n')
+    assert dependencies.requirements_hash(tmp_path, '/usr/bin/python3') == h
+    (tmp_path / 'requirements.txt').write_text('a\nb==1.0\n')
+    assert dependencies.requirements_hash(tmp_path, '/usr/bin/python3') != h
+
+    # Included files count, also if they change.
+    (tmp_path / 'requirements.txt').write_text('a\n-r base.txt\n')
+    (tmp_path / 'base.txt').write_text('b\n')
+    assert dependencies.requirements_hash(tmp_path, '/usr/bin/python3') == h
+    (tmp_path / 'base.txt').write_text('b==2.0\n')
+    assert dependencies.requirements_hash(tmp_path, '/usr/bin/python3') != h
+    (tmp_path / 'requirements.txt').write_text('a\n-c base.txt\nb\n')
+    assert dependencies.requirement_lines(tmp_path / 'requirements.txt') == ['a', '-c b==2.0', 'b']
+
+
+def test_is_pinned():
+    assert dependencies.is_pinned(['a==1.0', 'b @ https://example.com/b-1.0-py3-none-any.whl', '-c c>=1',
+                                   '--index-url https://example.com'])
+    assert not dependencies.is_pinned(['a==1.0', 'b>=1.0'])
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Posix only')
+def test_concurrent_sync(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    wheel_dir = tmp_path / 'wheels'
+    wheel_dir.mkdir()
+    monkeypatch.setattr(util, 'cache_dir', cache_dir, raising=False)
+    monkeypatch.setattr(util, 'wheel_dirs', [wheel_dir])
+    monkeypatch.setattr(util, 'offline', True)
+    make_wheel(wheel_dir, 'alpha', '1.0', scripts=['alpha-version'])
+
+    repo_dirs = [tmp_path / f'repo{i}' for i in range(3)]
+    errors = []
+
+    def sync(repo_dir: Path):
+        try:
+            dependencies.sync(repo_dir, lambda line: None)
+        except Exception as e:
+            errors.append(e)
+
+    for repo_dir in repo_dirs:
+        repo_dir.mkdir()
+        (repo_dir / 'requirements.txt').write_text('alpha==1.0\n')
+    threads = [threading.Thread(target=sync, args=(repo_dir,)) for repo_dir in repo_dirs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    targets = {os.readlink(repo_dir / 'venv') for repo_dir in repo_dirs}
+    assert len(targets) == 1
+    target = Path(targets.pop())
+    assert Path(target, dependencies.MANIFEST).is_file()
+    # Nothing left over from the build in a temporary directory.
+    assert [path.name for path in dependencies.venvs_root().iterdir() if path.is_dir()] == [target.name]
+    script = subprocess.run([(repo_dirs[0] / 'venv' / 'bin' / 'alpha-version').as_posix()],
+                            capture_output=True, check=True)
+    assert script.stdout.decode().strip() == '1.0'
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import subprocess
+from pathlib import Path
+
+import persistqueue
+import pytest
+
+from jenky import deploy, util
+from jenky.deploy import DeployError, Generation
+from jenky.util import Repo
+
+pytestmark = pytest.mark.skipif(subprocess.run(['git', '--version'], capture_output=True).returncode != 0,
+                                reason='Needs git')
+
+
+def git(cwd: Path, *args: str) -> str:
+    completed = subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+                               cwd=cwd, capture_output=True, check=True)
+    return completed.stdout.decode().strip()
+
+
+@pytest.fixture
+def repo(tmp_path: Path, monkeypatch) -> Repo:
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    monkeypatch.setattr(util, 'cache_dir', cache_dir, raising=False)
+    monkeypatch.setattr(util, 'queue', persistqueue.SQLiteQueue((cache_dir / 'queue').absolute()))
+    monkeypatch.setattr(util, 'output_captures', {})
+    monkeypatch.setattr(util, 'offline', False)
+    monkeypatch.setattr(deploy, 'SETTLE_TIME', .2)
+
+    directory = tmp_path / 'repo'
+    directory.mkdir()
+    git(directory, 'init', '-b', 'main')
+    (directory / '.gitignore').write_text('venv\n')
+    (directory / 'requirements.txt').write_text('fastapi\n')
+    (directory / 'version.txt').write_text('1\n')
+    git(directory, 'add', '.')
+    git(directory, 'commit', '-m', 'first')
+    git(directory, 'tag', '0.0.1')
+    (directory / 'venv').mkdir()
+    (directory / 'version.txt').write_text('2\n')
+    git(directory, 'commit', '-am', 'second')
+    git(directory, 'tag', '0.0.2')
+
+    repo = Repo.parse_obj(dict(repoName='repo', directory=directory, processes=[
+        dict(name='db', cmd=['sh', '-c', 'cat version.txt; sleep 30'], env={}, keepRunning=True,
+             readiness=dict(logPattern='^[0-9]$')),
+        dict(name='api', cmd=['sleep', '30'], env={}, keepRunning=True, dependsOn=['db']),
+        dict(name='tool', cmd=['false'], env={}, keepRunning=False),
+    ]))
+    for proc in repo.processes:
+        proc.set_repo(repo)
+    return repo
+
+
+def test_worktree(repo: Repo):
+    lines = []
+    directory = deploy.add_worktree(repo, 'refs/tags/0.0.1', lines.append)
+    assert directory.parent == deploy.worktree_root(repo)
+    assert (directory / 'version.txt').read_text() == '1\n'
+    assert (directory / 'venv').resolve() == (repo.directory / 'venv').resolve()
+
+    # The refs of a linked worktree
+    refs = util.git_ref(directory / '.git')
+    assert refs['tags'] == '0.0.1'
+
+    with pytest.raises(DeployError):
+        deploy.add_worktree(repo, 'refs/tags/nope', lines.append)
+
+    deploy.remove_worktree(repo, directory, lines.append)
+    assert not directory.exists()
+    assert (repo.directory / 'venv').is_dir()
+    # Never the configured directory
+    deploy.remove_worktree(repo, repo.directory, lines.append)
+    assert repo.directory.is_dir()
+
+
+def test_requirements_changed(repo: Repo):
+    (repo.directory / 'requirements.txt').write_text('fastapi\npandas\n')
+    git(repo.directory, 'commit', '-am', 'third')
+    # No wheels for a new venv
+    util.offline = True
+    lines = []
+    with pytest.raises(DeployError, match='Cannot resolve requirements.txt'):
+        deploy.add_worktree(repo, 'refs/tags/0.0.2', lines.append)
+    assert list(deploy.worktree_root(repo).iterdir()) == []
+
+
+def test_generation(repo: Repo):
+    lines = []
+    directory = deploy.add_worktree(repo, 'refs/tags/0.0.1', lines.append)
+
+    async def run() -> Generation:
+        generation = Generation(repo, directory)
+        try:
+            await generation.start(lines.append)
+            db, copy, _ = generation.started[0]
+            # The output of the new generation is its own until it is adopted.
+            assert util.output_capture(copy).read_forward(0)[2] == b'1\n'
+            assert util.output_capture(db).read_forward(0)[2] == b''
+            util.adopt_output(copy, db)
+            assert util.output_capture(db).read_forward(0)[2] == b'1\n'
+        finally:
+            await generation.stop()
+        return generation
+
+    generation = asyncio.run(run())
+    assert [proc.name for proc, _, _ in generation.started] == ['db', 'api']
+    assert [copy.repo.directory for _, copy, _ in generation.started] == [directory, directory]
+    # The live repo is untouched.
+    assert repo.processes[0].repo.directory == repo.directory
+    assert util.output_capture(repo.processes[0]).read_forward(0)[2] == b'1\n'
+    # Only the live captures are left.
+    assert sorted(path.name for path in util.cache_dir.glob('*.out')) == ['db.out']
+    assert [line for line in lines if line.startswith('Started')] == [
+        f'Started {proc.name} with pid {p.pid}' for proc, _, p in generation.started]
+
+
+def test_generation_rollback(repo: Repo):
+    db = repo.processes[0]
+    live = util.start_process(db, repo.directory)
+    repo.processes[1].cmd = ['sh', '-c', 'sleep .1']
+    lines = []
+    directory = deploy.add_worktree(repo, 'refs/tags/0.0.1', lines.append)
+
+    async def run() -> Generation:
+        generation = Generation(repo, directory)
+        with pytest.raises(DeployError, match='api exited'):
+            await generation.start(lines.append)
+        await generation.stop()
+        return generation
+
+    try:
+        generation = asyncio.run(run())
+        assert not any(deploy.is_alive(p) for _, _, p in generation.started)
+        # The old generation still writes to its own output.
+        assert deploy.is_alive(live)
+        assert util.output_capture(db).read_forward(0)[2] == b'2\n'
+        assert util.output_capture(db).live_file.stat().st_nlink == 1
+        assert sorted(path.name for path in util.cache_dir.glob('*.out')) == ['db.out']
+    finally:
+        util.terminate_process(db, live)
+
+
+def test_worktree_processes(repo: Repo, tmp_path: Path, monkeypatch):
+    app_config_path = tmp_path / 'jenky_app_config.json'
+    app_config_path.write_text(json.dumps(dict(appName='test', repos=[dict(repoName='repo', directory='repo')])))
+    monkeypatch.setattr(util, 'app_config_path', app_config_path)
+
+    def write_repo_config(cmd):
+        (repo.directory / util.REPO_CONFIG_FILE).write_text(json.dumps(dict(processes=[
+            dict(name='db', cmd=cmd, env={}, keepRunning=True)])))
+
+    write_repo_config(['sleep', '30'])
+    git(repo.directory, 'add', util.REPO_CONFIG_FILE)
+    git(repo.directory, 'commit', '-m', 'third')
+    git(repo.directory, 'tag', '0.0.3')
+    # Not what we deploy
+    write_repo_config(['sleep', '1'])
+
+    lines = []
+    directory = deploy.add_worktree(repo, 'refs/tags/0.0.3', lines.append)
+    processes = deploy.worktree_processes(repo, directory)
+    assert [(proc.name, proc.cmd) for proc in processes] == [('db', ['sleep', '30'])]
+    generation = Generation(repo, directory, processes)
+    assert generation.repo.processes is processes
+    assert [proc.name for proc in repo.processes] == ['db', 'api', 'tool']
+
+    # After the deploy, the config of the repo is read from its working tree.
+    repo.directory = directory
+    deploy.save_deploy(repo)
+    _, files = util.read_app_config(app_config_path, deploy.deployed_directories())
+    assert files == [app_config_path, directory / util.REPO_CONFIG_FILE]
+
+    (directory / util.REPO_CONFIG_FILE).write_text('{')
+    with pytest.raises(DeployError):
+        deploy.worktree_processes(repo, directory)
+
+    # The app config lists the processes.
+    app_config_path.write_text(json.dumps(dict(appName='test', repos=[
+        dict(repoName='repo', directory='repo', processes=[])])))
+    assert deploy.worktree_processes(repo, directory) is None
@@ -0,0 +1,30 @@
+import asyncio
+
+from jenky.events import Broadcaster, format_event
+
+
+def test_format_event():
+    assert format_event('log', 'a\nb', event_id='7') == 'event: log\nid: 7\ndata: a\ndata: b\n\n'
+    assert format_event('repos', '{}') == 'event: repos\ndata: {}\n\n'
+
+
+def test_broadcaster():
+    async def run():
+        broadcaster = Broadcaster(asyncio.get_running_loop(), max_length=3)
+        fast = broadcaster.subscribe()
+        slow = broadcaster.subscribe()
+
+        received = []
+        for i in range(5):
+            broadcaster.publish('log', str(i), event_id=str(i))
+            await asyncio.sleep(0)
+            received.append(await fast.get())
+
+        assert [event_id for event_id, _ in received] == ['0', '1', '2', '3', '4']
+        # The slow subscriber overflowed and was closed.
+        assert slow.closed
+        assert broadcaster.subscriptions == [fast]
+        items = [await slow.get() for _ in range(4)]
+        assert items[-1] is None
+
+    asyncio.run(run())
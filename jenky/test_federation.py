@@ -0,0 +1,88 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+from fastapi import FastAPI
+
+from jenky.federation import Federation, PeerError, tag_repos
+from jenky.util import Peer
+
+stand_in = FastAPI()
+hits = []
+
+
+@stand_in.get("/{node}/repos")
+async def get_repos(node: str):
+    hits.append(node)
+    if node == 'slow':
+        await asyncio.sleep(1)
+    return dict(repos=[dict(repoName='r', processes=[dict(name='p')])])
+
+
+@stand_in.post("/{node}/repos/{repo_id}/processes/{process_id}")
+async def change_process_state(node: str, repo_id: str, process_id: str, action: dict):
+    hits.append((node, repo_id, process_id, action['action']))
+    return dict(action=action['action'])
+
+
+@pytest.fixture(scope='module')
+def base_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(stand_in, log_level='warning'))
+    thread = threading.Thread(target=server.run, kwargs=dict(sockets=[sock]), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f'http://127.0.0.1:{sock.getsockname()[1]}'
+    server.should_exit = True
+    thread.join()
+
+
+def make_federation(base_url: str, *names: str) -> Federation:
+    return Federation([Peer(name=name, url=f'{base_url}/{name}') for name in names], timeout=0.3, ttl=0.5)
+
+
+def test_fan_out(base_url):
+    async def run():
+        federation = make_federation(base_url, 'a', 'b', 'slow', 'down')
+        federation.peers['down'].url = 'http://127.0.0.1:1'
+        t0 = time.monotonic()
+        results = await federation.fan_out('/repos')
+        elapsed = time.monotonic() - t0
+        await federation.close()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(run())
+    assert tag_repos(results['a'], 'a')[0]['processes'][0]['node'] == 'a'
+    assert results['b']['repos'][0]['repoName'] == 'r'
+    assert isinstance(results['slow'], PeerError)
+    assert isinstance(results['down'], PeerError)
+    # Concurrently, and the slow peer only costs the timeout.
+    assert elapsed < 0.6
+
+
+def test_cache(base_url):
+    async def run():
+        federation = make_federation(base_url, 'cached')
+        hits.clear()
+        await asyncio.gather(*(federation.get('cached', '/repos') for _ in range(5)))
+        await federation.get('cached', '/repos')
+        assert hits == ['cached']
+        await asyncio.sleep(0.5)
+        await federation.get('cached', '/repos')
+        assert hits == ['cached', 'cached']
+
+        # Actions are routed to the peer and invalidate its cache.
+        assert await federation.post('cached', '/repos/r/processes/p', dict(action='kill')) == dict(action='kill')
+        await federation.get('cached', '/repos')
+        assert hits == ['cached', 'cached', ('cached', 'r', 'p', 'kill'), 'cached']
+
+        with pytest.raises(PeerError):
+            await federation.get('unknown', '/repos')
+        await federation.close()
+
+    asyncio.run(run())
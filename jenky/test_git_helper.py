@@ -0,0 +1,116 @@
+import asyncio
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+from jenky import git_helper
+from jenky.git_helper import GitQueue
+from jenky.util import Repo
+
+pytestmark = pytest.mark.skipif(subprocess.run(['git', '--version'], capture_output=True).returncode != 0,
+                                reason='Needs git')
+
+
+def git(cwd: Path, *args: str) -> str:
+    completed = subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+                               cwd=cwd, capture_output=True, check=True)
+    return completed.stdout.decode().strip()
+
+
+def make_clones(tmp_path: Path, count: int):
+    """
+    Returns a clone to push from and count clones, all with the same bare origin.
+    """
+    origin = tmp_path / 'origin.git'
+    git(tmp_path, 'init', '--bare', '-b', 'main', origin.as_posix())
+    upstream = tmp_path / 'upstream'
+    git(tmp_path, 'clone', origin.as_posix(), upstream.as_posix())
+    git(upstream, 'checkout', '-b', 'main')
+    (upstream / 'requirements.txt').write_text('fastapi\n')
+    git(upstream, 'add', '.')
+    git(upstream, 'commit', '-m', 'first')
+    git(upstream, 'tag', '0.0.1')
+    git(upstream, 'push', '--tags', 'origin', 'main')
+
+    repos = []
+    for i in range(count):
+        directory = tmp_path / f'clone{i}'
+        git(tmp_path, 'clone', origin.as_posix(), directory.as_posix())
+        repos.append(Repo.parse_obj(dict(repoName=f'repo{i}', directory=directory, processes=[])))
+    return upstream, repos
+
+
+def test_fetch_and_checkout(tmp_path: Path):
+    upstream, (repo,) = make_clones(tmp_path, 1)
+    (upstream / 'requirements.txt').write_text('fastapi\npandas\n')
+    git(upstream, 'commit', '-am', 'second')
+    git(upstream, 'tag', '0.0.2')
+    git(upstream, 'push', '--tags', 'origin', 'main')
+
+    async def run():
+        done = []
+        queue = GitQueue(concurrency=2, on_done=done.append)
+        fetch = queue.fetch(repo)
+        # Reused while running
+        assert queue.fetch(repo) is fetch
+        await asyncio.wait_for(fetch.done.wait(), 10)
+        assert fetch.state == 'done', fetch.lines
+        assert fetch.lines[0] == '$ git fetch --tags --progress'
+        # Reused within the ttl
+        assert queue.fetch(repo) is fetch
+
+        checkout = queue.submit(repo, 'checkout', 'refs/tags/0.0.2')
+        lines = [line async for line in checkout.follow()]
+        assert checkout.state == 'done'
+        assert lines == checkout.lines
+        assert 'Warning: requirements.txt did change!' in lines
+        assert (repo.directory / 'requirements.txt').read_text() == 'fastapi\npandas\n'
+
+        bad = queue.submit(repo, 'checkout', 'refs/tags/nope')
+        await asyncio.wait_for(bad.done.wait(), 10)
+        assert bad.state == 'failed'
+        assert bad.error == 'Exit code 1'
+
+        with pytest.raises(ValueError):
+            queue.submit(repo, 'push')
+        await asyncio.sleep(0)
+        assert done == [fetch, checkout, bad]
+
+    asyncio.run(run())
+
+
+def test_serialization(tmp_path: Path, monkeypatch):
+    _, repos = make_clones(tmp_path, 3)
+    running = []
+    max_running = []
+
+    def slow_fetch(git_dir: Path, git_ref, on_line) -> int:
+        running.append(git_dir)
+        max_running.append(len(running))
+        on_line(git_dir.name)
+        time.sleep(.2)
+        running.remove(git_dir)
+        return 0
+
+    monkeypatch.setitem(git_helper.ACTIONS, 'fetch', slow_fetch)
+
+    async def run():
+        queue = GitQueue(concurrency=2, fetch_ttl=0)
+        jobs = queue.fetch_all(repos) + [queue.fetch(repos[0])]
+        # The second fetch of repos[0] is still running.
+        assert jobs[3] is jobs[0]
+        jobs.append(queue.submit(repos[0], 'fetch'))
+        await asyncio.wait_for(asyncio.gather(*(job.done.wait() for job in jobs)), 10)
+        assert [job.state for job in jobs] == ['done'] * 5
+        # Same repo one after the other.
+        assert jobs[4].started_at >= jobs[0].finished_at
+        # Different repos concurrently, up to the limit.
+        assert max(max_running) == 2
+        # After the ttl, a new fetch.
+        job = queue.fetch(repos[1])
+        assert job is not jobs[1]
+        await asyncio.wait_for(job.done.wait(), 10)
+
+    asyncio.run(run())
@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from jenky import util
+from jenky.health import HealthChecker
+
+
+def make_process(tmp_path, name: str, liveness: dict) -> util.Process:
+    repo = util.Repo.parse_obj(dict(repoName='r', directory=tmp_path, processes=[
+        dict(name=name, cmd=[], env={}, keepRunning=True, liveness=dict(interval=0.05, initialDelay=0, **liveness))]))
+    proc = repo.processes[0]
+    proc.set_repo(repo)
+    proc.create_time = time.time()
+    return proc
+
+
+def test_health_checker(tmp_path):
+    async def run():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        alive = make_process(tmp_path, 'alive', dict(port=port))
+        hung = make_process(tmp_path, 'hung', dict(command=['sleep', '1'], timeout=0.05, failureThreshold=2))
+        failing = make_process(tmp_path, 'failing', dict(command=['false'], failureThreshold=3))
+
+        unhealthy = []
+        checker = HealthChecker(on_unhealthy=lambda proc: unhealthy.append((proc.name, time.monotonic())))
+        t0 = time.monotonic()
+        checker.start([alive, hung, failing])
+        await asyncio.sleep(1.)
+        await checker.close()
+        server.close()
+        return t0, checker, unhealthy, [alive, hung, failing]
+
+    t0, checker, unhealthy, (alive, hung, failing) = asyncio.run(run())
+    assert alive.healthy
+    assert checker.states['alive'].histogram.count >= 3
+    assert not hung.healthy
+    assert checker.states['hung'].last_error.startswith('Timeout')
+    assert not failing.healthy
+    assert checker.states['failing'].last_error == 'Exit code 1'
+    unhealthy_at = dict(reversed(unhealthy))
+    assert set(unhealthy_at) == {'hung', 'failing'}
+    # Two intervals and two timeouts
+    assert unhealthy_at['hung'] - t0 < 0.5
+    text = checker.prometheus([alive, hung, failing])
+    assert 'jenky_probe_duration_seconds_bucket{repo="r",process="hung",le="0.1"}' in text
@@ -1,86 +1,60 @@
+import json
 import time
-from pprint import pprint
 from pathlib import Path
-from jenky import util
-
-config = [
-    {
-        "repoName": "jenky",
-        "directory": "jenky",
-        "gitRef": "4711",
-        "gitRefs": ["..."],
-        "processes": [
-            {
-                "name": "jenky",
-                "cmdPattern": {
-                    "index": 1,
-                    "pattern": "test_jenky"
-                }
-            }
-        ]
-    }
-]
-
-
-def test_fill_process_running():
-    util.fill_process_running(config)
-    pprint(config)
-
-
-
-
-def test_fill_tags():
-    util.fill_git_tags(config)
-    pprint(config)
-
-
-def test_find_root():
-    procs = [
-        dict(pid=1, ppid=2, info='p1'),
-        dict(pid=2, ppid=3, info='p2')]
-    root = util.find_root(procs)
-    assert root == procs[1]
 
-    procs = [
-        dict(pid=2, ppid=3, info='p2'),
-        dict(pid=1, ppid=2, info='p1')
-        ]
-    root = util.find_root(procs)
-    assert root == procs[0]
-
-    procs = [
-        dict(pid=1, ppid=2, info='p1'),
-        dict(pid=3, ppid=4, info='p2')
-    ]
-    try:
-        root = util.find_root(procs)
-        assert False
-    except AssertionError:
-        pass
-
-
-def test_git_branches():
-    branches = util.git_branches(Path('c:/ws/projects/VirtualPowerStorage'))
-    pprint(branches)
-
-
-def test_git_tags():
-    tags = util.git_refs(Path('c:/ws/projects/VirtualPowerStorage'))
-    pprint(tags)
-
-
-def test_run():
-    cwd = Path('.').absolute()
-    util.start_process(cwd, ['bash', 'p.sh'])
-    time.sleep(1)
-    util.dump_processes([cwd])
-
-
-def test_match_cmd():
-    cmd1 = ['bash', 'foo.sh']
-    cmd2 = [r'C:\\WINDOWS\\system32\\wsl.exe', '-e', '/bin/bash', 'foo.sh']
-    assert util.match_cmd(cmd1, cmd2)
+import persistqueue
+import psutil
 
+from jenky import util
 
-util.git_cmd = 'C:/ws/tools/PortableGit/bin/git.exe'
-test_match_cmd()
+HASH_1 = '1' * 40
+
+
+def make_repo(tmp_path: Path) -> Path:
+    directory = tmp_path / 'repo'
+    git_dir = directory / '.git'
+    (git_dir / 'refs' / 'heads').mkdir(parents=True)
+    (git_dir / 'HEAD').write_text('ref: refs/heads/main\n')
+    (git_dir / 'refs' / 'heads' / 'main').write_text(HASH_1 + '\n')
+    (git_dir / 'packed-refs').write_text(f'{HASH_1} refs/tags/0.1.0\n')
+    (directory / util.REPO_CONFIG_FILE).write_text(json.dumps(dict(processes=[
+        dict(name='hello', cmd=['python', '-c', 'print(42)'], env={}, keepRunning=False)])))
+    return directory
+
+
+def test_collect_repos(tmp_path: Path):
+    make_repo(tmp_path)
+    app_config_path = tmp_path / 'jenky_app_config.json'
+    app_config_path.write_text(json.dumps(dict(appName='test', repos=[dict(repoName='repo', directory='repo')])))
+
+    app_config, files = util.read_app_config(app_config_path)
+    assert files == [app_config_path, tmp_path / 'repo' / util.REPO_CONFIG_FILE]
+    repos = util.collect_repos(app_config['repos'])
+    repo = repos[0]
+    assert repo.git_refs == dict(hash=HASH_1, heads='main', tags='0.1.0')
+    assert repo.git_tag == f'{HASH_1},main,0.1.0'
+    assert repo.processes[0].repo is repo
+    assert util.make_config(app_config, '1', repos).app_name == 'test'
+
+
+def test_start_process(tmp_path: Path, monkeypatch):
+    directory = make_repo(tmp_path)
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    monkeypatch.setattr(util, 'cache_dir', cache_dir, raising=False)
+    monkeypatch.setattr(util, 'queue', persistqueue.SQLiteQueue((cache_dir / 'queue').absolute()))
+    monkeypatch.setattr(util, 'output_captures', {})
+
+    repo_info = json.loads((directory / util.REPO_CONFIG_FILE).read_text())
+    repo = util.collect_repos([dict(repo_info, repoName='repo', directory=directory)])[0]
+    proc = repo.processes[0]
+    p = util.start_process(proc, directory)
+    if p:
+        try:
+            p.wait(10)
+        except psutil.NoSuchProcess:
+            pass
+    deadline = time.time() + 10
+    while not util.output_capture(proc).read_forward(0)[2] and time.time() < deadline:
+        time.sleep(.05)
+    assert util.output_capture(proc).read_forward(0)[2] == b'42\n'
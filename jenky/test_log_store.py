@@ -0,0 +1,76 @@
+import logging
+import time
+from pathlib import Path
+
+import pytest
+
+from jenky.log_store import LogStore
+
+T0 = float(int(time.time()) - 1000)
+
+
+def make_record(created: float, process: str, level: int, msg: str) -> logging.LogRecord:
+    record = logging.LogRecord('sample', level, 'sample.py', 1, msg, args=(), exc_info=None, func='main')
+    record.created = created
+    record.jenky_process = process
+    return record
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> LogStore:
+    store = LogStore(tmp_path / 'logs.db', retention_days=1)
+    for i in range(100):
+        process = 'a' if i % 2 else 'b'
+        level = logging.ERROR if i % 10 == 0 else logging.INFO
+        store.handle(make_record(T0 + i, process, level, f'message {i} {"boom" if i % 25 == 0 else ""}'))
+    store.flush()
+    yield store
+    store.close()
+
+
+def test_query(store: LogStore):
+    logs, cursor = store.query(limit=10)
+    assert [log['message'].split()[1] for log in logs] == [str(i) for i in range(99, 89, -1)]
+
+    logs, _ = store.query(process='a', level=logging.ERROR, limit=100)
+    assert logs == []
+    logs, _ = store.query(process='b', level=logging.WARNING, since=T0 + 10, until=T0 + 50, limit=100)
+    assert [log['created'] for log in logs] == [T0 + 40, T0 + 30, T0 + 20, T0 + 10]
+
+    if store.fts:
+        logs, _ = store.query(text='boom', limit=100)
+        assert [log['created'] for log in logs] == [T0 + 75, T0 + 50, T0 + 25, T0]
+
+
+def test_keyset_pagination(store: LogStore):
+    cursor = None
+    created = []
+    while True:
+        logs, cursor = store.query(process='a', cursor=cursor, limit=7)
+        created.extend(log['created'] for log in logs)
+        if not cursor:
+            break
+    assert created == [T0 + i for i in range(99, 0, -2)]
+
+
+def test_retention(store: LogStore):
+    store.handle(make_record(T0 - 2 * 86400, 'a', logging.INFO, 'expired'))
+    store.flush()
+    assert store.query(until=T0)[0][0]['message'] == 'expired'
+    store.last_retention = 0.
+    store.handle(make_record(T0 + 100, 'a', logging.INFO, 'new'))
+    store.flush()
+    logs, _ = store.query(limit=1000)
+    assert len(logs) == 101
+    assert 'expired' not in [log['message'] for log in logs]
+
+
+def test_close(store: LogStore):
+    store.close()
+    # Both happen at exit in logging.shutdown().
+    store.flush()
+    store.close()
+    # Not queued, because nobody would write it.
+    store.handle(make_record(T0, 'a', logging.INFO, 'late'))
+    assert store.dropped == 1
+    assert store._queue.empty()
@@ -0,0 +1,130 @@
+import json
+import logging
+import socket
+import sqlite3
+from pathlib import Path
+
+import persistqueue
+
+from jenky import logging as jenky_logging
+from jenky.logging import BatchingPersistHandler, PersistHandler, UnixSocketHandler
+
+
+def read_all(cache_path: Path) -> list:
+    queue = persistqueue.SQLiteQueue(cache_path)
+    items = []
+    while True:
+        try:
+            items.append(queue.get(block=False))
+        except persistqueue.exceptions.Empty:
+            return items
+
+
+def make_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def test_batching_persist_handler(tmp_path: Path):
+    handler = BatchingPersistHandler(tmp_path, batch_size=10, flush_interval=60)
+    logger = make_logger('test_batching', handler)
+    for i in range(25):
+        logger.info(f'record {i}')
+    handler.flush()
+    items = read_all(tmp_path)
+    assert [item['msg'] for item in items] == [f'record {i}' for i in range(25)]
+    assert PersistHandler.record_from_dict(items[0]).getMessage() == 'record 0'
+    handler.close()
+
+
+def test_batching_persist_handler_overflow(tmp_path: Path):
+    # The writer does not drain the buffer until close.
+    handler = BatchingPersistHandler(tmp_path, batch_size=100, flush_interval=60, max_length=5,
+                                     overflow='drop-oldest')
+    logger = make_logger('test_overflow', handler)
+    for i in range(8):
+        logger.info(f'record {i}')
+    assert handler.dropped == 3
+    handler.close()
+    assert [item['msg'] for item in read_all(tmp_path)] == [f'record {i}' for i in range(3, 8)]
+
+    handler = BatchingPersistHandler(tmp_path, batch_size=100, flush_interval=60, max_length=5,
+                                     overflow='drop-newest')
+    logger = make_logger('test_overflow', handler)
+    for i in range(8):
+        logger.info(f'record {i}')
+    assert handler.dropped == 3
+    handler.close()
+    assert [item['msg'] for item in read_all(tmp_path)] == [f'record {i}' for i in range(5)]
+
+
+def test_insert_items(tmp_path: Path):
+    # Fails if persistqueue changes its private schema or serializer.
+    queue = persistqueue.SQLiteQueue(tmp_path)
+    connection = sqlite3.connect((tmp_path / jenky_logging.QUEUE_DB_FILE).as_posix())
+    columns = [row[1] for row in connection.execute(f'PRAGMA table_info({jenky_logging.QUEUE_TABLE})')]
+    assert columns == ['_id', 'data', 'timestamp']
+    jenky_logging.insert_items(connection, [dict(msg='a'), dict(msg='b')])
+    connection.close()
+    assert [queue.get(block=False), queue.get(block=False)] == [dict(msg='a'), dict(msg='b')]
+
+
+def test_batching_persist_handler_retry(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(jenky_logging, 'RETRY_DELAY', .01)
+    insert_items = jenky_logging.insert_items
+    attempts = []
+
+    def flaky_insert(connection, items):
+        attempts.append(len(items))
+        if len(attempts) <= 2:
+            raise sqlite3.OperationalError('database is locked')
+        insert_items(connection, items)
+
+    monkeypatch.setattr(jenky_logging, 'insert_items', flaky_insert)
+    handler = BatchingPersistHandler(tmp_path, batch_size=10, flush_interval=60)
+    errors = []
+    handler.handleError = errors.append
+    logger = make_logger('test_retry', handler)
+    for i in range(3):
+        logger.info(f'record {i}')
+    handler.flush()
+    assert attempts == [3, 3, 3]
+    assert not errors
+    assert [item['msg'] for item in read_all(tmp_path)] == [f'record {i}' for i in range(3)]
+
+    # Always failing, the batch is reported and dropped after all attempts.
+    def failing_insert(connection, items):
+        attempts.append(len(items))
+        raise sqlite3.OperationalError('disk I/O error')
+
+    attempts.clear()
+    monkeypatch.setattr(jenky_logging, 'insert_items', failing_insert)
+    monkeypatch.setattr(jenky_logging, 'WRITE_ATTEMPTS', 2)
+    logger.info('lost')
+    handler.flush()
+    assert (attempts, handler.failed, handler._written) == ([1, 1], 1, 3)
+    assert [record.getMessage() for record in errors] == ['lost']
+    handler.close()
+
+
+def test_unix_socket_handler(tmp_path: Path):
+    socket_path = tmp_path / 'log.sock'
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(socket_path.as_posix())
+
+    handler = UnixSocketHandler(socket_path.as_posix(), tmp_path / 'queue')
+    logger = make_logger('test_socket', handler)
+    logger.info('via socket')
+    item = json.loads(server.recv(65536))
+    assert PersistHandler.record_from_dict(item).getMessage() == 'via socket'
+    assert not (tmp_path / 'queue').exists()
+
+    # The server is gone.
+    server.close()
+    socket_path.unlink()
+    logger.info('via queue')
+    handler.close()
+    assert [item['msg'] for item in read_all(tmp_path / 'queue')] == ['via queue']
@@ -0,0 +1,66 @@
+import subprocess
+import time
+
+import psutil
+
+from jenky import util
+from jenky.metrics import Histogram, Ring, Sampler
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in (0.001, 0.005, 0.3, 20.):
+        histogram.observe(value)
+    cumulative = dict(histogram.cumulative())
+    assert cumulative['0.005'] == 2
+    assert cumulative['0.25'] == 2
+    assert cumulative['0.5'] == 3
+    assert cumulative['10'] == 3
+    assert cumulative['+Inf'] == 4
+    assert histogram.count == 4
+
+
+def test_ring():
+    ring = Ring(3)
+    assert ring.last() is None
+    for t in range(5):
+        ring.append(float(t), [float(t)] * 7)
+    series = ring.series()
+    assert series['times'] == [2., 3., 4.]
+    assert series['rssBytes'] == [2., 3., 4.]
+    assert ring.series(since=3.)['times'] == [4.]
+    assert ring.last() == [4.] * 7
+
+
+def test_sampler():
+    repos = util.collect_repos([dict(repoName='r', directory='.', processes=[
+        dict(name='busy', cmd=[], env={}, keepRunning=True)])])
+    proc = repos[0].processes[0]
+    # A shell with a busy child.
+    popen = subprocess.Popen(['sh', '-c', 'while :; do :; done & wait'])
+    try:
+        sampler = Sampler(interval=0.1, capacity=10)
+        sampler.track(proc, psutil.Process(popen.pid))
+        sampler.sample()
+        time.sleep(0.5)
+        sampler.sample()
+
+        series = sampler.series()['busy']
+        assert len(series['times']) == 2
+        assert series['numProcesses'][-1] == 2
+        assert series['cpuPercent'][-1] > 50
+        assert series['rssBytes'][-1] > 0
+
+        text = sampler.prometheus()
+        assert 'jenky_process_num_processes{repo="r",process="busy"} 2\n' in text
+        assert '# TYPE jenky_process_write_bytes gauge\n' in text
+        assert 'jenky_process_write_bytes{repo="r",process="busy"}' in text
+        assert 'jenky_sampler_passes_total 2\n' in text
+
+        sampler.track(proc, None)
+        assert sampler.series() == {}
+    finally:
+        for p in psutil.Process(popen.pid).children(recursive=True):
+            p.kill()
+        popen.kill()
+        popen.wait()
@@ -0,0 +1,109 @@
+from pathlib import Path
+
+from jenky import output
+from jenky.output import OutputCapture
+
+
+def test_utf8_boundary():
+    data = 'aä€😀'.encode('utf8')
+    assert output.utf8_boundary(data) == len(data)
+    assert output.utf8_boundary(data[:-1]) == len(data) - 4
+    assert output.utf8_boundary(data[:-4]) == len(data) - 4
+    assert output.utf8_boundary(data[:2]) == 1
+    assert output.utf8_boundary(b'') == 0
+
+
+def test_read_chunks(tmp_path):
+    path = tmp_path / 'p.out'
+    lines = [f'{i} äöü€😀 ' * (i % 7) + '\n' for i in range(200)]
+    content = ''.join(lines).encode('utf8')
+    path.write_bytes(content)
+
+    # Forward
+    offset = 0
+    chunks = []
+    while True:
+        start, offset, data = output.read_forward(path, offset, size=100)
+        assert start + len(data) == offset
+        if not data:
+            break
+        # Complete lines, or at least complete characters.
+        assert data.endswith(b'\n') or len(data) > 90
+        str(data, encoding='utf8')
+        chunks.append(data)
+    assert b''.join(chunks) == content
+
+    # Backward
+    end = None
+    chunks = []
+    while end != 0:
+        end, _, data = output.read_backward(path, end, size=100)
+        str(data, encoding='utf8')
+        chunks.insert(0, data)
+    assert b''.join(chunks) == content
+
+    # Truncated file starts over.
+    path.write_bytes(b'new\n')
+    assert output.read_forward(path, offset) == (0, 4, b'new\n')
+
+
+def test_read_forward_long_line(tmp_path):
+    path = tmp_path / 'p.out'
+    content = ('€' * 100).encode('utf8')
+    path.write_bytes(content)
+    offset = 0
+    chunks = []
+    while offset < len(content):
+        _, offset, data = output.read_forward(path, offset, size=10)
+        str(data, encoding='utf8')
+        chunks.append(data)
+    assert b''.join(chunks) == content
+
+
+def write(capture: OutputCapture, data: bytes):
+    with open(capture.live_file, 'ab') as f:
+        f.write(data)
+
+
+def test_output_capture(tmp_path: Path):
+    capture = OutputCapture(tmp_path, 'p', max_bytes=100, keep_runs=2)
+
+    # First run, rotated into several segments.
+    capture.start_run().close()
+    run_1 = b''.join(f'run 1 line {i} ä€\n'.encode('utf8') for i in range(50))
+    for i in range(0, len(run_1), 70):
+        write(capture, run_1[i:i + 70])
+        capture.rotate_if_needed()
+    assert len(capture.index.segments) > 5
+    assert not capture.rotate_if_needed()
+
+    # Logical offsets span segments and the live file.
+    offset = 0
+    chunks = []
+    while True:
+        _, offset, data = capture.read_forward(offset, size=64)
+        if not data:
+            break
+        chunks.append(data)
+    assert b''.join(chunks) == run_1
+    assert capture.read_backward()[2].endswith(b'line 49 \xc3\xa4\xe2\x82\xac\n')
+
+    # Segments are compressed in the background.
+    output.compressor.submit(lambda: None).result()
+    assert all(segment.file.endswith('.gz') for segment in capture.index.segments)
+    assert capture.read_forward(0, size=len(run_1) + 1)[2] == run_1
+
+    # Restarts keep the output of the previous runs.
+    capture.start_run().close()
+    write(capture, b'run 2\n')
+    capture.start_run().close()
+    write(capture, b'run 3\n')
+    assert capture.runs() == [2, 3]
+    assert capture.read_forward(0, run=2)[2] == b'run 2\n'
+    assert capture.read_forward(0)[2] == b'run 3\n'
+
+    # The index survives a jenky restart.
+    output.compressor.submit(lambda: None).result()
+    capture = OutputCapture(tmp_path, 'p', max_bytes=100, keep_runs=2)
+    assert capture.runs() == [2, 3]
+    assert capture.read_backward(run=2)[2] == b'run 2\n'
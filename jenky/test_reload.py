@@ -0,0 +1,78 @@
+import os
+from pathlib import Path
+
+from jenky import util
+from jenky.reload import ConfigWatcher, diff_configs
+
+
+def make_config(tmp_path: Path, app_config: dict) -> util.Config:
+    path = tmp_path / 'jenky_app_config.json'
+    path.write_text(util.json.dumps(app_config))
+    app_config, _ = util.read_app_config(path)
+    return util.make_config(app_config, '', [util.Repo.parse_obj(repo) for repo in app_config['repos']])
+
+
+def process(name: str, **kwargs) -> dict:
+    return dict(dict(name=name, cmd=['python', f'{name}.py'], env={}, keepRunning=True), **kwargs)
+
+
+def test_diff_configs(tmp_path):
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'jenky_config.json').write_text(util.json.dumps(dict(processes=[process('b1')])))
+    old = make_config(tmp_path, dict(appName='app', repos=[
+        dict(repoName='a', directory='.', processes=[process('a1'), process('a2'), process('a3'), process('a4')]),
+        dict(repoName='b', directory='b'),
+        dict(repoName='c', directory='.', processes=[process('c1')]),
+    ]))
+    assert old.repos[1].processes[0].name == 'b1'
+    # State is not configuration.
+    old.repos[0].processes[0].create_time = 1.
+
+    new = make_config(tmp_path, dict(appName='app', repos=[
+        dict(repoName='a', directory='.', processes=[
+            process('a1'), process('a2', env=dict(FOO='bar')), process('a4', gracePeriod=10), process('a5')]),
+        dict(repoName='b', directory='b'),
+        dict(repoName='d', directory='.', processes=[process('d1')]),
+    ]))
+    diff = diff_configs(old, new)
+    assert [repo.repoName for repo in diff.added_repos] == ['d']
+    assert diff.removed_repos == ['c']
+    assert diff.changed_repos == []
+    assert [(repo, proc.name) for repo, proc in diff.added] == [('a', 'a5')]
+    assert diff.removed == [('a', 'a3')]
+    assert [(repo, proc.name, restart) for repo, proc, restart in diff.changed] == [('a', 'a2', True),
+                                                                                   ('a', 'a4', False)]
+    assert not diff_configs(new, new)
+
+
+def test_config_watcher(tmp_path):
+    path = tmp_path / 'jenky_config.json'
+    watcher = ConfigWatcher([path])
+    assert not watcher.changed()
+    path.write_text('{}')
+    assert watcher.changed()
+    watcher.watch([path])
+    assert not watcher.changed()
+    os.utime(path, ns=(1, 1))
+    assert watcher.changed()
+
+
+def test_config_watcher_pending(tmp_path):
+    path = tmp_path / 'jenky_config.json'
+    path.write_text('{}')
+    watcher = ConfigWatcher([path])
+    # Half written, so it is not watched again.
+    path.write_text('{"processes": [')
+    os.utime(path, ns=(1, 1))
+    assert watcher.changed()
+    assert watcher.changed()
+
+    # Modified while reading.
+    path.write_text('{"processes": []}')
+    os.utime(path, ns=(2, 2))
+    signature = watcher.current()
+    os.utime(path, ns=(3, 3))
+    watcher.watch([path], signature)
+    assert watcher.changed()
+    watcher.watch([path])
+    assert not watcher.changed()
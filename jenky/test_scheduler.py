@@ -0,0 +1,90 @@
+import asyncio
+import threading
+import time
+
+from jenky import scheduler
+from jenky.scheduler import Scheduler
+
+
+def test_blocking_job_does_not_overlap():
+    runs = []
+    threads = set()
+
+    def action():
+        threads.add(threading.get_ident())
+        start = time.monotonic()
+        # Longer than the interval
+        time.sleep(.05)
+        runs.append((start, time.monotonic()))
+
+    async def run():
+        s = Scheduler()
+        job = s.add('slow', action, .01, delay=0., blocking=True)
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(.005)
+
+        task = asyncio.create_task(ticker())
+        while len(runs) < 3:
+            await asyncio.sleep(.01)
+        task.cancel()
+        await s.close()
+        return job, ticks
+
+    job, ticks = asyncio.run(run())
+    # Each run starts after the previous one ended.
+    for (_, end), (start, _) in zip(runs, runs[1:]):
+        assert start >= end
+    assert threading.get_ident() not in threads
+    # The event loop was not blocked by the job.
+    assert any(start < tick < end for start, end in runs for tick in ticks)
+    assert job.duration.count == job.lateness.count == job.runs >= 3
+    assert job.duration.sum >= .05 * 3
+
+
+def test_backoff_and_stop(monkeypatch):
+    monkeypatch.setattr(scheduler, 'MAX_BACKOFF', .08)
+    starts = []
+
+    async def action():
+        starts.append(time.monotonic())
+        if len(starts) <= 3:
+            raise ValueError('boom')
+        return -1.
+
+    async def run():
+        s = Scheduler()
+        job = s.add('flaky', action, .02, delay=0.)
+        await asyncio.wait_for(job.task, 5)
+        return s, job
+
+    s, job = asyncio.run(run())
+    assert len(starts) == 4
+    assert (job.runs, job.errors, job.consecutive_errors, job.last_error) == (4, 3, 0, 'boom')
+    # Equal jitter of min(MAX_BACKOFF, max(interval, 1) * 2 ** n)
+    for before, after in zip(starts, starts[1:]):
+        assert after - before >= .04
+    # A stopped job is gone.
+    assert 'flaky' not in s.jobs
+    assert job.due is None
+
+
+def test_as_dict_and_prometheus():
+    async def run():
+        s = Scheduler()
+        s.add('tick', lambda: None, 10., delay=0.)
+        await asyncio.sleep(.05)
+        return s
+
+    s = asyncio.run(run())
+    state = s.as_dict()['tick']
+    assert state['runs'] == 1
+    assert 9. < state['dueIn'] <= 10.
+    assert state['lateness']['count'] == 1
+    text = s.prometheus()
+    assert 'jenky_job_duration_seconds_count{job="tick"} 1' in text
+    assert 'jenky_job_lateness_seconds_bucket{job="tick",le="+Inf"} 1' in text
+    assert 'jenky_job_errors_total{job="tick"} 0' in text
@@ -0,0 +1,372 @@
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import httpx
+import persistqueue
+import pytest
+import uvicorn
+from fastapi.testclient import TestClient
+
+from jenky import output, server, util
+from jenky.federation import Federation
+from jenky.server import app
+from jenky.test_util import make_git_dir
+
+
+def write_app_config(tmp_path: Path, processes: List[dict], **app_config) -> Path:
+    """
+    An app config with the repo 'repo' in tmp_path and the processes.
+    """
+    if not (tmp_path / '.git').exists():
+        make_git_dir(tmp_path)
+    app_config_path = tmp_path / 'jenky_app_config.json'
+    app_config_path.write_text(json.dumps(dict(appName='test', repos=[
+        dict(repoName='repo', directory=tmp_path.as_posix(), processes=processes)], **app_config)))
+    return app_config_path
+
+
+def process(name: str, keep_running: bool = False, cmd=('sleep', '30')) -> dict:
+    return dict(name=name, cmd=list(cmd), env={}, keepRunning=keep_running)
+
+
+@contextlib.contextmanager
+def start_app(tmp_path: Path, monkeypatch, app_config_path: Optional[Path] = None) -> TestClient:
+    monkeypatch.setattr(util, 'cache_dir', tmp_path, raising=False)
+    monkeypatch.setattr(util, 'app_config_path', app_config_path)
+    monkeypatch.setattr(util, 'queue', persistqueue.SQLiteQueue((tmp_path / 'queue').absolute()))
+    monkeypatch.setattr(util, 'log_reader', util.LogQueueReader(util.queue.path), raising=False)
+    monkeypatch.setattr(util, 'state_journal', util.StateJournal(tmp_path), raising=False)
+    monkeypatch.setattr(util, 'output_captures', {})
+    monkeypatch.setattr(util.logger, 'handlers', [util.list_handler])
+    # The tests run the jobs themselves.
+    monkeypatch.setattr(server, 'RELOAD_INTERVAL', 3600.)
+    if app_config_path:
+        app_config, _ = util.read_app_config(app_config_path)
+        app.state.config = util.make_config(app_config, '1', util.collect_repos(app_config['repos']))
+    else:
+        app.state.config = util.make_config(dict(appName='test'), '1', [])
+    # Configures logging the same as uvicorn.run before the startup, which closes all existing handlers.
+    uvicorn.Config(app)
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def client(tmp_path: Path, monkeypatch) -> TestClient:
+    with start_app(tmp_path, monkeypatch) as client:
+        yield client
+
+
+def read_events(client: TestClient, headers: Optional[dict] = None,
+                publish: Callable[[], None] = lambda: None) -> List[dict]:
+    """
+    Reads /logs/stream while publish runs, then closes the stream the same as for a slow subscriber.
+    """
+    broadcaster = app.state.broadcaster
+
+    def close():
+        while not broadcaster.subscriptions:
+            time.sleep(.01)
+        publish()
+        subscription = broadcaster.subscriptions[-1]
+        broadcaster.loop.call_soon_threadsafe(subscription.queue.put_nowait, None)
+
+    thread = threading.Thread(target=close)
+    thread.start()
+    response = client.get('/logs/stream', headers=headers or {})
+    thread.join()
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = []
+    for block in response.text.split('\n\n'):
+        event = {}
+        for line in block.splitlines():
+            key, _, value = line.partition(': ')
+            event[key] = value
+        if 'event' in event:
+            events.append(event)
+    return events
+
+
+def message(event: dict) -> str:
+    # Without the format of the handler, if any.
+    return json.loads(event['data'])[1].rpartition(' - ')[2]
+
+
+def test_log_stream(client: TestClient):
+    util.logger.warning('before')
+    events = read_events(client, publish=lambda: util.logger.warning('live'))
+    assert events[0]['event'] == 'repos'
+    assert json.loads(events[0]['data'])['appName'] == 'test'
+    logs = [(event['id'], message(event)) for event in events if event['event'] == 'log']
+    # The backlog oldest first, then the live entries.
+    assert [text for _, text in logs[-2:]] == ['before', 'live']
+    assert [int(event_id) for event_id, _ in logs] == sorted(int(event_id) for event_id, _ in logs)
+
+    # Resume after the entry before
+    last_event_id = logs[-2][0]
+    util.logger.warning('missed')
+    events = read_events(client, headers={'Last-Event-ID': last_event_id})
+    assert [message(event) for event in events if event['event'] == 'log'] == ['live', 'missed']
+
+
+def test_log_store_survives_uvicorn(client: TestClient):
+    util.logger.warning('stored after startup')
+    util.log_store.flush()
+    logs = client.get('/logs/query', params=dict(q='stored')).json()['logs']
+    assert [log['message'] for log in logs] == ['stored after startup']
+
+
+def test_reload_config_retries(tmp_path: Path, monkeypatch):
+    def write_config(names, mtime_ns) -> Path:
+        path = write_app_config(tmp_path, [process(name) for name in names])
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    app_config_path = write_config(['a'], 1)
+    with start_app(tmp_path, monkeypatch, app_config_path) as client:
+        write_config(['a', 'b', 'c'], 2)
+        add_process = server.add_process
+
+        def failing_add_process(repo, proc):
+            if proc.name == 'c':
+                raise RuntimeError('boom')
+            add_process(repo, proc)
+
+        monkeypatch.setattr(server, 'add_process', failing_add_process)
+        with pytest.raises(RuntimeError, match='boom'):
+            client.portal.call(server.reload_config)
+        repo = app.state.config.repos[0]
+        assert [proc.name for proc in repo.processes] == ['a', 'b']
+        assert [proc.name for proc in app.state.loaded_config.repos[0].processes] == ['a']
+        assert app.state.config_watcher.changed()
+
+        # The next poll applies the rest.
+        monkeypatch.setattr(server, 'add_process', add_process)
+        client.portal.call(server.reload_config)
+        assert [proc.name for proc in repo.processes] == ['a', 'b', 'c']
+        assert [proc.name for proc in app.state.loaded_config.repos[0].processes] == ['a', 'b', 'c']
+        assert not app.state.config_watcher.changed()
+
+
+def test_kill_returns_termination(tmp_path: Path, monkeypatch):
+    app_config_path = write_app_config(tmp_path, [process('sleeper', keep_running=True)])
+    with start_app(tmp_path, monkeypatch, app_config_path) as client:
+        proc = app.state.config.repos[0].processes[0]
+        deadline = time.monotonic() + 10
+        while proc.create_time is None and time.monotonic() < deadline:
+            time.sleep(.05)
+        assert proc.create_time
+
+        # sleep exits right away on SIGTERM, the termination is still returned.
+        response = client.post('/repos/repo/processes/sleeper', json=dict(action='kill')).json()
+        termination = response['termination']
+        assert termination['processName'] == 'sleeper'
+        termination = client.get(f'/terminations/{termination["id"]}', params=dict(wait=5)).json()
+        assert termination['state'] == 'terminated'
+        assert client.get('/terminations/12345').status_code == 404
+
+
+def test_process_log(tmp_path: Path, monkeypatch):
+    with start_app(tmp_path, monkeypatch, write_app_config(tmp_path, [process('p')])) as client:
+        proc = app.state.config.repos[0].processes[0]
+        capture = util.output_capture(proc)
+        with capture.start_run() as f:
+            f.write(b'old run\n')
+        lines = [f'line {i:05d} {"x" * 28}\n'.encode() for i in range(2000)]
+        f = capture.start_run()
+        f.write(b''.join(lines))
+        f.flush()
+
+        # The tail
+        response = client.get('/repos/repo/processes/p/out')
+        assert response.headers['X-Runs'] == '1,2'
+        start, end = int(response.headers['X-Start-Offset']), int(response.headers['X-End-Offset'])
+        assert 0 < start and end == 2000 * 40
+        text = response.text
+        # Paging backwards
+        while start > 0:
+            response = client.get('/repos/repo/processes/p/out', params=dict(before=start))
+            assert int(response.headers['X-End-Offset']) == start
+            start = int(response.headers['X-Start-Offset'])
+            text = response.text + text
+        assert text.encode() == b''.join(lines)
+
+        # From an offset, only complete lines
+        f.write(b'new line\npartial')
+        f.flush()
+        response = client.get('/repos/repo/processes/p/out', params=dict(offset=end))
+        assert response.text == 'new line\n'
+        assert int(response.headers['X-End-Offset']) == end + len('new line\n')
+        f.close()
+
+        assert client.get('/repos/repo/processes/p/out', params=dict(run=1, offset=0)).text == 'old run\n'
+        assert client.get('/repos/repo/processes/p/out', params=dict(run=9)).status_code == 404
+        assert client.get('/repos/repo/processes/nope/out').status_code == 404
+
+
+def test_follow_file(tmp_path: Path):
+    path = tmp_path / 'follow.out'
+    path.write_bytes(b'first\n')
+
+    async def run():
+        chunks = server.follow_file(functools.partial(output.read_forward, path), 0)
+        first = await chunks.__anext__()
+        with open(path, 'ab') as f:
+            f.write(b'second\nthird')
+        second = await asyncio.wait_for(chunks.__anext__(), 5)
+        await chunks.aclose()
+        return first, second
+
+    # Streams what is appended, line by line.
+    assert asyncio.run(run()) == (b'first\n', b'second\n')
+
+
+def test_nodes(tmp_path: Path, monkeypatch):
+    requests = []
+
+    def peer(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, request.url.host, request.url.path, request.url.query.decode()))
+        if request.url.host == 'down':
+            return httpx.Response(500)
+        if request.url.path == '/repos':
+            return httpx.Response(200, json=dict(repos=[dict(repoName='remote', processes=[dict(name='q')])]))
+        if request.url.path == '/logs':
+            return httpx.Response(200, json=dict(logsSince=[['7', 'remote log'], ['6', 'older']]))
+        return httpx.Response(200, json=dict(action=json.loads(request.content)['action']))
+
+    peers = [dict(name='n2', url='http://up'), dict(name='n3', url='http://down')]
+    app_config_path = write_app_config(tmp_path, [process('p')], nodeName='n1', peers=peers)
+    with start_app(tmp_path, monkeypatch, app_config_path) as client:
+        federation = app.state.federation
+        app.state.federation = Federation(app.state.config.peers, transport=httpx.MockTransport(peer))
+        client.portal.call(federation.close)
+
+        body = client.get('/nodes/repos').json()
+        assert [(node['name'], node['error'] is None) for node in body['nodes']] == [
+            ('n1', True), ('n2', True), ('n3', False)]
+        assert [(repo['repoName'], repo['node'], repo['processes'][0]['node']) for repo in body['repos']] == [
+            ('repo', 'n1', 'n1'), ('remote', 'n2', 'n2')]
+
+        util.logger.warning('local log')
+        body = client.get('/nodes/logs').json()
+        assert body['logs']['n2'] == [['7', 'remote log'], ['6', 'older']]
+        assert body['logs']['n1'][0][1].endswith('local log')
+        assert list(body['errors']) == ['n3']
+        cursors = dict(item.split(':') for item in body['lastEventId'].split(','))
+        assert cursors['n2'] == '7'
+        client.get('/nodes/logs', params=dict(last_event_id=body['lastEventId']))
+        assert ('GET', 'up', '/logs', 'last_event_id=7') in requests
+
+        assert client.post('/nodes/n2/repos/remote/processes/q', json=dict(action='restart')).json() == dict(
+            action='restart')
+        assert ('POST', 'up', '/repos/remote/processes/q', '') in requests
+        assert client.post('/nodes/n1/repos/repo/processes/p', json=dict(action='kill')).json()['process_id'] == 'p'
+        assert client.post('/nodes/n3/repos/r/processes/q', json=dict(action='kill')).status_code == 502
+        assert client.post('/nodes/n9/repos/r/processes/q', json=dict(action='kill')).status_code == 404
+
+
+def test_jobs(tmp_path: Path, monkeypatch):
+    def fake_git(git_dir: Path, git_ref, on_line) -> int:
+        on_line(f'{git_dir.name} {git_ref}')
+        return 0 if git_ref != 'nope' else 1
+
+    with start_app(tmp_path, monkeypatch, write_app_config(tmp_path, [process('p')])) as client:
+        monkeypatch.setitem(app.state.git_queue.actions, 'fetch', fake_git)
+        monkeypatch.setitem(app.state.git_queue.actions, 'checkout', fake_git)
+
+        jobs = client.post('/repos', json=dict(action='fetch')).json()['jobs']
+        assert [job['repoName'] for job in jobs] == ['repo']
+        job = client.get(f'/jobs/{jobs[0]["id"]}', params=dict(wait=5)).json()
+        assert (job['state'], job['lines']) == ('done', [f'{tmp_path.name} None'])
+        # A successful fetch is reused.
+        assert client.get('/repos/repo').json()['fetch']['id'] == job['id']
+
+        job = client.post('/repos/repo', json=dict(action='checkout', gitRef='nope')).json()['job']
+        assert client.get(f'/jobs/{job["id"]}/stream').text == f'{tmp_path.name} nope\nfailed: Exit code 1\n'
+
+        assert client.post('/repos/repo', json=dict(action='checkout')).status_code == 400
+        assert client.post('/repos/repo', json=dict(action='merge', gitRef='x')).status_code == 400
+        assert client.post('/repos', json=dict(action='checkout')).status_code == 400
+        assert client.post('/repos/nope', json=dict(action='fetch')).status_code == 404
+        assert client.get('/jobs/12345').status_code == 404
+
+
+def test_metrics(tmp_path: Path, monkeypatch):
+    app_config_path = write_app_config(tmp_path, [process('sleeper', keep_running=True)])
+    with start_app(tmp_path, monkeypatch, app_config_path) as client:
+        proc = app.state.config.repos[0].processes[0]
+        deadline = time.monotonic() + 10
+        while proc.create_time is None and time.monotonic() < deadline:
+            time.sleep(.05)
+        try:
+            app.state.sampler.sample()
+            text = client.get('/metrics').text
+            assert 'jenky_process_num_processes{repo="repo",process="sleeper"} 1\n' in text
+            assert '# TYPE jenky_process_read_bytes gauge\n' in text
+            assert 'jenky_sampler_passes_total 1\n' in text
+            assert 'jenky_job_duration_seconds_count{job="syncProcesses"}' in text
+
+            series = client.get('/metrics/series').json()
+            assert series['processes']['sleeper']['numProcesses'] == [1.]
+            assert series['sampler']['passes'] == 1
+        finally:
+            client.post('/repos/repo/processes/sleeper', json=dict(action='kill'))
+
+
+def test_probes(tmp_path: Path, monkeypatch):
+    sleeper = process('sleeper', keep_running=True)
+    sleeper['liveness'] = dict(command=['true'], interval=.05, initialDelay=0)
+    with start_app(tmp_path, monkeypatch, write_app_config(tmp_path, [sleeper])) as client:
+        proc = app.state.config.repos[0].processes[0]
+        deadline = time.monotonic() + 10
+        while not proc.healthy and time.monotonic() < deadline:
+            time.sleep(.05)
+        try:
+            assert proc.healthy
+            probe = client.get('/probes').json()['sleeper']
+            assert (probe['failures'], probe['lastError']) == (0, None)
+            assert probe['latency']['count'] == sum(probe['latency']['counts']) > 0
+            text = client.get('/metrics').text
+            assert 'jenky_probe_duration_seconds_bucket{repo="repo",process="sleeper",le="+Inf"}' in text
+        finally:
+            client.post('/repos/repo/processes/sleeper', json=dict(action='kill'))
+        # Not running is neither healthy nor unhealthy.
+        deadline = time.monotonic() + 10
+        while proc.healthy is not None and time.monotonic() < deadline:
+            time.sleep(.05)
+        assert client.get('/repos').json()['repos'][0]['processes'][0]['healthy'] is None
+
+
+def test_query_logs(client: TestClient):
+    for i in range(5):
+        util.logger.warning(f'query warning {i}')
+    util.logger.error('query error')
+    util.log_store.flush()
+
+    def query(**params) -> dict:
+        return client.get('/logs/query', params=params).json()
+
+    assert [log['message'] for log in query(level='error')['logs']] == ['query error']
+    assert [log['message'] for log in query(level='40')['logs']] == ['query error']
+    assert query(q='error')['logs'][0]['level'] == 40
+
+    # Paging newest first
+    messages = []
+    cursor = None
+    while True:
+        page = query(q='query', limit=2, **(dict(cursor=cursor) if cursor else {}))
+        messages.extend(log['message'] for log in page['logs'])
+        cursor = page['nextCursor']
+        if not cursor:
+            break
+    assert messages == ['query error'] + [f'query warning {i}' for i in reversed(range(5))]
+
+    assert client.get('/logs/query', params=dict(level='loud')).status_code == 422
+    assert client.get('/logs/query', params=dict(q='"unbalanced')).status_code == 422
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from pathlib import Path
+
+import pytest
+
+from jenky import startup, util
+
+
+def make_processes(tmp_path: Path, *infos: dict):
+    repo = util.Repo.parse_obj(dict(repoName='r', directory=tmp_path, processes=[
+        dict(cmd=[], env={}, keepRunning=True, **info) for info in infos]))
+    for proc in repo.processes:
+        proc.set_repo(repo)
+    return repo.processes
+
+
+def test_waves(tmp_path):
+    procs = make_processes(
+        tmp_path, dict(name='web', dependsOn=['api', 'db']), dict(name='api', dependsOn=['db']), dict(name='db'),
+        dict(name='cron'))
+    waves = startup.waves(procs)
+    assert [[proc.name for proc in wave] for wave in waves] == [['db', 'cron'], ['api'], ['web']]
+
+    with pytest.raises(ValueError, match='unknown'):
+        startup.waves(make_processes(tmp_path, dict(name='a', dependsOn=['b'])))
+    with pytest.raises(ValueError, match='Cyclic'):
+        startup.waves(make_processes(tmp_path, dict(name='a', dependsOn=['b']), dict(name='b', dependsOn=['a'])))
+
+
+def test_wait_ready(tmp_path, monkeypatch):
+    monkeypatch.setattr(util, 'cache_dir', tmp_path, raising=False)
+    port_proc, log_proc, file_proc, slow_proc = make_processes(
+        tmp_path,
+        dict(name='port', readiness=dict(port=0)),
+        dict(name='log', readiness=dict(logPattern='^Listening on')),
+        dict(name='file', readiness=dict(file='ready.flag')),
+        dict(name='slow', readiness=dict(file='never.flag', timeout=0.3)))
+
+    async def run():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        port_proc.readiness.port = server.sockets[0].getsockname()[1]
+
+        started_at = time.time()
+        for proc in (port_proc, log_proc, file_proc, slow_proc):
+            proc.create_time = started_at
+        out = util.output_capture(log_proc).start_run()
+        tasks = [asyncio.create_task(startup.wait_ready(proc, started_at))
+                 for proc in (port_proc, log_proc, file_proc, slow_proc)]
+
+        await asyncio.sleep(0.2)
+        out.write(b'Starting\nListening on 8080\n')
+        out.flush()
+        (tmp_path / 'ready.flag').touch()
+        results = await asyncio.gather(*tasks)
+        out.close()
+        server.close()
+        return results
+
+    assert asyncio.run(run()) == [True, True, True, False]
+    assert port_proc.time_to_ready < 0.2
+    assert 0.2 <= log_proc.time_to_ready < 0.5
+    assert 0.2 <= file_proc.time_to_ready < 0.5
+    assert slow_proc.time_to_ready is None
@@ -0,0 +1,119 @@
+import asyncio
+import subprocess
+import time
+
+import psutil
+import pytest
+
+from jenky.supervisor import ExitWatcher, Terminator
+from jenky.util import Process
+
+
+def make_process(name: str, cmd=('sleep', '30')) -> Process:
+    return Process.parse_obj(dict(name=name, cmd=list(cmd), env={}, keepRunning=True))
+
+
+@pytest.mark.skipif(not ExitWatcher.supported, reason='Needs pidfd')
+def test_exit_watcher():
+    proc = make_process('sleeper')
+    exited = []
+
+    async def run():
+        event = asyncio.Event()
+
+        def on_exit(p: Process):
+            exited.append((p, time.monotonic()))
+            event.set()
+
+        watcher = ExitWatcher(asyncio.get_running_loop(), on_exit=on_exit)
+        popen = subprocess.Popen(list(proc.cmd))
+        assert watcher.watch(proc, popen.pid)
+        # Watching twice is a noop.
+        assert watcher.watch(proc, popen.pid)
+        await asyncio.sleep(0.1)
+        killed_at = time.monotonic()
+        popen.kill()
+        await asyncio.wait_for(event.wait(), 2)
+        watcher.close()
+        return killed_at
+
+    killed_at = asyncio.run(run())
+    assert len(exited) == 1
+    assert exited[0][0] is proc
+    assert exited[0][1] - killed_at < 0.5
+
+
+@pytest.mark.skipif(not ExitWatcher.supported, reason='Needs pidfd')
+def test_exit_watcher_gone_process():
+    proc = make_process('gone', cmd=['true'])
+    exited = []
+
+    async def run():
+        watcher = ExitWatcher(asyncio.get_running_loop(), on_exit=exited.append)
+        popen = subprocess.Popen(list(proc.cmd))
+        popen.wait()
+        assert watcher.watch(proc, popen.pid)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert exited == [proc]
+
+
+def test_terminator():
+    polite = make_process('polite')
+    stubborn = make_process('stubborn', cmd=['sh', '-c', "trap '' TERM; exec sleep 30"])
+    stubborn.grace_period = 0.5
+
+    async def run():
+        terminator = Terminator(asyncio.get_running_loop())
+        p1 = psutil.Process(subprocess.Popen(list(polite.cmd)).pid)
+        p2 = psutil.Process(subprocess.Popen(list(stubborn.cmd)).pid)
+        await asyncio.sleep(0.1)
+
+        t0 = time.monotonic()
+        terminations = [terminator.terminate(polite, p1), terminator.terminate(stubborn, p2)]
+        # Terminating twice returns the active termination.
+        assert terminator.terminate(stubborn, p2) is terminations[1]
+        assert all(termination.state == 'terminating' for termination in terminations)
+        await asyncio.gather(*(termination.done.wait() for termination in terminations))
+        return time.monotonic() - t0, terminations
+
+    elapsed, (t1, t2) = asyncio.run(run())
+    assert t1.state == 'terminated'
+    assert t2.state == 'terminated'
+    assert t1.finished_at < t2.finished_at
+    # Both ran concurrently.
+    assert elapsed < 1.5
+    assert not t1.p.is_running()
+    assert not t2.p.is_running()
+
+
+def test_terminator_history():
+    procs = [make_process(f'p{i}') for i in range(3)]
+
+    async def run():
+        terminator = Terminator(asyncio.get_running_loop(), max_length=2)
+        ps = [psutil.Process(subprocess.Popen(list(proc.cmd)).pid) for proc in procs]
+        first = terminator.terminate(procs[0], ps[0])
+        await first.done.wait()
+        # The finished termination is still found.
+        assert terminator.latest(procs[0]) is first
+        assert terminator.latest(procs[0], since=first.started_at + 1) is None
+        assert terminator.active(procs[0]) is None
+
+        second = terminator.terminate(procs[1], ps[1])
+        third = terminator.terminate(procs[2], ps[2])
+        # Only the finished one is evicted.
+        assert list(terminator.terminations.values()) == [second, third]
+        await asyncio.gather(second.done.wait(), third.done.wait())
+
+        # Active terminations are never evicted, even beyond max_length.
+        sleepers = [make_process(f's{i}', cmd=['sh', '-c', "trap '' TERM; exec sleep 30"]) for i in range(3)]
+        for sleeper in sleepers:
+            sleeper.grace_period = 0.3
+        active = [terminator.terminate(sleeper, psutil.Process(subprocess.Popen(list(sleeper.cmd)).pid))
+                  for sleeper in sleepers]
+        assert list(terminator.terminations.values()) == active
+        await asyncio.gather(*(termination.done.wait() for termination in active))
+
+    asyncio.run(run())
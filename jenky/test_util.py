@@ -0,0 +1,229 @@
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+import persistqueue
+import pytest
+
+from jenky import util
+
+HASH_1 = '1' * 40
+HASH_2 = '2' * 40
+HASH_3 = '3' * 40
+
+
+def make_git_dir(tmp_path: Path) -> Path:
+    git_dir = tmp_path / '.git'
+    (git_dir / 'refs' / 'heads').mkdir(parents=True)
+    (git_dir / 'refs' / 'tags').mkdir()
+    (git_dir / 'HEAD').write_text('ref: refs/heads/master\n')
+    (git_dir / 'refs' / 'heads' / 'master').write_text(HASH_1 + '\n')
+    (git_dir / 'packed-refs').write_text(
+        '# pack-refs with: peeled fully-peeled sorted\n'
+        f'{HASH_1} refs/tags/0.1.0\n'
+        f'{HASH_3} refs/tags/0.2.0\n'
+        f'^{HASH_2}\n'
+        f'{HASH_2} refs/heads/develop\n')
+    return git_dir
+
+
+def test_ref_index(tmp_path):
+    git_dir = make_git_dir(tmp_path)
+    index = util.RefIndex(git_dir)
+    assert index.refresh()
+    assert index.head_hash() == HASH_1
+    assert index.named_refs(HASH_1) == dict(hash=HASH_1, heads='master', tags='0.1.0')
+    # Annotated tag 0.2.0 is peeled to the develop commit.
+    assert index.named_refs(HASH_2) == dict(hash=HASH_2, heads='develop', tags='0.2.0')
+
+    # Nothing changed.
+    assert not index.refresh()
+
+    # A new loose ref.
+    (git_dir / 'refs' / 'tags' / 'feature').mkdir()
+    (git_dir / 'refs' / 'tags' / 'feature' / '0.3.0').write_text(HASH_1 + '\n')
+    assert index.refresh()
+    assert index.named_refs(HASH_1)['tags/feature'] == '0.3.0'
+    assert not index.refresh()
+
+    # Detached HEAD to a packed ref.
+    (git_dir / 'HEAD').write_text(HASH_2 + '\n')
+    assert index.refresh()
+    assert util.git_ref(git_dir) == dict(hash=HASH_2, heads='develop', tags='0.2.0')
+
+
+def test_ref_index_packed_branch(tmp_path):
+    git_dir = make_git_dir(tmp_path)
+    (git_dir / 'HEAD').write_text('ref: refs/heads/develop\n')
+    assert util.git_ref(git_dir)['hash'] == HASH_2
+
+
+
+def test_log_queue_reader(tmp_path: Path):
+    queue = persistqueue.SQLiteQueue(tmp_path)
+    for i in range(25):
+        queue.put(dict(msg=f'record {i}', padding='x' * 10000))
+    reader = util.LogQueueReader(tmp_path, batch_size=10, compact_interval=0)
+    assert reader.backlog() == 25
+
+    def failing_handler(items):
+        raise ValueError()
+
+    # Nothing is lost if the handler fails.
+    with pytest.raises(ValueError):
+        reader.drain(failing_handler)
+    assert reader.backlog() == 25
+
+    batches = []
+    while reader.drain(batches.append):
+        pass
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [item['msg'] for batch in batches for item in batch] == [f'record {i}' for i in range(25)]
+    stats = reader.stats()
+    assert stats['backlog'] == 0
+    assert stats['drained'] == 25
+    # The empty queue was compacted.
+    assert (tmp_path / 'data.db-wal').stat().st_size == 0
+    assert (tmp_path / 'data.db').stat().st_size < 25 * 10000 / 10
+    # The writers still work.
+    queue.put(dict(msg='after'))
+    assert reader.backlog() == 1
+
+
+def test_list_handler():
+    handler = util.ListHandler(capacity=10)
+    handler.formatter = logging.Formatter('%(levelname)s - %(message)s')
+    test_logger = logging.getLogger('test_list_handler')
+    test_logger.propagate = False
+    test_logger.addHandler(handler)
+    # Many records within the same second still get distinct ids.
+    for i in range(25):
+        test_logger.warning('record %d', i)
+
+    items = handler.items_since(None)
+    assert [item[0] for item in items] == [str(seq) for seq in range(25, 15, -1)]
+    assert items[0][1] == 'WARNING - record 24'
+    assert handler.items_since('22') == items[:3]
+    assert handler.items_since('25') == []
+    # Cursors which are too old, unknown or from before a restart return everything.
+    assert handler.items_since('3') == items
+    assert handler.items_since('100') == items
+    assert handler.items_since('1600000000i0') == items
+
+
+def test_restart_backoff():
+    proc = util.Process.parse_obj(dict(name='crashing', cmd=['false'], env={}, keepRunning=True, restartBackoff=0.2,
+                                       maxRestarts=4, restartWindow=60))
+    backoff = util.RestartBackoff()
+    assert backoff.may_start(proc)
+    backoff.started(proc)
+    # The first crash restarts without delay.
+    assert backoff.may_start(proc)
+    assert proc.next_restart <= time.time()
+    backoff.started(proc)
+
+    delays = []
+    for restart in range(2):
+        assert not backoff.may_start(proc)
+        delays.append(proc.next_restart - time.time())
+        time.sleep(max(0., proc.next_restart - time.time()))
+        assert backoff.may_start(proc)
+        backoff.started(proc)
+    # Exponential with jitter of up to half the delay.
+    assert 0.05 < delays[0] <= 0.2
+    assert 0.15 < delays[1] <= 0.4
+
+    assert not backoff.may_start(proc)
+    assert proc.crash_looping
+    assert proc.next_restart is None
+
+    backoff.reset(proc)
+    assert not proc.crash_looping
+    assert backoff.may_start(proc)
+
+
+def test_state_journal(tmp_path: Path):
+    # A pid file of an older version is adopted.
+    (tmp_path / 'legacy.json').write_text('{"pid": 42, "create_time": 1.5}')
+    journal = util.StateJournal(tmp_path, max_journal_length=5)
+    assert journal.get('legacy') == dict(pid=42, create_time=1.5, starts=1)
+    assert not (tmp_path / 'legacy.json').exists()
+
+    journal.started('a', 1, 10.)
+    journal.started('b', 2, 20.)
+    journal.started('a', 3, 30.)
+    journal.gone('b')
+    # Gone twice is not journaled.
+    journal.gone('b')
+    assert len((tmp_path / 'state.journal').read_text().splitlines()) == 4
+    journal.close()
+
+    # Replayed from snapshot and journal, and a torn last line is ignored.
+    with open(tmp_path / 'state.journal', 'a') as f:
+        f.write('{"name": "c", "pi')
+    journal = util.StateJournal(tmp_path, max_journal_length=5)
+    assert journal.states == dict(legacy=dict(pid=42, create_time=1.5, starts=1),
+                                  a=dict(pid=3, create_time=30., starts=2))
+    assert (tmp_path / 'state.journal').read_text() == ''
+
+    # Compacted when the journal is full.
+    for i in range(6):
+        journal.started('d', 100 + i, 40.)
+    assert len((tmp_path / 'state.journal').read_text().splitlines()) == 1
+    journal.close()
+    assert util.StateJournal(tmp_path).get('d') == dict(pid=105, create_time=40., starts=6)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Posix venv layout')
+def test_python_runtime(tmp_path: Path):
+    runtime = util.python_runtime(tmp_path)
+    assert runtime.executable == 'python'
+    assert runtime.python_path == tmp_path.as_posix()
+
+    venv = tmp_path / 'venv'
+    (venv / 'bin').mkdir(parents=True)
+    (venv / 'bin' / 'python').symlink_to(sys.executable)
+    (venv / 'lib' / 'python3.12' / 'site-packages').mkdir(parents=True)
+    (venv / 'pyvenv.cfg').write_text('home = /usr/bin\ninclude-system-site-packages = false\nversion = 3.12.1\n')
+
+    runtime = util.python_runtime(tmp_path)
+    assert runtime.executable == (venv / 'bin' / 'python').as_posix()
+    assert runtime.python_path.split(os.pathsep) == [tmp_path.as_posix(),
+                                                     (venv / 'lib' / 'python3.12' / 'site-packages').as_posix()]
+    # Cached
+    assert util.python_runtime(tmp_path) is runtime
+
+    # Resolved again on a checkout, or if the venv was recreated.
+    assert util.python_runtime(tmp_path, git_tag='main') is not runtime
+    runtime = util.python_runtime(tmp_path, git_tag='main')
+    stat = os.stat(venv / 'pyvenv.cfg')
+    os.utime(venv / 'pyvenv.cfg', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert util.python_runtime(tmp_path, git_tag='main') is not runtime
+
+
+def test_sync_process_since(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    monkeypatch.setattr(util, 'cache_dir', cache_dir, raising=False)
+    monkeypatch.setattr(util, 'queue', persistqueue.SQLiteQueue((cache_dir / 'queue').absolute()))
+    monkeypatch.setattr(util, 'state_journal', util.StateJournal(cache_dir))
+    monkeypatch.setattr(util, 'output_captures', {})
+    monkeypatch.setattr(util, 'terminate_handler', util.terminate_process)
+    make_git_dir(tmp_path)
+    repo = util.Repo.parse_obj(dict(repoName='r', directory=tmp_path, processes=[
+        dict(name='sleeper', cmd=['sleep', '30'], env={}, keepRunning=True)]))
+    proc = repo.processes[0]
+    proc.set_repo(repo)
+
+    p, create_time = util.sync_process_since(proc, tmp_path)
+    assert p and create_time is None
+    assert proc.create_time == p.create_time()
+    p2, create_time = util.sync_process_since(proc, tmp_path)
+    assert p2.pid == p.pid and create_time == p.create_time()
+
+    proc.keep_running = False
+    p, create_time = util.sync_process_since(proc, tmp_path)
+    assert p is None and create_time == p2.create_time()
+    assert proc.create_time is None
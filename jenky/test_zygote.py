@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import psutil
+import pytest
+
+from jenky import util, zygote
+from jenky.zygote import Zygote, spawn_args
+
+SCRIPT = """
+import os, sys
+print(os.getpid(), os.getcwd(), os.environ['GREETING'], sys.argv[1:], 'json' in sys.modules, sys.path[0], flush=True)
+sys.exit(int(sys.argv[1]))
+"""
+
+
+def test_spawn_args():
+    assert spawn_args(['python', 'app.py', '--port', '8000']) == ['app.py', '--port', '8000']
+    assert spawn_args(['python', '-m', 'uvicorn', 'app:app']) == ['-m', 'uvicorn', 'app:app']
+    assert spawn_args(['python', '-u', 'app.py']) is None
+    assert spawn_args(['python', '-m']) is None
+    assert spawn_args(['python']) is None
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Needs fork')
+def test_zygote(tmp_path: Path):
+    script = tmp_path / 'script.py'
+    script.write_text(SCRIPT)
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+
+    zygote = Zygote(sys.executable, tmp_path.as_posix(), dict(os.environ), ['json'], tmp_path / 'zygote.sock')
+    try:
+        pids = []
+        for i in range(2):
+            output = tmp_path / f'output{i}.txt'
+            with open(output, 'wb') as f:
+                pid = zygote.spawn([script.as_posix(), str(i)], work_dir.as_posix(), dict(GREETING='hello'), f.fileno())
+            pids.append(pid)
+            p = psutil.Process(pid)
+            assert p.ppid() == zygote.popen.pid
+            # The zygote reaps it, so no exit code here.
+            p.wait(timeout=5)
+            assert output.read_text().split() == [str(pid), work_dir.as_posix(), 'hello', f"['{i}']", 'True',
+                                                  tmp_path.as_posix()]
+        assert len(set(pids)) == 2
+        assert zygote.is_alive()
+    finally:
+        zygote.close()
+    assert not zygote.is_alive()
+    assert not (tmp_path / 'zygote.sock').exists()
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Needs fork')
+def test_zygote_start_timeout(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(zygote, 'START_TIMEOUT', .5)
+    (tmp_path / 'hang.py').write_text('import time\nprint("loading", flush=True)\ntime.sleep(60)\n')
+    env = dict(os.environ, PYTHONPATH=tmp_path.as_posix())
+
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError, match='did not start'):
+        Zygote(sys.executable, tmp_path.as_posix(), env, ['hang'], tmp_path / 'zygote.sock')
+    assert time.monotonic() - t0 < 5
+    assert not (tmp_path / 'zygote.sock').exists()
+
+
+def test_env_digest():
+    env = dict(PATH='/bin', JENKY_NAME='a')
+    assert util.env_digest(env) == util.env_digest(dict(JENKY_NAME='b', PATH='/bin'))
+    assert util.env_digest(env) != util.env_digest(dict(env, PATH='/usr/bin'))
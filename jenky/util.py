@@ -1,23 +1,77 @@
 import argparse
 import collections
+import hashlib
 import json
 import logging
 import os
+import random
+import re
+import socket
 import sys
+import threading
 from pathlib import Path
-from pprint import pprint
 from typing import List, Tuple, Optional, Dict, Callable
+import sqlite3
 import subprocess
+import time
 
 import persistqueue
 import psutil
+from persistqueue.serializers import pickle as serializer
 from pydantic import BaseModel, Field
 
+from jenky import output, zygote
+from jenky.log_store import LogStore
+from jenky.logging import QUEUE_DB_FILE, QUEUE_TABLE, PersistHandler
+
 logger = logging.getLogger(__package__)
 
 cache_dir: Path
+# The app config, which is watched for changes.
+app_config_path: Optional[Path] = None
 queue: Optional[persistqueue.Queue] = None
-log_handler: Callable[[List[Dict]], None] = pprint
+# The Unix socket the server receives log records on, if any.
+log_socket: Optional[Path] = None
+log_store: Optional[LogStore] = None
+log_retention_days = 30.
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s'
+# Local wheel directories for building venvs, and whether to use only these and the wheel cache.
+wheel_dirs: List[Path] = []
+offline: bool = False
+
+
+class Readiness(BaseModel):
+    """
+    When a started process is ready. Set one of port, log_pattern or file.
+    """
+    # A TCP port accepting connections.
+    port: Optional[int]
+    host: str = '127.0.0.1'
+    # A regular expression matching a line of the captured output of the current run.
+    log_pattern: Optional[str] = Field(alias='logPattern')
+    # A file, relative to the repository, created or modified after the start.
+    file: Optional[str]
+    # Seconds after which we give up waiting.
+    timeout: float = 60.
+
+
+class Liveness(BaseModel):
+    """
+    How to check that a running process is alive. Set one of http, port or command.
+    """
+    # A URL which must answer a GET with a status below 400.
+    http: Optional[str]
+    # A TCP port accepting connections.
+    port: Optional[int]
+    host: str = '127.0.0.1'
+    # A command, run in the repository, which must exit with 0.
+    command: Optional[List[str]]
+    # Seconds between probes, after the start before the first probe, and until a probe fails.
+    interval: float = 10.
+    initial_delay: float = Field(10., alias='initialDelay')
+    timeout: float = 2.
+    # Consecutive failures after which the process is restarted.
+    failure_threshold: int = Field(3, alias='failureThreshold')
 
 
 class Process(BaseModel):
@@ -25,6 +79,30 @@ class Process(BaseModel):
     cmd: List[str]
     env: dict
     keep_running: bool = Field(..., alias='keepRunning')
+    # Seconds between SIGTERM and SIGKILL when stopping the process.
+    grace_period: float = Field(3., alias='gracePeriod')
+    # Size at which the captured output is rotated, and the number of runs for which it is kept.
+    max_output_bytes: int = Field(10 * 1024 * 1024, alias='maxOutputBytes')
+    keep_runs: int = Field(3, alias='keepRuns')
+    # The first automatic restart within restart_window is immediate, later ones wait restart_backoff seconds,
+    # doubling per restart up to max_restart_backoff. After max_restarts restarts within restart_window, the process is crash-looping and is
+    # not restarted until a manual restart.
+    restart_backoff: float = Field(1., alias='restartBackoff')
+    max_restart_backoff: float = Field(300., alias='maxRestartBackoff')
+    max_restarts: int = Field(5, alias='maxRestarts')
+    restart_window: float = Field(300., alias='restartWindow')
+    crash_looping: bool = Field(False, alias='crashLooping')
+    next_restart: Optional[float] = Field(alias='nextRestart')
+    # Names of the processes which must be ready before this process is started.
+    depends_on: List[str] = Field([], alias='dependsOn')
+    readiness: Optional[Readiness]
+    liveness: Optional[Liveness]
+    # Modules to import in a warm interpreter, which is forked to start the python process. Posix only.
+    preload: Optional[List[str]]
+    # Result of the liveness probes, None if there are none or the process is not running.
+    healthy: Optional[bool]
+    # Seconds from the start until the readiness condition was met, if it was.
+    time_to_ready: Optional[float] = Field(alias='timeToReady')
     create_time: Optional[float] = Field(alias='createTime')
     service_sub_domain: Optional[str] = Field(alias='serviceSubDomain')
     service_home_path: Optional[str] = Field(alias='serviceHomePath')
@@ -59,50 +137,224 @@ class Repo(BaseModel):
 repos_by_process_id: Dict[int, Repo] = {}
 
 
+class Peer(BaseModel):
+    # The node name of the peer
+    name: str
+    # Base URL of the peer jenky, for example http://host2:8000
+    url: str
+
+
 class Config(BaseModel):
     app_name: str = Field(..., alias='appName')
     version: str
     repos: List[Repo]
+    # Name of this jenky in a federation
+    node_name: str = Field(socket.gethostname(), alias='nodeName')
+    # Other jenky instances shown in the federated view of this one
+    peers: List[Peer] = []
+
+
+class LogEntry:
+    """
+    The raw fields of a log record. The entry is only formatted when it is served, and then only once.
+    """
+    __slots__ = ('seq', 'created', 'levelno', 'levelname', 'name', 'func_name', 'message', 'exc_text', 'formatted')
+
+    def __init__(self, seq: int, record: logging.LogRecord, exc_text: Optional[str]):
+        self.seq = seq
+        self.created = record.created
+        self.levelno = record.levelno
+        self.levelname = record.levelname
+        self.name = record.name
+        self.func_name = record.funcName
+        # Merge the arguments now, they may be mutated by the caller.
+        self.message = record.getMessage()
+        self.exc_text = exc_text
+        self.formatted: Optional[str] = None
 
 
 class ListHandler(logging.StreamHandler):
-    def __init__(self):
+    """
+    Keeps the last capacity log entries in a ring buffer. Each entry has a sequence number, which is its id.
+    The entry with sequence number seq is at position seq % capacity, so a cursor resolves to a slice by arithmetic.
+    """
+
+    def __init__(self, capacity: int = 1000):
         super().__init__()
-        self.buffer = collections.deque(maxlen=1000)
-        self._current_time = 0
-        self._current_index = 0
+        self.capacity = capacity
+        self._entries: List[Optional[LogEntry]] = [None] * capacity
+        # Sequence number of the next entry, the first entry is 1.
+        self._next_seq = 1
+        # Called with each new entry.
+        self.listeners: List[Callable[[LogEntry], None]] = []
+
+    def emit(self, record: logging.LogRecord):
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            # Format the traceback now, so that we do not keep the frames alive.
+            exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+        # Note that handle() holds the handler lock.
+        entry = LogEntry(self._next_seq, record, exc_text)
+        self._entries[entry.seq % self.capacity] = entry
+        self._next_seq += 1
+        for listener in self.listeners:
+            try:
+                listener(entry)
+            except Exception:
+                self.handleError(record)
+
+    def item(self, entry: LogEntry) -> Tuple[str, str]:
+        """
+        Returns the (id, message) item of the entry.
+        """
+        if entry.formatted is None:
+            record = logging.makeLogRecord(dict(
+                created=entry.created, msecs=(entry.created - int(entry.created)) * 1000, levelno=entry.levelno,
+                levelname=entry.levelname, name=entry.name, funcName=entry.func_name, msg=entry.message,
+                exc_text=entry.exc_text))
+            entry.formatted = self.format(record)
+        return str(entry.seq), entry.formatted
+
+    def items_since(self, last_event_id: Optional[str]) -> List[Tuple[str, str]]:
+        """
+        Returns all items newer than the item with the given id, newest first.
+        An unknown id, for example from before a restart of jenky, returns all items.
+        """
+        with self.lock:
+            next_seq = self._next_seq
+            oldest_seq = max(1, next_seq - self.capacity)
+            try:
+                first_seq = int(last_event_id) + 1
+            except (TypeError, ValueError):
+                first_seq = oldest_seq
+            if first_seq > next_seq:
+                first_seq = oldest_seq
+            first_seq = max(first_seq, oldest_seq)
+            entries = [self._entries[seq % self.capacity] for seq in range(next_seq - 1, first_seq - 1, -1)]
+        return [self.item(entry) for entry in entries]
+
+
+list_handler = ListHandler()
 
-    def unique_id(self, timestamp: float) -> str:
-        if int(timestamp) == self._current_time:
-            self._current_index += self._current_index
+
+def handle_logs(items: List[Dict]):
+    """
+    Passes the log records of the child processes to the list handler and the log store.
+    """
+    for item in items:
+        record = PersistHandler.record_from_dict(item)
+        list_handler.handle(record)
+        if log_store:
+            log_store.handle(record)
+
+
+log_handler: Callable[[List[Dict]], None] = handle_logs
+
+
+class StateJournal:
+    """
+    The pid, create time and number of starts of each process we started. The state is kept in memory, and is only
+    read from disk at startup, so that we can adopt the processes which survived us.
+    On disk, it is the snapshot state.json, which is replaced atomically, and the journal state.journal with one JSON
+    line per change since the snapshot. We do not fsync, because after a crash of the host there is nothing to adopt.
+    """
+
+    def __init__(self, directory: Path, max_journal_length: int = 1000):
+        self.directory = directory
+        self.snapshot_file = directory / 'state.json'
+        self.journal_file = directory / 'state.journal'
+        self.max_journal_length = max_journal_length
+        self.states: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._load()
+        self._compact()
+
+    def _load(self):
+        if self.snapshot_file.exists():
+            self.states = json.loads(self.snapshot_file.read_text(encoding='utf8'))
+        if self.journal_file.exists():
+            with open(self.journal_file, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # We died while writing the last line.
+                        logger.warning(f'Ignoring invalid line in {self.journal_file}')
+                        continue
+                    self._apply(change)
+
+        # Pid files of older versions
+        for pid_file in self.directory.glob('*.json'):
+            try:
+                p_info = json.loads(pid_file.read_text())
+            except ValueError:
+                continue
+            if isinstance(p_info, dict) and set(p_info) == {'pid', 'create_time'}:
+                self.states.setdefault(pid_file.stem, dict(p_info, starts=1))
+                pid_file.unlink()
+
+    def _apply(self, change: dict):
+        name = change.pop('name')
+        if change.get('pid') is None:
+            self.states.pop(name, None)
         else:
-            self._current_index = 0
-            self._current_time = int(timestamp)
-        return str(f'{self._current_time}i{self._current_index}')
+            self.states[name] = change
 
-    def emit(self, record):
-        msg = self.format(record)
-        self.buffer.appendleft((self.unique_id(record.created), msg))
+    def _compact(self):
+        tmp_file = self.snapshot_file.with_suffix('.tmp')
+        tmp_file.write_text(json.dumps(self.states), encoding='utf8')
+        os.replace(tmp_file, self.snapshot_file)
+        self._journal = open(self.journal_file, 'w', encoding='utf8')
+        self._journal_length = 0
 
+    def _append(self, change: dict):
+        self._journal.write(json.dumps(change) + '\n')
+        self._journal.flush()
+        self._journal_length += 1
+        if self._journal_length >= self.max_journal_length:
+            self._journal.close()
+            self._compact()
 
-list_handler = ListHandler()
+    def get(self, name: str) -> Optional[dict]:
+        return self.states.get(name)
 
+    def started(self, name: str, pid: int, create_time: float):
+        with self._lock:
+            starts = self.states.get(name, {}).get('starts', 0) + 1
+            self.states[name] = dict(pid=pid, create_time=create_time, starts=starts)
+            self._append(dict(name=name, pid=pid, create_time=create_time, starts=starts))
 
-def find_process(pid_file: Path) -> Optional[psutil.Process]:
-    logger.debug(f'Reading {pid_file}')
+    def gone(self, name: str):
+        with self._lock:
+            if name in self.states:
+                del self.states[name]
+                self._append(dict(name=name, pid=None))
 
-    if not pid_file.exists():
-        logger.debug(f'No such file: {pid_file}')
-        return None
+    def close(self):
+        with self._lock:
+            self._journal.close()
 
-    try:
-        p_info = json.loads(pid_file.read_text())
-    except Exception as e:
-        logger.exception(f'Reading pid file {pid_file}')
-        raise e
 
-    pid = p_info['pid']
-    assert isinstance(pid, int)
+state_journal: Optional[StateJournal] = None
+_state_journal_lock = threading.Lock()
+
+
+def get_state_journal() -> StateJournal:
+    global state_journal
+    with _state_journal_lock:
+        if state_journal is None:
+            state_journal = StateJournal(cache_dir)
+    return state_journal
+
+
+def find_process(name: str) -> Optional[psutil.Process]:
+    """
+    Returns the running process we started under this name, if any.
+    """
+    state = get_state_journal().get(name)
+    if state is None:
+        return None
+    pid = state['pid']
 
     try:
         p = psutil.Process(pid)
@@ -120,7 +372,7 @@ def find_process(pid_file: Path) -> Optional[psutil.Process]:
         return None
 
     try:
-        if abs(p.create_time() - p_info['create_time']) < 1:
+        if abs(p.create_time() - state['create_time']) < 1:
             return p
         # pprint(p.environ())
         # if p.environ().get('JENKY_NAME', '') == proc.name:
@@ -129,9 +381,28 @@ def find_process(pid_file: Path) -> Optional[psutil.Process]:
         pass
 
 
-def sync_process(proc: Process, directory: Path):
-    pid_file = cache_dir / (proc.name + '.json')
-    p = find_process(pid_file)
+# Processes are synced from several worker threads, but a process is never synced concurrently.
+sync_locks: Dict[str, threading.Lock] = {}
+
+
+def sync_process(proc: Process, directory: Path) -> Optional[psutil.Process]:
+    """
+    Starts or stops the process as requested by keep_running. Returns the running process, if any.
+    """
+    return sync_process_since(proc, directory)[0]
+
+
+def sync_process_since(proc: Process, directory: Path) -> Tuple[Optional[psutil.Process], Optional[float]]:
+    """
+    Like sync_process, but also returns the create_time of the process from right before this sync.
+    """
+    with sync_locks.setdefault(proc.name, threading.Lock()):
+        create_time = proc.create_time
+        return _sync_process(proc, directory), create_time
+
+
+def _sync_process(proc: Process, directory: Path) -> Optional[psutil.Process]:
+    p = find_process(proc.name)
 
     if proc.keep_running and p:
         pass
@@ -139,24 +410,160 @@ def sync_process(proc: Process, directory: Path):
         pass
     elif not proc.keep_running and p:
         logger.warning(f'Reaping process {proc.name}')
-        p.terminate()
-        # We need to wait unless a zombie stays in process list!
-        # TODO: We should do this async.
-        gone, alive = psutil.wait_procs([p], timeout=3, callback=None)
-        for process in alive:
-            process.kill()
-        p = None
-    elif proc.keep_running and not p:
+        terminate_handler(proc, p)
+        if not p.is_running():
+            p = None
+    elif proc.keep_running and not p and restart_backoff(proc).may_start(proc):
         logger.warning(f'Restarting process {proc.name}')
+        restart_backoff(proc).started(proc)
         p = start_process(proc, directory)
         if p:
-            pid_file.write_text(json.dumps(dict(pid=p.pid, create_time=p.create_time())))
+            get_state_journal().started(proc.name, p.pid, p.create_time())
+        else:
+            # It died right away, this schedules the next attempt.
+            restart_backoff(proc).may_start(proc)
 
     if p:
         proc.create_time = p.create_time()
     else:
         proc.create_time = None
-        pid_file.unlink(missing_ok=True)
+        get_state_journal().gone(proc.name)
+
+    return p
+
+
+def run_streaming(cmd: List[str], cwd: Path, on_line: Callable[[str], None],
+                  env: Optional[Dict[str, str]] = None) -> int:
+    """
+    Runs the command and passes each line of its output to on_line. Returns the exit code.
+    """
+    with subprocess.Popen(cmd, cwd=cwd.as_posix(), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, env=env) as popen:
+        rest = b''
+        while True:
+            chunk = popen.stdout.read1(4096)
+            if not chunk:
+                break
+            # Progress bars overwrite themselves with carriage returns.
+            lines = re.split(rb'[\r\n]', rest + chunk)
+            rest = lines.pop()
+            for line in lines:
+                if line:
+                    on_line(str(line, encoding='utf8', errors='replace'))
+        if rest:
+            on_line(str(rest, encoding='utf8', errors='replace'))
+    return popen.returncode
+
+
+def terminate_process(proc: Process, p: psutil.Process):
+    """
+    Blocking termination, used unless an asynchronous terminate_handler is installed.
+    """
+    p.terminate()
+    # We need to wait unless a zombie stays in process list!
+    gone, alive = psutil.wait_procs([p], timeout=proc.grace_period, callback=None)
+    for process in alive:
+        process.kill()
+    psutil.wait_procs(alive, timeout=1)
+
+
+class RestartBackoff:
+    """
+    Decides when a process which should be running may be started again.
+    """
+
+    def __init__(self):
+        self.starts: collections.deque = collections.deque()
+
+    def may_start(self, proc: Process) -> bool:
+        """
+        Also sets proc.next_restart and proc.crash_looping.
+        """
+        now = time.time()
+        while self.starts and now - self.starts[0] >= proc.restart_window:
+            self.starts.popleft()
+
+        if proc.crash_looping:
+            return False
+        if len(self.starts) >= proc.max_restarts:
+            logger.error(f'Process {proc.name} is crash-looping, {len(self.starts)} restarts within '
+                         f'{proc.restart_window}s')
+            proc.crash_looping = True
+            proc.next_restart = None
+            return False
+
+        if proc.next_restart is None:
+            if len(self.starts) >= 2:
+                delay = min(proc.max_restart_backoff, proc.restart_backoff * 2 ** (len(self.starts) - 2))
+                # Equal jitter, so that processes crashing together do not restart together.
+                delay = delay / 2 + random.uniform(0, delay / 2)
+            else:
+                # First start, or the first restart since the process ran longer than the window.
+                delay = 0.
+            proc.next_restart = now + delay
+        return now >= proc.next_restart
+
+    def started(self, proc: Process):
+        self.starts.append(time.time())
+        proc.next_restart = None
+
+    def reset(self, proc: Process):
+        self.starts.clear()
+        proc.crash_looping = False
+        proc.next_restart = None
+
+
+restart_backoffs: Dict[str, RestartBackoff] = {}
+
+
+def restart_backoff(proc: Process) -> RestartBackoff:
+    return restart_backoffs.setdefault(proc.name, RestartBackoff())
+
+
+# The zygote per python executable, working directory, preloaded modules and environment.
+zygotes: Dict[Tuple[str, str, Tuple[str, ...], str], zygote.Zygote] = {}
+zygotes_lock = threading.Lock()
+zygote_count = 0
+
+
+def env_digest(env: Dict[str, str]) -> str:
+    """
+    Digest of the environment of a zygote. The name of the process is set per spawn and does not count.
+    """
+    items = sorted((key, value) for key, value in env.items() if key != 'JENKY_NAME')
+    return hashlib.sha256(json.dumps(items).encode()).hexdigest()
+
+
+def get_zygote(executable: str, cwd: str, env: Dict[str, str], preload: List[str]) -> zygote.Zygote:
+    """
+    Returns the running zygote, starting it if needed. The executable is resolved, so that a zygote is started if the
+    venv was replaced. The preloaded modules see the environment, so a changed env also needs its own zygote.
+    """
+    global zygote_count
+    key = (os.path.realpath(os.path.join(cwd, executable)), cwd, tuple(preload), env_digest(env))
+    with zygotes_lock:
+        z = zygotes.get(key)
+        if z is None or not z.is_alive():
+            if z is not None:
+                logger.warning(f'Zygote for {executable} died, starting a new one')
+                z.close()
+            zygote_count += 1
+            socket_path = (cache_dir / f'zygote{zygote_count}.sock').absolute()
+            z = zygotes[key] = zygote.Zygote(executable, cwd, env, preload, socket_path)
+        return z
+
+
+def close_zygotes(cwd: Optional[str] = None):
+    """
+    Closes all zygotes, or those started in the directory cwd.
+    """
+    with zygotes_lock:
+        for key in [key for key in zygotes if cwd is None or key[1] == cwd]:
+            zygotes.pop(key).close()
+
+
+# Must not block if called on the event loop.
+terminate_handler: Callable[[Process, psutil.Process], object] = terminate_process
 
 
 def sync_processes(repos: List[Repo]):
@@ -165,77 +572,149 @@ def sync_processes(repos: List[Repo]):
             sync_process(proc, repo.directory)
 
 
+class PythonRuntime:
+    """
+    The python interpreter of a repo and the environment to run it in.
+    """
+
+    def __init__(self, executable: str, python_path: str, env: Dict[str, str], signature: tuple):
+        self.executable = executable
+        self.python_path = python_path
+        self.env = env
+        self.signature = signature
+
+
+# Resolved runtimes by repo directory.
+python_runtimes: Dict[str, PythonRuntime] = {}
+
+
+def venv_interpreter(directory: Path) -> Path:
+    # See https://docs.python.org/3/library/venv.html for MS-Windows vs Linux.
+    return directory / 'venv' / ('Scripts/python.exe' if os.name == 'nt' else 'bin/python')
+
+
+def venv_signature(directory: Path) -> tuple:
+    signature = []
+    for path in (directory / 'venv' / 'pyvenv.cfg', venv_interpreter(directory)):
+        try:
+            signature.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def make_python_runtime(directory: Path, signature: tuple) -> PythonRuntime:
+    executable = 'python'
+    # We want to have a clean PYTHONPATH. We only add to paths, the repo and site packages.
+    # TODO: Is this a good idea?
+    python_path = [directory.as_posix()]
+    pyvenv_file = directory / 'venv' / 'pyvenv.cfg'
+    if pyvenv_file.is_file():
+        # We have a virtual environment.
+        with open(pyvenv_file, 'r') as f:
+            pyvenv = {k.strip(): v.strip() for k, _, v in (line.partition('=') for line in f) if v}
+        if os.name == 'nt':
+            # Do not use the exe from the venv because this is not a symbolic link and will generate 2 processes.
+            # Note that we are guessing the location of the python installation. This will kind of works on
+            # Windows, but not on linux.
+            executable = pyvenv['home'] + '/python.exe'
+            python_path.append((directory / 'venv/Lib/site-packages').as_posix())
+        elif os.name == 'posix':
+            # Note that we cannot just use pyvenv['home'], because that will probably say /usr/bin, but not
+            # what the python command was to create the venv!
+            # This is a symlink, which is ok.
+            executable = venv_interpreter(directory).as_posix()
+            # The venv may be of any python version.
+            site_packages = sorted((directory / 'venv/lib').glob('python*/site-packages'))
+            python_path.extend(path.as_posix() for path in site_packages)
+        else:
+            assert False, 'Unsupported os ' + os.name
+
+    return PythonRuntime(executable, os.pathsep.join(python_path), os.environ.copy(), signature)
+
+
+def python_runtime(directory: Path, git_tag: str = '') -> PythonRuntime:
+    """
+    Returns the python runtime of the repo directory. It is only resolved again if the venv or, on checkout,
+    the git_tag changed.
+    """
+    directory = directory.absolute()
+    signature = venv_signature(directory) + (git_tag,)
+    runtime = python_runtimes.get(directory.as_posix())
+    if runtime is None or runtime.signature != signature:
+        runtime = python_runtimes[directory.as_posix()] = make_python_runtime(directory, signature)
+        logger.debug(f'Python runtime of {directory}: {runtime.executable}')
+    return runtime
+
+
+def forget_python_runtime(directory: Path):
+    python_runtimes.pop(directory.absolute().as_posix(), None)
+
+
 def start_process(proc: Process, cwd: Path) -> Optional[psutil.Process]:
     name = proc.name
     proc_logger = logging.getLogger(name)
     current_working_directory = cwd.absolute().as_posix()
     proc_logger.info(f'Start process in {current_working_directory}')
 
+    proc.repo.refresh()
+    runtime = python_runtime(cwd, proc.repo.git_tag)
+
     # TODO: On systemd, use it and replace jenky_config with service unit file.
-    my_env = os.environ.copy()
+    my_env = dict(runtime.env)
     my_env.update(proc.env)
 
-    proc.repo.refresh()
+    my_env['JENKY_NAME'] = name
     my_env['JENKY_APP_VERSION'] = proc.repo.git_tag
     my_env['JENKY_LOG_FILE'] = queue.path.as_posix()
-    # We want to have a clean PYTHONPATH. We only add to paths, . and site packages.
-    # TODO: Is this a good idea?
-    my_env['PYTHONPATH'] = '.;'
+    if log_socket:
+        my_env['JENKY_LOG_SOCKET'] = log_socket.as_posix()
+    my_env['PYTHONPATH'] = runtime.python_path
 
     if proc.cmd[0] == 'python':
-        executable = 'python'
-        pyvenv_file = Path('venv/pyvenv.cfg')
-        if pyvenv_file.is_file():
-            # We have a virtual environment.
-            pyvenv = {k.strip(): v.strip() for k, v in (line.split('=') for line in open(pyvenv_file, 'r'))}
-            # See https://docs.python.org/3/library/venv.html for MS-Windows vs Linux.
-            if os.name == 'nt':
-                # Do not use the exe from the venv because this is not a symbolic link and will generate 2 processes.
-                # Note that we are guessing the location of the python installation. This will kind of works on
-                # Windows, but not on linux.
-                executable = pyvenv['home'] + '/python.exe'
-                my_env['PYTHONPATH'] += 'venv/Lib/site-packages'
-            elif os.name == 'posix':
-                # Note that we cannot just use pyvenv['home'], because that will probably say /usr/bin, but not
-                # what the python command was to create the venv!
-                # This is a symlink, which is ok.
-                # TODO: Shall we resolve the symlink?
-                executable = 'venv/bin/python'
-                my_env['PYTHONPATH'] += 'venv/lib/python3.8/site-packages'
-            else:
-                assert False, 'Unsupported os ' + os.name
-
-        cmd = [executable] + proc.cmd[1:]
+        cmd = [runtime.executable] + proc.cmd[1:]
     else:
         cmd = proc.cmd
 
     proc_logger.debug(f'Running: {" ".join(cmd)}')
     proc_logger.debug(f'PYTHONPATH: {my_env.get("PYTHONPATH", "")}')
 
-    out_file = cache_dir / f'{name}.out'
-    out_file.unlink(missing_ok=True)
-    stdout = open(out_file.as_posix(), 'w')
+    stdout = output_capture(proc).start_run()
 
-    if os.name == 'nt':
-        kwargs = {}
-    else:
-        # This prevents that killing this process will kill the child process.
-        kwargs = dict(start_new_session=True)
-
-    # Note: FastApi does not support asyncio subprocesses, so do not use it!
-    popen = subprocess.Popen(
-        cmd,
-        stdin=subprocess.DEVNULL,  # TODO: We do not actually need this, even if subprocess reads from stdin.
-        stdout=stdout,
-        stderr=subprocess.STDOUT,
-        cwd=current_working_directory,
-        env=my_env,
-        **kwargs)
+    pid = None
+    argv = zygote.spawn_args(cmd)
+    if proc.preload is not None and proc.cmd[0] == 'python' and os.name == 'posix' and argv:
+        try:
+            z = get_zygote(cmd[0], current_working_directory, my_env, proc.preload)
+            pid = z.spawn(argv, current_working_directory, my_env, stdout.fileno())
+            proc_logger.debug(f'Forked {pid} from zygote')
+        except Exception:
+            proc_logger.exception('Zygote failed, falling back to a new interpreter')
+
+    if pid is None:
+        if os.name == 'nt':
+            kwargs = {}
+        else:
+            # This prevents that killing this process will kill the child process.
+            kwargs = dict(start_new_session=True)
+
+        # Note: FastApi does not support asyncio subprocesses, so do not use it!
+        popen = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,  # TODO: We do not actually need this, even if subprocess reads from stdin.
+            stdout=stdout,
+            stderr=subprocess.STDOUT,
+            cwd=current_working_directory,
+            env=my_env,
+            **kwargs)
+        pid = popen.pid
+    # The child has its own handle.
+    stdout.close()
 
     try:
-        p = psutil.Process(popen.pid)
+        p = psutil.Process(pid)
     except psutil.NoSuchProcess:
-        proc_logger.warning(f'No such proccess {popen.pid}')
+        proc_logger.warning(f'No such proccess {pid}')
         return
 
     is_running = p.is_running()
@@ -250,6 +729,45 @@ def start_process(proc: Process, cwd: Path) -> Optional[psutil.Process]:
     return p
 
 
+output_captures: Dict[str, output.OutputCapture] = {}
+# The capture names of the processes of a staged generation by their id, see stage_output.
+staged_outputs: Dict[int, str] = {}
+
+
+def output_capture(proc: Process) -> output.OutputCapture:
+    name = staged_outputs.get(id(proc), proc.name)
+    capture = output_captures.get(name)
+    if capture is None:
+        capture = output_captures.setdefault(name, output.OutputCapture(cache_dir, name))
+    capture.max_bytes = proc.max_output_bytes
+    capture.keep_runs = proc.keep_runs
+    return capture
+
+
+def stage_output(proc: Process, name: str):
+    """
+    The process, a copy not yet live, captures its output under name, so that the live process keeps its output.
+    """
+    staged_outputs[id(proc)] = name
+
+
+def adopt_output(staged: Process, proc: Process):
+    """
+    Makes the output of the staged copy the current run of the live process.
+    """
+    name = staged_outputs.pop(id(staged))
+    capture = output_captures.pop(name, None) or output.OutputCapture(cache_dir, name)
+    output_capture(proc).adopt(capture)
+
+
+def discard_output(staged: Process):
+    name = staged_outputs.pop(id(staged), None)
+    if name is not None:
+        capture = output_captures.pop(name, None)
+        if capture:
+            capture.remove()
+
+
 def get_by_id(repos: List[Repo], repo_id: str, process_id: str) -> Tuple[Repo, Process]:
     repo = repo_by_id(repos, repo_id)
     procs = [proc for proc in repo.processes if proc.name == process_id]
@@ -267,22 +785,8 @@ def repo_by_id(repos: List[Repo], repo_id: str) -> Repo:
 
 def get_tail(path: Path) -> List[str]:
     logger.debug(path)
-    with open(path.as_posix(), "rb") as f:
-        try:
-            f.seek(-50*1024, os.SEEK_END)
-            byte_lines = f.readlines()
-            if len(byte_lines):
-                byte_lines = byte_lines[1:]
-            else:
-                # So we are in the middle of a line and could hit a composed unicode character.
-                # But we just ignore that...
-                pass
-        except:
-            # file size too short
-            f.seek(0)
-            byte_lines = f.readlines()
-    lines = [str(byte_line, encoding='utf8') for byte_line in byte_lines]
-    return lines
+    _, _, data = output.read_backward(path)
+    return str(data, encoding='utf8').splitlines(keepends=True)
 
 
 def is_file(p: Path) -> bool:
@@ -292,6 +796,33 @@ def is_file(p: Path) -> bool:
         return False
 
 
+# Per-repo configuration, used if the app config does not list the processes of the repo.
+REPO_CONFIG_FILE = 'jenky_config.json'
+
+
+def read_app_config(path: Path, directories: Optional[Dict[str, Path]] = None) -> Tuple[dict, List[Path]]:
+    """
+    Reads the app config, including the jenky_config.json of the repos which do not list their processes. For the repos
+    in directories, for example deployed to another working tree, that file is read from there.
+    Returns the app config and all files read.
+    """
+    app_config = json.loads(path.read_text(encoding='utf8'))
+    files = [path]
+    for repo in app_config['repos']:
+        repo['directory'] = (path.parent / repo['directory']).resolve()
+        if 'processes' not in repo:
+            repo_config_path = (directories or {}).get(repo['repoName'], repo['directory']) / REPO_CONFIG_FILE
+            files.append(repo_config_path)
+            repo_config = json.loads(repo_config_path.read_text(encoding='utf8'))
+            repo.update((k, v) for k, v in repo_config.items() if k not in repo)
+    return app_config, files
+
+
+def make_config(app_config: dict, version: str, repos: List[Repo]) -> Config:
+    return Config(appName=app_config['appName'], version=version, repos=repos,
+                  nodeName=app_config.get('nodeName', socket.gethostname()), peers=app_config.get('peers', []))
+
+
 def collect_repos(repo_infos: List[dict]) -> List[Repo]:
     repos: List[Repo] = []
 
@@ -307,19 +838,150 @@ def collect_repos(repo_infos: List[dict]) -> List[Repo]:
     return repos
 
 
+class RefIndex:
+    """
+    All named references of a git directory, from both loose refs and packed-refs.
+    The index is only rebuilt if HEAD, packed-refs or one of the refs directories changed.
+    This does not need nor uses a git client installation.
+    """
+
+    def __init__(self, git_dir: Path):
+        self.git_dir = git_dir
+        # HEAD is in head_dir, the refs are in common_dir. Both are git_dir, except for a linked worktree, where .git
+        # is a file pointing to its own directory in the .git/worktrees of the main working tree.
+        self.head_dir = git_dir
+        self.common_dir = git_dir
+        if git_dir.is_file():
+            gitdir = git_dir.read_text(encoding='utf8').strip()
+            assert gitdir.startswith('gitdir:'), f'Invalid {git_dir}'
+            self.head_dir = (git_dir.parent / gitdir[len('gitdir:'):].strip()).resolve()
+            common_file = self.head_dir / 'commondir'
+            if common_file.is_file():
+                self.common_dir = (self.head_dir / common_file.read_text(encoding='utf8').strip()).resolve()
+            else:
+                self.common_dir = self.head_dir
+        self.head = ''
+        # For example 'refs/tags/0.1.0' -> hash
+        self.refs: Dict[str, str] = {}
+        self.names_by_hash: Dict[str, List[str]] = {}
+        self._signature: Optional[Tuple] = None
+        self._ref_dirs: List[Path] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _mtime(path: Path) -> Optional[int]:
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _current_signature(self) -> Tuple:
+        # Git replaces loose ref files by renaming, so a changed or new ref also changes its directory mtime.
+        paths = [self.head_dir / 'HEAD', self.common_dir / 'packed-refs'] + self._ref_dirs
+        return tuple(self._mtime(path) for path in paths)
+
+    def refresh(self) -> bool:
+        """
+        Returns True if the index was rebuilt.
+        """
+        with self._lock:
+            if self._signature is not None and self._signature == self._current_signature():
+                return False
+            self._build()
+            return True
+
+    def _build(self):
+        logger.debug(f'Indexing {self.git_dir.absolute()}')
+        head_mtime = self._mtime(self.head_dir / 'HEAD')
+        packed_mtime = self._mtime(self.common_dir / 'packed-refs')
+        head = (self.head_dir / 'HEAD').read_text(encoding='ascii').strip()
+
+        refs: Dict[str, str] = {}
+        # Peeled hashes of annotated tags, i.e. the commit they point to.
+        peeled: Dict[str, str] = {}
+        packed_refs = self.common_dir / 'packed-refs'
+        if packed_mtime is not None:
+            ref_name = None
+            for line in packed_refs.read_text(encoding='utf8').splitlines():
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('^'):
+                    peeled[ref_name] = line[1:].strip()
+                else:
+                    git_hash, ref_name = line.split(maxsplit=1)
+                    refs[ref_name] = git_hash
+
+        # Loose refs take precedence over packed refs.
+        ref_dirs = []
+        dir_mtimes = []
+        stack = [self.common_dir / 'refs']
+        while stack:
+            ref_dir = stack.pop()
+            mtime = self._mtime(ref_dir)
+            if mtime is None:
+                continue
+            ref_dirs.append(ref_dir)
+            dir_mtimes.append(mtime)
+            with os.scandir(ref_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append(Path(entry.path))
+                    elif entry.is_file():
+                        ref_name = Path(entry.path).relative_to(self.common_dir).as_posix()
+                        refs[ref_name] = Path(entry.path).read_text(encoding='ascii').strip()
+                        peeled.pop(ref_name, None)
+
+        names_by_hash: Dict[str, List[str]] = {}
+        for ref_name in sorted(refs):
+            names_by_hash.setdefault(refs[ref_name], []).append(ref_name)
+            if ref_name in peeled:
+                names_by_hash.setdefault(peeled[ref_name], []).append(ref_name)
+
+        self.head = head
+        self.refs = refs
+        self.names_by_hash = names_by_hash
+        self._ref_dirs = ref_dirs
+        self._signature = tuple([head_mtime, packed_mtime] + dir_mtimes)
+
+    def head_hash(self) -> str:
+        if self.head.startswith('ref:'):
+            # This is a branch, example "ref: refs/heads/master"
+            return self.refs.get(self.head.split()[1], '')
+        # This is detached, and head is a hash AFAIK
+        return self.head
+
+    def named_refs(self, git_hash: str) -> Dict[str, str]:
+        """
+        Returns all named tag or reference for the provided hash and the hash.
+        """
+        refs = dict(hash=git_hash)
+        for ref_name in self.names_by_hash.get(git_hash, []):
+            # For example 'refs/remotes/origin/main' -> {'remotes/origin': 'main'}
+            parent, _, name = ref_name[len('refs/'):].rpartition('/')
+            refs[parent] = name
+        return refs
+
+
+ref_indices: Dict[Path, RefIndex] = {}
+
+
+def ref_index(git_dir: Path) -> RefIndex:
+    """
+    Returns the up-to-date index of the git directory.
+    """
+    index = ref_indices.get(git_dir)
+    if index is None:
+        index = ref_indices.setdefault(git_dir, RefIndex(git_dir))
+    index.refresh()
+    return index
+
+
 def git_named_refs(git_hash: str, git_dir: Path) -> Dict[str, str]:
     """
     Returns all named tag or reference for the provided hash and the hash.
     This method does not need nor uses a git client installation.
     """
-
-    refs = dict(hash=git_hash)
-    ref_dir = git_dir / 'refs'
-    for item in ref_dir.glob('**/*'):
-        if item.is_file() and git_hash == item.read_text(encoding='ascii').strip():
-            refs[item.parent.relative_to(ref_dir).as_posix()] = item.name
-
-    return refs
+    return ref_index(git_dir).named_refs(git_hash)
 
 
 def git_ref(git_dir: Path) -> Dict[str, str]:
@@ -327,36 +989,119 @@ def git_ref(git_dir: Path) -> Dict[str, str]:
     Finds the git reference (tag or branch) of this working directory.
     This method does not need nor uses a git client installation.
     """
+    index = ref_index(git_dir)
+    return index.named_refs(index.head_hash())
 
-    logger.debug(f'Scanning {git_dir.absolute()}')
-    head = (git_dir / 'HEAD').read_text(encoding='ascii').strip()
-    if head.startswith('ref:'):
-        # This is a branch, example "ref: refs/heads/master"
-        ref_path = head.split()[1]
-        git_hash = (git_dir / ref_path).read_text(encoding='ascii').strip()
-    else:
-        # This is detached, and head is a hash AFAIK
-        git_hash = head
 
-    return git_named_refs(git_hash, git_dir)
+class LogQueueReader:
+    """
+    Drains the queue the child processes log into, one batch per SQL round trip.
+    This is at-least-once: Items are only deleted after the log handler succeeded.
+    """
 
+    RATE_WINDOW = 60.
+
+    def __init__(self, path: Path, batch_size: int = 1000, compact_interval: float = 3600.):
+        self.batch_size = batch_size
+        self.compact_interval = compact_interval
+        self.last_compaction = time.time()
+        self.drained = 0
+        # Pairs of time and number of drained items during the last RATE_WINDOW seconds.
+        self._history = collections.deque()
+        self._lock = threading.Lock()
+        # The queue may be drained from different threads, but never concurrently.
+        self.connection = sqlite3.connect((path / QUEUE_DB_FILE).as_posix(), timeout=10, check_same_thread=False)
+        # 2 is INCREMENTAL, which only takes effect with one full VACUUM of the existing database.
+        if self.connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.connection.execute('VACUUM')
+
+    def drain(self, handler: Callable[[List[Dict]], None]) -> int:
+        """
+        Passes at most batch_size items to the handler. Returns the number of drained items.
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                f'SELECT _id, data FROM {QUEUE_TABLE} ORDER BY _id LIMIT ?', (self.batch_size,)).fetchall()
+            if not rows:
+                self._compact_if_due()
+                return 0
+
+            items = []
+            for _id, data in rows:
+                try:
+                    items.append(serializer.loads(data))
+                except Exception:
+                    logger.exception(f'Skipping corrupt log queue item {_id}')
+            if items:
+                handler(items)
+
+            with self.connection:
+                self.connection.execute(f'DELETE FROM {QUEUE_TABLE} WHERE _id <= ?', (rows[-1][0],))
+
+            now = time.time()
+            self.drained += len(rows)
+            self._history.append((now, len(rows)))
+            while self._history[0][0] < now - self.RATE_WINDOW:
+                self._history.popleft()
+            return len(rows)
+
+    def _compact_if_due(self):
+        # No full VACUUM, its exclusive lock would stall the child processes logging into the queue. An incremental
+        # vacuum of the empty queue only releases its free pages, and the checkpoint shrinks the file and truncates
+        # the WAL, both quick.
+        if time.time() - self.last_compaction < self.compact_interval:
+            return
+        logger.debug('Compact log queue')
+        # execute() steps the pragma only once, freeing a single page, executescript() runs it to the end.
+        self.connection.executescript('PRAGMA incremental_vacuum')
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.last_compaction = time.time()
+
+    def backlog(self) -> int:
+        # Ids are contiguous, and this is much cheaper than a COUNT(*).
+        with self._lock:
+            min_id, max_id = self.connection.execute(f'SELECT MIN(_id), MAX(_id) FROM {QUEUE_TABLE}').fetchone()
+        return 0 if min_id is None else max_id - min_id + 1
+
+    def stats(self) -> dict:
+        now = time.time()
+        drained = sum(count for t, count in self._history if t >= now - self.RATE_WINDOW)
+        return dict(backlog=self.backlog(), drained=self.drained, drainRate=drained / self.RATE_WINDOW,
+                    batchSize=self.batch_size, lastCompaction=self.last_compaction)
+
+
+log_reader: Optional[LogQueueReader] = None
+
+
+def read_logs() -> int:
+    """
+    Drains at most one batch of log items. Returns the number of drained items.
+    """
+    return log_reader.drain(log_handler)
 
-def read_logs():
-    items = []
-    while True:  # not queue.empty(), see https://github.com/peter-wangxu/persist-queue/issues/76#issuecomment-850350655
-        try:
-            item = queue.get(block=False)
-        except persistqueue.exceptions.Empty:
-            break
-        items.append(item)
 
-    if items:
-        log_handler(items)
-        queue.task_done()
+def open_log_store():
+    """
+    Opens the log store in the cache dir and attaches it to the logger. Call this only after uvicorn configured logging,
+    which closes all handlers existing by then.
+    """
+    global log_store
+    log_store = LogStore((cache_dir / 'logs.db').absolute(), retention_days=log_retention_days)
+    log_store.formatter = logging.Formatter(LOG_FORMAT)
+    logger.addHandler(log_store)
+
+
+def close_log_store():
+    global log_store
+    if log_store:
+        logger.removeHandler(log_store)
+        log_store.close()
+        log_store = None
 
 
 def parse_args() -> Tuple[str, int, Config]:
-    global cache_dir, queue
+    global cache_dir, app_config_path, queue, log_reader, log_retention_days, state_journal, wheel_dirs, offline
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', type=str, help='Server host', default="127.0.0.1")
@@ -366,27 +1111,38 @@ def parse_args() -> Tuple[str, int, Config]:
                         default="jenky_app_config.json")
     parser.add_argument('--log-level', type=str, help='Log level', default="INFO")
     parser.add_argument('--cache-dir', type=str, help='Path to cache dir', default=".jenky_cache")
+    parser.add_argument('--log-batch-size', type=int, help='Maximal number of log items read at once', default=1000)
+    parser.add_argument('--log-retention-days', type=float, help='Days the logs are kept in the log store',
+                        default=30.)
+    parser.add_argument('--wheel-dir', type=str, action='append', default=[],
+                        help='Local directory of wheels to build venvs from, may be repeated')
+    parser.add_argument('--offline', action='store_true', help='Build venvs only from the wheel dirs and cache')
     args = parser.parse_args()
 
     app_config_path = Path(args.app_config.format(**os.environ))
     cache_dir = Path(args.cache_dir)
     assert cache_dir.is_dir()
-    app_config = json.loads(app_config_path.read_text(encoding='utf8'))
-    for repo in app_config['repos']:
-        repo['directory'] = (app_config_path.parent / repo['directory']).resolve()
+    wheel_dirs = [Path(wheel_dir).absolute() for wheel_dir in args.wheel_dir]
+    offline = args.offline
+    app_config, _ = read_app_config(app_config_path)
 
     jenky_version = ','.join(git_ref(Path('./.git')).values()) if Path('./.git').is_dir() else ''
-    config = Config(appName=app_config['appName'], version=jenky_version, repos=collect_repos(app_config['repos']))
+    config = make_config(app_config, jenky_version, collect_repos(app_config['repos']))
 
     logger.setLevel(logging.__dict__[args.log_level])
     logger.info(args)
 
+    # This creates the queue, which the child processes write to.
     queue = persistqueue.SQLiteQueue((cache_dir / 'mypath').absolute())
+    log_reader = LogQueueReader(queue.path, batch_size=args.log_batch_size)
+    state_journal = StateJournal(cache_dir)
 
+    # The log store is only opened on startup of the server, see open_log_store.
+    log_retention_days = args.log_retention_days
     stream_handler = logging.StreamHandler(sys.stdout)
 
     for handler in (stream_handler, list_handler):
-        handler.formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(funcName)s - %(message)s')
+        handler.formatter = logging.Formatter(LOG_FORMAT)
         logger.addHandler(handler)
 
     logger.info(f'Cache path is {queue.path}')
@@ -0,0 +1,222 @@
+"""
+A zygote is a warm Python interpreter with preloaded modules, which forks to run a script. This saves the start of
+the interpreter and the imports of the preloaded modules on each start of a process. Posix only.
+
+The zygote is started as a script with the python of the venv, so this module must only use the standard library.
+"""
+import array
+import importlib
+import json
+import logging
+import os
+import runpy
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger('jenky')
+
+MAX_REQUEST_SIZE = 1024 * 1024
+# Seconds the zygote may take to import the preloaded modules.
+START_TIMEOUT = 60.
+# Running this file as a script would put the jenky package directory on sys.path, where our logging module shadows
+# the standard one. With -c, sys.path[0] is the working directory instead.
+BOOTSTRAP = 'import runpy, sys; runpy.run_path(sys.argv[1], run_name="__main__")'
+
+
+def send_request(sock: socket.socket, request: dict, fd: int):
+    data = json.dumps(request).encode()
+    sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+
+
+def receive_request(sock: socket.socket) -> Tuple[dict, int]:
+    fds = array.array('i')
+    data, ancdata, _, _ = sock.recvmsg(MAX_REQUEST_SIZE, socket.CMSG_LEN(fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if len(fds) != 1:
+        raise ValueError('Expected one file descriptor')
+    return json.loads(data), fds[0]
+
+
+def serve(socket_path: str) -> Optional[dict]:
+    """
+    The loop of the zygote. Returns only in a forked child, with the request it has to run.
+    """
+    # Children are reaped automatically, jenky watches them by pid.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    # Tell jenky we are ready.
+    print('ready', flush=True)
+
+    while True:
+        connection, _ = server.accept()
+        try:
+            request, fd = receive_request(connection)
+        except Exception as e:
+            connection.close()
+            print(f'Invalid request: {e}', file=sys.stderr, flush=True)
+            continue
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            connection.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Same as Popen(start_new_session=True, stdin=DEVNULL, stdout=fd, stderr=STDOUT)
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(devnull, 0)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(devnull)
+            os.close(fd)
+            return request
+
+        os.close(fd)
+        try:
+            connection.sendall(json.dumps(dict(pid=pid)).encode())
+        finally:
+            connection.close()
+
+
+def run(request: dict):
+    """
+    Runs the script of the request in this (forked) process, same as python would.
+    """
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    argv: List[str] = request['argv']
+    if argv[0] == '-m':
+        sys.argv = argv[1:]
+        sys.path[0] = os.getcwd()
+        runpy.run_module(argv[1], run_name='__main__', alter_sys=True)
+    else:
+        sys.argv = argv
+        sys.path[0] = os.path.dirname(os.path.abspath(argv[0]))
+        runpy.run_path(argv[0], run_name='__main__')
+
+
+def exit_with_parent():
+    """
+    Jenky holds our stdin. When it is gone, so are we. Our children live on.
+    """
+    # Not sys.stdin, whose lock would be held in the forked children.
+    while os.read(0, 1024):
+        pass
+    os._exit(0)
+
+
+def main():
+    # See BOOTSTRAP for the arguments.
+    socket_path = sys.argv[2]
+    threading.Thread(target=exit_with_parent, daemon=True).start()
+    for module in sys.argv[3:]:
+        importlib.import_module(module)
+    request = serve(socket_path)
+    try:
+        run(request)
+    except SystemExit:
+        raise
+    except BaseException:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+class Zygote:
+    """
+    Client side of a zygote, started with the python executable in the directory cwd.
+    """
+
+    def __init__(self, executable: str, cwd: str, env: Dict[str, str], preload: List[str], socket_path: Path):
+        self.executable = executable
+        self.cwd = cwd
+        self.preload = preload
+        self.socket_path = socket_path
+        socket_path.unlink(missing_ok=True)
+        self.popen = subprocess.Popen(
+            [executable, '-c', BOOTSTRAP, Path(__file__).absolute().as_posix(), socket_path.as_posix()] + preload,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, env=env, start_new_session=True)
+        # Waits until the modules are loaded. They may print something themselves.
+        if not self.wait_ready(time.monotonic() + START_TIMEOUT):
+            # A hanging import may not even honour SIGTERM.
+            self.popen.kill()
+            self.popen.wait()
+            self.close()
+            raise RuntimeError(f'Zygote for {executable} did not start within {START_TIMEOUT} seconds')
+        logger.info(f'Zygote for {executable} with {", ".join(preload)} is ready')
+
+    def wait_ready(self, deadline: float) -> bool:
+        """
+        Reads the output of the zygote up to its ready line. Returns False if the zygote exited or the deadline passed.
+        """
+        fd = self.popen.stdout.fileno()
+        pending = b''
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0. or not select.select([fd], [], [], timeout)[0]:
+                return False
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                return False
+            *lines, pending = (pending + chunk).split(b'\n')
+            if any(line.strip() == b'ready' for line in lines):
+                return True
+
+    def is_alive(self) -> bool:
+        return self.popen.poll() is None
+
+    def spawn(self, argv: List[str], cwd: str, env: Dict[str, str], stdout: int) -> int:
+        """
+        Forks the zygote to run python with argv. Returns the pid of the new process.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10.)
+            sock.connect(self.socket_path.as_posix())
+            send_request(sock, dict(argv=argv, cwd=cwd, env=env), stdout)
+            response = json.loads(sock.recv(1024))
+        return response['pid']
+
+    def close(self):
+        self.popen.stdin.close()
+        if self.is_alive():
+            self.popen.terminate()
+            try:
+                self.popen.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.popen.kill()
+                self.popen.wait()
+        self.popen.stdout.close()
+        self.socket_path.unlink(missing_ok=True)
+
+
+def spawn_args(cmd: List[str]) -> Optional[List[str]]:
+    """
+    The argv for the zygote if the python command can be run by a zygote, i.e. python script.py ... or
+    python -m module ...
+    """
+    if len(cmd) < 2:
+        return None
+    if cmd[1] == '-m' and len(cmd) >= 3:
+        return cmd[1:]
+    if cmd[1].startswith('-'):
+        # Interpreter options would have to be applied at the start of the zygote.
+        return None
+    return cmd[1:]
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ import datetime
 import logging.handlers
 from pathlib import Path
 
-from jenky.logging import PersistHandler
+from jenky.logging import UnixSocketHandler
 
 app_version = os.environ.get('JENKY_APP_VERSION', '0.0.0')
 print(app_version)
@@ -15,7 +15,8 @@ logger = logging.getLogger('sample_1')
 # handler = logging.handlers.RotatingFileHandler(
 #    filename=os.environ['JENKY_LOG_FILE'], mode='a', maxBytes=10*1024, backupCount=1)
 
-handler = PersistHandler(Path(os.environ['JENKY_LOG_FILE']))
+# Sends to the jenky server, or to the JENKY_LOG_FILE queue if the server is not listening.
+handler = UnixSocketHandler.from_environ()
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
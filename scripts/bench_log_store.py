@@ -0,0 +1,63 @@
+# Measures ingest and query latency of the log store.
+# Run from the repository root, for tens of millions of rows use for example --rows 20000000:
+#    python scripts/bench_log_store.py --rows 1000000
+
+import argparse
+import logging
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from jenky.log_store import LogStore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, default=1000000)
+parser.add_argument('--processes', type=int, default=40)
+parser.add_argument('--path', type=str, help='Existing store to query, skips ingest', default=None)
+args = parser.parse_args()
+
+levels = [logging.DEBUG, logging.INFO, logging.INFO, logging.INFO, logging.WARNING, logging.ERROR]
+
+if args.path:
+    store = LogStore(Path(args.path), retention_days=36500)
+else:
+    store = LogStore(Path(tempfile.mkdtemp()) / 'logs.db', retention_days=36500, batch_size=10000)
+    t_start = time.time() - args.rows / 1000
+    record = logging.LogRecord('bench', logging.INFO, 'bench.py', 1, '', args=(), exc_info=None, func='main')
+    t0 = time.perf_counter()
+    for i in range(args.rows):
+        record.created = t_start + i / 1000
+        record.levelno = levels[i % len(levels)]
+        record.jenky_process = f'process_{i % args.processes}'
+        record.msg = f'request {i} served in {i % 97} ms'
+        store.emit(record)
+    store.flush()
+    elapsed = time.perf_counter() - t0
+    print(f'ingest: {args.rows:,} rows in {elapsed:.1f}s, {args.rows / elapsed:,.0f} rows/s')
+
+now = time.time()
+queries = {
+    'latest': dict(),
+    'process': dict(process='process_7'),
+    'process+level': dict(process='process_7', level=logging.ERROR),
+    'level': dict(level=logging.ERROR),
+    'time range': dict(since=now - 600, until=now - 300),
+    'process+time range': dict(process='process_7', since=now - 600, until=now - 300),
+    'full text': dict(text='"served in 42 ms"'),
+}
+
+for name, query in queries.items():
+    latencies = []
+    cursor = None
+    # First page and then 20 pages deep via the cursor.
+    for page in range(20):
+        t0 = time.perf_counter()
+        logs, cursor = store.query(cursor=cursor, limit=100, **query)
+        latencies.append(1000 * (time.perf_counter() - t0))
+        if not cursor:
+            break
+    print(f'{name}: first page {latencies[0]:.2f} ms, median page {statistics.median(latencies):.2f} ms, '
+          f'max page {max(latencies):.2f} ms')
+
+store.close()
@@ -0,0 +1,39 @@
+# Measures records/second of PersistHandler against BatchingPersistHandler.
+# Run from the repository root:
+#    python scripts/bench_persist_handler.py --records 20000
+
+import argparse
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+from jenky.logging import BatchingPersistHandler, PersistHandler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--records', type=int, default=20000)
+parser.add_argument('--batch-size', type=int, default=500)
+parser.add_argument('--flush-interval', type=float, default=0.1)
+args = parser.parse_args()
+
+
+def bench(name: str, handler: logging.Handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    t0 = time.perf_counter()
+    for i in range(args.records):
+        logger.info('index %d', i)
+    emitted = time.perf_counter() - t0
+    handler.flush()
+    flushed = time.perf_counter() - t0
+    handler.close()
+    print(f'{name}: emit {args.records / emitted:,.0f} records/s, including flush {args.records / flushed:,.0f} '
+          f'records/s')
+
+
+bench('PersistHandler', PersistHandler(Path(tempfile.mkdtemp())))
+bench('BatchingPersistHandler', BatchingPersistHandler(
+    Path(tempfile.mkdtemp()), batch_size=args.batch_size, flush_interval=args.flush_interval))
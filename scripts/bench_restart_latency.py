@@ -0,0 +1,82 @@
+# Measures the restart latency of a crashed process, that is from kill to the new pid.
+# Run from the repository root:
+#    python scripts/bench_restart_latency.py --mode watch
+#    python scripts/bench_restart_latency.py --mode poll --poll-interval 5 --runs 5
+
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import persistqueue
+
+from jenky import util
+from jenky.supervisor import ExitWatcher
+from jenky.util import Repo
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mode', choices=['watch', 'poll'], default='watch')
+parser.add_argument('--runs', type=int, default=20)
+parser.add_argument('--poll-interval', type=float, default=5.)
+args = parser.parse_args()
+
+util.cache_dir = Path(tempfile.mkdtemp())
+util.queue = persistqueue.SQLiteQueue((util.cache_dir / 'mypath').absolute())
+repo = Repo.parse_obj(dict(
+    repoName='bench', directory=Path('.').absolute(),
+    # Without backoff, only the first restart within the restart window would be immediate.
+    processes=[dict(name='sleeper', cmd=['sleep', '600'], env={}, keepRunning=True, restartBackoff=0.,
+                    maxRestarts=args.runs + 1)]))
+proc = repo.processes[0]
+proc.set_repo(repo)
+
+
+async def main():
+    restarted = asyncio.Event()
+    pids = []
+
+    def sync_process(_proc):
+        p = util.sync_process(_proc, repo.directory)
+        if p and (not pids or p.pid != pids[-1]):
+            pids.append(p.pid)
+            restarted.set()
+        if p and args.mode == 'watch':
+            watcher.watch(_proc, p.pid)
+
+    watcher = ExitWatcher(asyncio.get_running_loop(), on_exit=sync_process)
+    if args.mode == 'watch' and not watcher.supported:
+        raise SystemExit('Exit watching is not supported on this platform')
+
+    async def poll():
+        while True:
+            await asyncio.sleep(args.poll_interval)
+            sync_process(proc)
+
+    if args.mode == 'poll':
+        asyncio.create_task(poll())
+
+    sync_process(proc)
+    latencies = []
+    for _ in range(args.runs):
+        await asyncio.sleep(0.2)
+        restarted.clear()
+        t0 = time.perf_counter()
+        os.kill(pids[-1], signal.SIGKILL)
+        await restarted.wait()
+        latencies.append(time.perf_counter() - t0)
+
+    proc.keep_running = False
+    util.sync_process(proc, repo.directory)
+    watcher.close()
+
+    latencies_ms = [1000 * latency for latency in latencies]
+    print(f'mode={args.mode} runs={args.runs}')
+    print(f'restart latency ms: min={min(latencies_ms):.1f} median={statistics.median(latencies_ms):.1f} '
+          f'max={max(latencies_ms):.1f}')
+
+
+asyncio.run(main())
@@ -0,0 +1,231 @@
+# Scale test of the supervisor and the HTTP endpoints with a synthetic app config of N repos with M processes each.
+# Writes the results as JSON, so that versions can be compared. Run from the repository root (Linux or macOS):
+#    python scripts/bench_scale.py --repos 20 --processes 10 --output bench.json
+#    python scripts/bench_scale.py --repos 20 --processes 10 --baseline bench.json
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import persistqueue
+import uvicorn
+
+from jenky import util
+from jenky.logging import PersistHandler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--repos', type=int, default=10)
+parser.add_argument('--processes', type=int, default=5, help='Processes per repo')
+parser.add_argument('--refs', type=int, default=1000, help='Git refs per repo, half of them packed')
+parser.add_argument('--ticks', type=int, default=20, help='Sync ticks to measure')
+parser.add_argument('--clients', type=int, default=10, help='Concurrent HTTP clients')
+parser.add_argument('--requests', type=int, default=500, help='HTTP requests per endpoint')
+parser.add_argument('--tail-mb', type=int, default=100, help='Size of the file for get_tail')
+parser.add_argument('--records', type=int, default=20000, help='Log records for PersistHandler and read_logs')
+parser.add_argument('--port', type=int, default=8799)
+parser.add_argument('--output', type=str, help='JSON file to write the results to', default=None)
+parser.add_argument('--baseline', type=str, help='JSON file of a previous run to compare with', default=None)
+args = parser.parse_args()
+
+root = Path(tempfile.mkdtemp())
+util.cache_dir = root / 'cache'
+util.cache_dir.mkdir()
+util.queue = persistqueue.SQLiteQueue((util.cache_dir / 'mypath').absolute())
+util.log_reader = util.LogQueueReader(util.queue.path)
+util.state_journal = util.StateJournal(util.cache_dir)
+util.logger.setLevel(logging.WARNING)
+
+results: Dict[str, Dict[str, float]] = {}
+
+
+def summary(latencies: List[float]) -> Dict[str, float]:
+    """
+    Latencies in seconds to milliseconds. The percentiles interpolate between the closest ranks.
+    """
+    # Before Python 3.10, quantiles needs two data points.
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return dict(
+        p50_ms=1000 * statistics.median(latencies),
+        p95_ms=1000 * percentiles[94],
+        p99_ms=1000 * percentiles[98],
+        max_ms=1000 * max(latencies),
+    )
+
+
+def make_git_dir(git_dir: Path, refs: int):
+    """
+    A synthetic .git with a branch, refs // 2 loose tags and the rest in packed-refs.
+    """
+    (git_dir / 'refs' / 'heads').mkdir(parents=True)
+    (git_dir / 'refs' / 'tags').mkdir()
+    (git_dir / 'HEAD').write_text('ref: refs/heads/main\n')
+    (git_dir / 'refs' / 'heads' / 'main').write_text(f'{0:040x}\n')
+    for i in range(refs // 2):
+        (git_dir / 'refs' / 'tags' / f'0.{i}.0').write_text(f'{i:040x}\n')
+    packed = ['# pack-refs with: peeled fully-peeled sorted']
+    packed.extend(f'{i:040x} refs/tags/1.{i}.0' for i in range(refs - refs // 2))
+    (git_dir / 'packed-refs').write_text('\n'.join(packed) + '\n')
+
+
+def make_repos() -> List[dict]:
+    repos = []
+    for r in range(args.repos):
+        directory = root / f'repo{r}'
+        make_git_dir(directory / '.git', args.refs)
+        repos.append(dict(repoName=f'repo{r}', directory=directory, processes=[
+            dict(name=f'repo{r}-process{p}', cmd=['sleep', '3600'], env={}, keepRunning=True)
+            for p in range(args.processes)]))
+    return repos
+
+
+def bench_sync(repos: List[util.Repo]):
+    t0 = time.perf_counter()
+    util.sync_processes(repos)
+    first = time.perf_counter() - t0
+    latencies = []
+    for _ in range(args.ticks):
+        t0 = time.perf_counter()
+        util.sync_processes(repos)
+        latencies.append(time.perf_counter() - t0)
+    results['sync_processes'] = dict(start_all_ms=1000 * first, **summary(latencies))
+
+    latencies = []
+    for _ in range(args.ticks):
+        t0 = time.perf_counter()
+        for repo in repos:
+            repo.refresh()
+        latencies.append(time.perf_counter() - t0)
+    results['repo_refresh'] = summary(latencies)
+
+
+def bench_get_tail():
+    path = root / 'large.log'
+    line = b'2024-01-01 00:00:00,000 - INFO - bench - main - request served in 42 ms\n'
+    with open(path, 'wb') as f:
+        chunk = line * (1024 * 1024 // len(line))
+        for _ in range(args.tail_mb):
+            f.write(chunk)
+    latencies = []
+    for _ in range(100):
+        t0 = time.perf_counter()
+        util.get_tail(path)
+        latencies.append(time.perf_counter() - t0)
+    results['get_tail'] = dict(file_mb=args.tail_mb, **summary(latencies))
+
+
+def bench_logs():
+    handler = PersistHandler(util.queue.path)
+    logger = logging.getLogger('bench.child')
+    logger.propagate = False
+    logger.addHandler(handler)
+    t0 = time.perf_counter()
+    for i in range(args.records):
+        logger.warning('request %d served', i)
+    emitted = time.perf_counter() - t0
+    logger.removeHandler(handler)
+
+    t0 = time.perf_counter()
+    drained = 0
+    while True:
+        n = util.read_logs()
+        if not n:
+            break
+        drained += n
+    read = time.perf_counter() - t0
+    results['persist_handler'] = dict(records_per_s=args.records / emitted)
+    results['read_logs'] = dict(records=drained, records_per_s=drained / read)
+
+
+async def bench_endpoint(client: httpx.AsyncClient, path: str):
+    latencies = []
+    pending = iter(range(args.requests))
+
+    async def worker():
+        for _ in pending:
+            t0 = time.perf_counter()
+            response = await client.get(path)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.clients)))
+    elapsed = time.perf_counter() - t0
+    results[f'http {path}'] = dict(clients=args.clients, requests_per_s=len(latencies) / elapsed,
+                                   **summary(latencies))
+
+
+def bench_http(config: util.Config):
+    from jenky.server import app
+    app.state.config = config
+    server = uvicorn.Server(uvicorn.Config(app, port=args.port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(.1)
+
+    async def run():
+        limits = httpx.Limits(max_connections=args.clients)
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{args.port}', limits=limits, timeout=30) as client:
+            for path in ('/repos', '/logs'):
+                await bench_endpoint(client, path)
+
+    asyncio.run(run())
+    server.should_exit = True
+    thread.join()
+
+
+def compare(baseline: dict):
+    """
+    Prints the change of each metric against the baseline. For latencies lower is better, for rates higher.
+    """
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get('results', {}).get(name, {}).get(metric)
+            if not old or metric in ('file_mb', 'clients', 'records'):
+                continue
+            print(f'{name} {metric}: {old:.3f} -> {value:.3f} ({100 * (value - old) / old:+.1f}%)', file=sys.stderr)
+
+
+repo_infos = make_repos()
+t0 = time.perf_counter()
+repos = util.collect_repos(repo_infos)
+results['collect_repos'] = dict(ms=1000 * (time.perf_counter() - t0))
+config = util.make_config(dict(appName='bench'), '', repos)
+
+try:
+    bench_sync(repos)
+    bench_logs()
+    bench_get_tail()
+    bench_http(config)
+finally:
+    for repo in repos:
+        for proc in repo.processes:
+            proc.keep_running = False
+    util.terminate_handler = util.terminate_process
+    util.sync_processes(repos)
+
+report = dict(
+    version=','.join(util.git_ref(Path('.git')).values()) if Path('.git').exists() else '',
+    time=time.time(),
+    python=sys.version.split()[0],
+    platform=platform.platform(),
+    cpus=os.cpu_count(),
+    args=vars(args),
+    results=results,
+)
+print(json.dumps(report, indent=2))
+if args.output:
+    Path(args.output).write_text(json.dumps(report, indent=2))
+if args.baseline:
+    compare(json.loads(Path(args.baseline).read_text()))
@@ -0,0 +1,69 @@
+# Measures spawn-to-first-log latency of a python process, started as a new interpreter and forked from a zygote.
+# Run from the repository root, preload what your services import:
+#    python scripts/bench_zygote.py --preload fastapi pydantic uvicorn
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import psutil
+
+from jenky.zygote import Zygote
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--preload', nargs='+', default=['fastapi', 'uvicorn'])
+parser.add_argument('--runs', type=int, default=20)
+args = parser.parse_args()
+
+work_dir = Path(tempfile.mkdtemp())
+script = work_dir / 'service.py'
+script.write_text('\n'.join([f'import {module}' for module in args.preload] + [
+    'import logging',
+    'logging.basicConfig(level=logging.INFO)',
+    "logging.info('started')",
+]))
+
+
+def first_log(output: Path, t0: float) -> float:
+    while output.stat().st_size == 0:
+        time.sleep(.0005)
+    return 1000 * (time.perf_counter() - t0)
+
+
+def run(spawn) -> list:
+    latencies = []
+    for i in range(args.runs):
+        output = work_dir / 'output.txt'
+        with open(output, 'wb') as f:
+            t0 = time.perf_counter()
+            pid = spawn(f)
+        latencies.append(first_log(output, t0))
+        psutil.Process(pid).wait()
+    return latencies
+
+
+def popen(f) -> int:
+    return subprocess.Popen([sys.executable, script.as_posix()], stdin=subprocess.DEVNULL, stdout=f,
+                            stderr=subprocess.STDOUT, cwd=work_dir, start_new_session=True).pid
+
+
+t0 = time.perf_counter()
+zygote = Zygote(sys.executable, work_dir.as_posix(), dict(os.environ), args.preload, work_dir / 'zygote.sock')
+print(f'zygote ready after {1000 * (time.perf_counter() - t0):.1f} ms')
+
+try:
+    results = {
+        'popen': run(popen),
+        'zygote': run(lambda f: zygote.spawn([script.as_posix()], work_dir.as_posix(), dict(os.environ), f.fileno())),
+    }
+finally:
+    zygote.close()
+
+for name, latencies in results.items():
+    print(f'{name}: median {statistics.median(latencies):.1f} ms, min {min(latencies):.1f} ms, '
+          f'max {max(latencies):.1f} ms over {len(latencies)} runs')
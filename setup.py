@@ -10,7 +10,7 @@ dist = setup(
     author="Wolfgang Kühn",
     description="A build and deploy server for Python developers",
     packages=['jenky'],
-    install_requires=['aiofiles', 'fastapi', 'psutil', 'uvicorn'],
+    install_requires=['aiofiles', 'fastapi', 'httpx', 'psutil', 'uvicorn'],
     extras_require={},
     package_data=package_data
 )